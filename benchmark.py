@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''
+Times model.Graph commits and loads on each storage backend.
+
+Usage: benchmark.py [cards] [edits]
+
+Builds a board of <cards> cards with an edge between each consecutive
+pair, commits it, makes <edits> single-card edits with a commit each, then
+loads the head commit from scratch. The sqlite backend is run once per
+sqlprofile profile.
+'''
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import kvbackend
+import kvstore
+import model
+import sqlprofile
+
+
+def run(name, datastore, cards, edits):
+    start = time.time()
+    g = model.Graph(datastore, None)
+    previous = None
+    for i in xrange(cards):
+        c = g.new_card(i % 100 * 250, i // 100 * 200, 200, 150)
+        c.text = 'card %d\n\nsome text on the card' % i
+        if previous is not None:
+            g.new_edge(previous, c)
+        previous = c
+    g.commit()
+    built = time.time()
+    for i in xrange(edits):
+        g.cards[i % cards].x += 10
+        head = g.commit()
+    edited = time.time()
+    model.Graph(datastore, head)
+    loaded = time.time()
+    print '%-16s build %7.3fs   %d edits %7.3fs   load %7.3fs' % (
+        name, built - start, edits, edited - built, loaded - edited)
+
+
+def main(argv):
+    cards = int(argv[0]) if len(argv) > 0 else 2000
+    edits = int(argv[1]) if len(argv) > 1 else 200
+    directory = tempfile.mkdtemp()
+    try:
+        run('memory', kvstore.KVStore(kvbackend.MemoryBackend()), cards, edits)
+        conn = sqlite3.connect(os.path.join(directory, 'bench.gp'))
+        run('sqlite plain', kvstore.KVStore(conn, 'objects'), cards, edits)
+        conn.close()
+        for name in sorted(sqlprofile.PROFILES):
+            filename = os.path.join(directory, 'bench-%s.gp' % name)
+            conn = sqlprofile.connect(filename)
+            sqlprofile.apply(conn, name)
+            run('sqlite ' + name, kvstore.KVStore(conn, 'objects'), cards, edits)
+            conn.close()
+        log = kvbackend.LogBackend(os.path.join(directory, 'bench.gplog'))
+        run('log', kvstore.KVStore(log), cards, edits)
+        log.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
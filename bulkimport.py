@@ -0,0 +1,207 @@
+'''
+Importing lots of notes at once.
+
+Building a board of 100k cards through model.Graph encodes and hashes the
+cards one at a time on one core. import_notes() skips the Graph: it lays
+the notes out on a grid, has a pool of worker processes encode and hash
+them a batch at a time, stores each batch as it comes back, and commits
+once at the end. The cards come out exactly as model.Card would save them.
+
+Notes come from sources, which generate note text:
+ * read_directory(): every text or Markdown file under a directory
+ * read_markdown(): one Markdown file, a note per heading
+ * read_csv(): a CSV file, a note per row
+'''
+
+import csv
+import itertools
+import multiprocessing
+import os
+import unittest
+
+import kvstore
+import model
+import objcodec
+import storable
+
+NOTE_EXTENSIONS = ('.txt', '.md', '.markdown')
+BATCH_SIZE = 1000
+DEFAULT_COLUMNS = 50
+# card size, and the space between cards on the grid
+CARD_W = 200
+CARD_H = 150
+GAP = 50
+
+
+def read_directory(path):
+    "Generate the text of each note file under path, in name order"
+    for directory, subdirectories, files in os.walk(path):
+        subdirectories.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in NOTE_EXTENSIONS:
+                with open(os.path.join(directory, name)) as f:
+                    yield f.read().decode('utf-8', 'replace').strip()
+
+def read_markdown(path):
+    '''
+    Generate a note for each heading in the Markdown file at path: the
+    heading without its #s, and what follows up to the next heading.
+    '''
+    note = []
+    with open(path) as f:
+        for line in f:
+            line = line.decode('utf-8', 'replace').rstrip()
+            if line.startswith('#'):
+                if ''.join(note).strip():
+                    yield '\n'.join(note).strip()
+                note = [line.lstrip('#').strip()]
+            else:
+                note.append(line)
+    if ''.join(note).strip():
+        yield '\n'.join(note).strip()
+
+def read_csv(path, column=None):
+    '''
+    Generate a note for each row of the CSV file at path, whose first row
+    names the columns: the named column, or the one called "text", or
+    else the row's fields a line each.
+    '''
+    with open(path, 'rb') as f:
+        rows = csv.reader(f)
+        header = [name.decode('utf-8', 'replace') for name in next(rows, [])]
+        if column is None and 'text' in header:
+            column = 'text'
+        if column is not None and column not in header:
+            raise ValueError('no column "%s" in %s' % (column, path))
+        for row in rows:
+            row = [field.decode('utf-8', 'replace') for field in row]
+            if column is not None:
+                text = row[header.index(column)] if len(row) > header.index(column) else ''
+            else:
+                text = '\n'.join(field for field in row if field)
+            if text.strip():
+                yield text.strip()
+
+
+def place(index, columns, top=0):
+    "(x, y) of the index'th card on the grid"
+    return (index % columns * (CARD_W + GAP),
+            top + index // columns * (CARD_H + GAP))
+
+def encode_batch(job):
+    '''
+    Encode and hash a batch of notes as cards. Runs in the worker
+    processes, so takes and returns only plain data: job is (codec name,
+    hash name, index of the first note, notes, columns, top), and the
+    result is [(encoded card, key, kvstore.object_info() of it)].
+    '''
+    codec_name, hash_name, start, notes, columns, top = job
+    codec = objcodec.get_codec(codec_name)
+    hash_function = kvstore.get_hash(hash_name)
+    out = []
+    for index, text in enumerate(notes, start):
+        x, y = place(index, columns, top)
+        card = storable.Storable({model.objtype: model.CARD_OBJTYPE, 'text': text,
+                                  'x': x, 'y': y, 'w': CARD_W, 'h': CARD_H})
+        encoded = card.encode(codec)
+        out.append((encoded, hash_function(encoded), (model.CARD_OBJTYPE, None)))
+    return out
+
+def bottom(datastore, cards):
+    "The lowest edge of cards, a list of oids, or 0 if there are none"
+    lowest = 0
+    for oid, card in model.load_objects(datastore, cards):
+        lowest = max(lowest, card.get('y', 0) + card.get('h', 0))
+    return lowest
+
+def import_notes(datastore, notes, parent=None, columns=DEFAULT_COLUMNS,
+                 processes=None, batch_size=BATCH_SIZE):
+    '''
+    Make a card of each of notes, an iterable of text, and commit them on
+    top of commit parent, below the cards there already. processes is the
+    size of the worker pool, the number of CPUs by default; 1 does it all
+    in this process. Returns (commit oid, number of cards made).
+    '''
+    if parent is not None:
+        commit = model.load_commit(datastore, parent)
+        cards = list(commit['cards'])
+        edges = commit.get('edges', [])
+    else:
+        cards = []
+        edges = []
+    top = bottom(datastore, cards) + GAP if cards else 0
+    codec_name = objcodec.codec_name(datastore.codec)
+    notes = iter(notes)
+    def jobs():
+        for start in itertools.count(0, batch_size):
+            batch = list(itertools.islice(notes, batch_size))
+            if not batch:
+                return
+            yield codec_name, datastore.hash_name, start, batch, columns, top
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes)
+        batches = pool.imap(encode_batch, jobs())
+    else:
+        batches = itertools.imap(encode_batch, jobs())
+    count = 0
+    try:
+        for batch in batches:
+            cards.extend(datastore.store_many(batch))
+            count += len(batch)
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return model.save_commit(datastore, cards, edges, parent), count
+
+
+class TestBulkImport(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import kvbackend
+        self.directory = tempfile.mkdtemp()
+        self.store = kvstore.KVStore(kvbackend.MemoryBackend())
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def testSameCardsAsGraph(self):
+        notes = [u'note %d \u2603' % i for i in range(25)]
+        head, count = import_notes(self.store, notes, columns=10, processes=2, batch_size=4)
+        self.assertEqual(count, 25)
+        g = model.Graph(self.store, None)
+        for i, text in enumerate(notes):
+            x, y = place(i, 10)
+            g.new_card(x, y, CARD_W, CARD_H).text = text
+        self.assertEqual(model.load_commit(self.store, head)['cards'],
+                         model.load_commit(self.store, g.commit())['cards'])
+        # more go below
+        head, count = import_notes(self.store, ['below'], head, processes=1)
+        g = model.Graph(self.store, head)
+        self.assertEqual(g.cards[-1].y, 3 * (CARD_H + GAP))
+
+    def testSources(self):
+        self.write('b.md', '# B\n\nbody')
+        self.write('a.txt', 'A')
+        self.write('skip.png', 'not a note')
+        self.assertEqual(list(read_directory(self.directory)), ['A', '# B\n\nbody'])
+        path = self.write('notes.markdown', 'intro\n# One\ntext\n\n## Two\n')
+        self.assertEqual(list(read_markdown(path)), ['intro', 'One\ntext', 'Two'])
+        path = self.write('notes.csv', 'title,text\nt1,first\nt2,"multi\nline"\n')
+        self.assertEqual(list(read_csv(path)), ['first', 'multi\nline'])
+        self.assertEqual(list(read_csv(path, 'title')), ['t1', 't2'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,325 @@
+'''
+Bundles: the objects one commit has that another doesn't, in one file.
+
+A bundle takes the history from a commit the receiving file already has,
+the base, up to a head, as a file that can be mailed or copied to another
+machine and imported there. Only the objects new since the base go in, so
+shipping a day's work on a big board is shipping a day's worth of objects.
+
+The file is written in one pass, so it can go straight down a pipe:
+
+ * header: MAGIC, the hash name (padded with NULs), the raw head key and the
+   raw base key (all NULs for none)
+ * blocks, each a (compressed length, raw length) header and zlib data.
+   The raw data is records: a raw key, a length and the value, uncompressed
+   whatever the source file does. Objects come before the commits that use
+   them, oldest commit first, so importing a bundle cut short leaves the
+   target whole.
+ * an empty block header, ending the blocks
+ * the index: zlib compressed (raw key, block offset, offset in block,
+   length) entries, one per record, sorted by key
+ * footer: the offset of the index, its compressed length, the number of
+   entries and END_MAGIC
+
+Importing only needs to read the blocks in order; the index is for looking
+up single objects without reading the rest.
+'''
+
+import binascii
+import struct
+import unittest
+import zlib
+
+import model
+import transfer
+
+
+class Error(Exception):
+    pass
+
+
+MAGIC = 'GPBNDL1\n'
+END_MAGIC = 'GPBEND1\n'
+header = struct.Struct('>8s8s20s20s')
+block_header = struct.Struct('>II')
+record_header = struct.Struct('>20sI')
+index_entry = struct.Struct('>20sQII')
+footer = struct.Struct('>QIQ8s')
+
+NO_KEY = '\0' * 20
+# how much raw data goes in a block before it's compressed and written
+BLOCK_SIZE = 256 * 1024
+
+
+def raw_key(key):
+    if key is None:
+        return NO_KEY
+    return binascii.unhexlify(key)
+
+def hex_key(raw):
+    if raw == NO_KEY:
+        return None
+    return binascii.hexlify(raw)
+
+
+class BundleWriter(object):
+    '''
+    Writes a bundle to the file object out: add() every record, then
+    close(). out only needs write().
+    '''
+
+    def __init__(self, out, hash_name, head, base=None, block_size=BLOCK_SIZE):
+        self.out = out
+        self.block_size = block_size
+        # [(raw key, block offset, offset in block, length)]
+        self.entries = []
+        self.block = []
+        self.block_length = 0
+        self.offset = 0
+        self.write(header.pack(MAGIC, hash_name, raw_key(head), raw_key(base)))
+
+    def write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+
+    def add(self, key, value):
+        if isinstance(value, unicode):
+            # sqlite hands JSON back as text
+            value = value.encode('utf-8')
+        raw = raw_key(key)
+        self.entries.append((raw, self.offset, self.block_length + record_header.size,
+                             len(value)))
+        self.block.append(record_header.pack(raw, len(value)))
+        self.block.append(value)
+        self.block_length += record_header.size + len(value)
+        if self.block_length >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.block:
+            return
+        data = ''.join(self.block)
+        packed = zlib.compress(data)
+        self.write(block_header.pack(len(packed), len(data)))
+        self.write(packed)
+        self.block = []
+        self.block_length = 0
+
+    def close(self):
+        "Write out the last block, the index and the footer. Doesn't close out."
+        self.flush()
+        self.write(block_header.pack(0, 0))
+        self.entries.sort()
+        index = zlib.compress(''.join(index_entry.pack(*entry) for entry in self.entries))
+        index_offset = self.offset
+        self.write(index)
+        self.write(footer.pack(index_offset, len(index), len(self.entries), END_MAGIC))
+
+
+class Bundle(object):
+    '''
+    Reads the bundle at filename: hash_name, head and base, records() to
+    go through it all in order, get() for single objects.
+    '''
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        magic, hash_name, head, base = header.unpack(self.read(header.size))
+        if magic != MAGIC:
+            raise Error('%s is not a bundle' % filename)
+        self.hash_name = hash_name.rstrip('\0')
+        self.head = hex_key(head)
+        self.base = hex_key(base)
+        self.index = None
+        # (offset, raw data) of the block get() last read
+        self.block = (None, None)
+
+    def read(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise Error('bundle is cut short')
+        return data
+
+    def read_block(self, offset):
+        "Return (raw data, offset of the next block), raw data None at the end"
+        self.file.seek(offset)
+        packed_length, length = block_header.unpack(self.read(block_header.size))
+        if packed_length == 0:
+            return None, None
+        try:
+            data = zlib.decompress(self.read(packed_length))
+        except zlib.error:
+            data = None
+        if data is None or len(data) != length:
+            raise Error('corrupt block at %d' % offset)
+        return data, offset + block_header.size + packed_length
+
+    def records(self):
+        "Generate (key, value) for everything in the bundle, in order"
+        offset = header.size
+        while True:
+            data, offset = self.read_block(offset)
+            if data is None:
+                return
+            pos = 0
+            while pos < len(data):
+                raw, length = record_header.unpack_from(data, pos)
+                pos += record_header.size
+                yield hex_key(raw), data[pos:pos + length]
+                pos += length
+
+    def load_index(self):
+        if self.index is not None:
+            return
+        self.file.seek(-footer.size, 2)
+        index_offset, packed_length, count, magic = footer.unpack(self.read(footer.size))
+        if magic != END_MAGIC:
+            raise Error('bundle is cut short')
+        self.file.seek(index_offset)
+        data = zlib.decompress(self.read(packed_length))
+        self.index = {}
+        for i in xrange(count):
+            raw, block, offset, length = index_entry.unpack_from(data, i * index_entry.size)
+            self.index[hex_key(raw)] = (block, offset, length)
+
+    def keys(self):
+        self.load_index()
+        return self.index.keys()
+
+    def contains(self, key):
+        self.load_index()
+        return key in self.index
+
+    def get(self, key):
+        "The value of key, or None if it isn't in the bundle"
+        self.load_index()
+        if key not in self.index:
+            return None
+        block, offset, length = self.index[key]
+        if self.block[0] != block:
+            self.block = (block, self.read_block(block)[0])
+        return self.block[1][offset:offset + length]
+
+    def close(self):
+        self.file.close()
+
+
+def ancestors(datastore, oid):
+    "The set of commits oid descends from, and oid"
+    seen = set()
+    while oid:
+        seen.add(oid)
+        oid = model.load_commit(datastore, oid)['parent']
+    return seen
+
+def export(datastore, out, head, base=None):
+    '''
+    Write everything reachable from commit head in KVStore datastore that
+    isn't reachable from commit base to file object out. Returns the number
+    of objects written.
+
+    The bundle's base is the newest commit of head's history that base has
+    too, which needn't be base itself, or None if there's none; a file
+    needs that commit to import the bundle.
+    '''
+    known = ancestors(datastore, base)
+    chain, boundary = transfer.history(datastore, head, known.__contains__)
+    writer = BundleWriter(out, datastore.hash_name, head, boundary)
+    count = 0
+    for commit_oid, new in transfer.changes(datastore, chain, boundary):
+        keys = sorted(new) + [commit_oid]
+        values = datastore.get_many(keys)
+        for key in keys:
+            if key not in values:
+                raise model.Error('Failed to find object %s' % key)
+            writer.add(key, values[key])
+        count += len(keys)
+    writer.close()
+    return count
+
+def import_bundle(bundle, datastore, batch_size=1000):
+    '''
+    Store what's in Bundle bundle that KVStore datastore lacks, checking
+    every key against its value. Returns the number of objects stored.
+    '''
+    if bundle.hash_name != datastore.hash_name:
+        raise Error('can\'t import a %s keyed bundle into a %s keyed file' % (
+            bundle.hash_name, datastore.hash_name))
+    if bundle.base is not None and not datastore.contains(bundle.base):
+        raise Error('the bundle needs commit %s, which this file lacks' % bundle.base)
+    stored = 0
+    batch = []
+    for record in bundle.records():
+        batch.append(record)
+        if len(batch) >= batch_size:
+            stored += store(datastore, batch)
+            batch = []
+    stored += store(datastore, batch)
+    return stored
+
+def store(datastore, records):
+    present = datastore.backend.present([key for key, value in records])
+    new = [(key, value) for key, value in records if key not in present]
+    keys = datastore.store_many([(value, None) for key, value in new])
+    for (key, value), stored_key in zip(new, keys):
+        if key != stored_key:
+            raise Error('corrupt bundle: object %s hashes to %s' % (key, stored_key))
+    return len(new)
+
+
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        import kvbackend
+        import kvstore
+        self.store = lambda: kvstore.KVStore(kvbackend.MemoryBackend())
+        self.source = self.store()
+        fd, self.filename = tempfile.mkstemp(suffix='.gpbundle')
+        os.close(fd)
+
+    def tearDown(self):
+        import os
+        os.remove(self.filename)
+
+    def export(self, head, base=None):
+        with open(self.filename, 'wb') as out:
+            count = export(self.source, out, head, base)
+        return count, Bundle(self.filename)
+
+    def testIncremental(self):
+        g = model.Graph(self.source, None)
+        for i in range(100):
+            g.new_card().text = 'card %d' % i
+        g.new_edge(g.cards[0], g.cards[1])
+        first = g.commit()
+        target = self.store()
+        count, bundle = self.export(first)
+        self.assertEqual(bundle.base, None)
+        self.assertEqual(import_bundle(bundle, target), count)
+        self.assertEqual(len(model.Graph(target, first).cards), 100)
+        g.cards[0].text = 'changed'
+        second = g.commit()
+        count, bundle = self.export(second, first)
+        # the card, the edge to it, the commit
+        self.assertEqual(count, 3)
+        self.assertEqual((bundle.head, bundle.base), (second, first))
+        self.assertEqual(bundle.get(second), self.source.get(second))
+        self.assertEqual(import_bundle(bundle, target), 3)
+        self.assertEqual(model.Graph(target, second).cards[0].text, 'changed')
+        self.assertRaises(Error, import_bundle, bundle, self.store())
+
+    def testCorrupt(self):
+        g = model.Graph(self.source, None)
+        g.new_card().text = 'original'
+        head = g.commit()
+        writer = BundleWriter(open(self.filename, 'wb'), self.source.hash_name, head)
+        for key, value in self.source.iterate():
+            writer.add(key, value.replace('original', 'tampered'))
+        writer.close()
+        writer.out.close()
+        self.assertRaises(Error, import_bundle, Bundle(self.filename), self.store())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+'''
+Index of the versions each card has gone through.
+
+Cards are content addressed, so a card gets a new oid every time it
+changes, and nothing in a commit says which old oid a new one replaced.
+CardHistory keeps a table mapping each card's identity (the oid of the
+first version we saw) to the commits where its oid changed, so listing
+the versions of one card doesn't mean walking every commit manifest.
+
+It is kept up to date by listening to model.Graph.commit_slot, and can
+catch up on commits made without it with catch_up().
+'''
+
+import difflib
+
+import model
+import storable
+
+
+class CardHistory(object):
+    '''
+    Card version index living in a table of a sqlite connection.
+
+    Each row says "card <card> became <oid> in commit <commit_oid>". oid is
+    NULL for the commit that deleted the card.
+
+    Two cards with identical contents share an oid, so they can't be told
+    apart here either; whichever version was recorded last wins.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute('''
+            create table if not exists card_history (
+                card text not null,
+                commit_oid text not null,
+                oid text,
+                constraint one_version_per_commit
+                    unique (card, commit_oid) on conflict ignore)''')
+        self.conn.execute('''
+            create index if not exists card_history_oid
+                on card_history (oid)''')
+        self.conn.commit()
+
+    def attach(self, graph):
+        '''
+        Record every future commit of graph. Returns the slot handle.
+        '''
+        return graph.commit_slot.add(self.on_commit)
+
+    def on_commit(self, commit_oid, card_changes, edge_changes):
+        self.record(commit_oid, card_changes)
+
+    def identity(self, oid):
+        '''
+        Return the identity of the card that has (or had) version oid,
+        or None if the version isn't indexed.
+        '''
+        result = self.conn.execute('''
+            select card from card_history where oid = ?
+            order by rowid desc limit 1''', (oid,)).fetchone()
+        if result:
+            return result[0]
+        return None
+
+    def record(self, commit_oid, changes):
+        '''
+        Index the card changes made by one commit.
+
+        changes is a list of (old oid, new oid), as passed to
+        model.Graph.commit_slot.
+        '''
+        rows = []
+        for old_oid, new_oid in changes:
+            if old_oid is None:
+                card = new_oid
+            else:
+                card = self.identity(old_oid) or old_oid
+            rows.append((card, commit_oid, new_oid))
+        self.conn.executemany(
+            'insert into card_history values (?, ?, ?)', rows)
+        self.conn.commit()
+
+    def rewrite_commits(self, absorbed):
+        '''
+        Follow a history rewrite, as yielded by retention.thin().
+
+        absorbed is [(old commit oid, new commit oid)], oldest first. When
+        several old commits collapse into one, the newest version of each
+        card wins.
+        '''
+        for old_oid, new_oid in absorbed:
+            self.conn.execute('''
+                update or replace card_history set commit_oid = ?
+                where commit_oid = ?''', (new_oid, old_oid))
+        self.conn.commit()
+
+    def rewrite_oids(self, oid_map):
+        '''
+        Follow a rewrite that gave every object a new oid, like
+        migrate.recode(). oid_map is {old oid: new oid}.
+        '''
+        self.conn.execute('''
+            create temp table if not exists oid_map (
+                old text primary key, new text not null)''')
+        self.conn.execute('delete from temp.oid_map')
+        self.conn.executemany(
+            'insert into temp.oid_map values (?, ?)', oid_map.iteritems())
+        self.conn.execute('''
+            update card_history set
+                card = coalesce((select new from temp.oid_map
+                    where old = card_history.card), card),
+                commit_oid = coalesce((select new from temp.oid_map
+                    where old = card_history.commit_oid), commit_oid),
+                oid = coalesce((select new from temp.oid_map
+                    where old = card_history.oid), oid)''')
+        self.conn.execute('delete from temp.oid_map')
+        self.conn.commit()
+
+    def forget(self, oids):
+        '''
+        Drop versions whose objects have been garbage collected.
+        '''
+        self.conn.executemany(
+            'delete from card_history where oid = ?',
+            ((oid,) for oid in oids))
+        self.conn.commit()
+
+    def versions(self, oid):
+        '''
+        Return [(commit oid, card oid)] for every version of the card that
+        has version oid, oldest first. The last card oid is None if the
+        card has been deleted.
+        '''
+        card = self.identity(oid)
+        if card is None:
+            return []
+        return list(self.conn.execute('''
+            select commit_oid, oid from card_history where card = ?
+            order by rowid''', (card,)))
+
+    def last_change(self, oid):
+        '''
+        Return the oid of the commit that last changed the card, or None.
+        '''
+        versions = self.versions(oid)
+        if versions:
+            return versions[-1][0]
+        return None
+
+    def last_text_change(self, datastore, oid):
+        '''
+        Return the oid of the commit that last changed the card's text.
+
+        Only decodes versions of this card, newest first.
+        '''
+        versions = [v for v in self.versions(oid) if v[1] is not None]
+        if not versions:
+            return None
+        text = load_card(datastore, versions[-1][1])['text']
+        changed_in = versions[-1][0]
+        for commit_oid, card_oid in reversed(versions[:-1]):
+            if load_card(datastore, card_oid)['text'] != text:
+                break
+            changed_in = commit_oid
+        return changed_in
+
+    def catch_up(self, datastore, head, indexed=None):
+        '''
+        Index the commits from indexed (exclusive) up to head.
+
+        indexed is the last commit that was recorded, or None to index all
+        of history. Card changes are paired up by their position in the
+        commit manifests, which model.Graph.commit keeps stable.
+        '''
+        chain = []
+        oid = head
+        while oid and oid != indexed:
+            chain.append(oid)
+            oid = model.load_commit(datastore, oid)['parent']
+        if indexed and oid != indexed:
+            # indexed isn't an ancestor of head; start over
+            return self.catch_up(datastore, head)
+        if oid:
+            old_cards = model.load_commit(datastore, oid)['cards']
+        else:
+            old_cards = []
+        for commit_oid in reversed(chain):
+            new_cards = model.load_commit(datastore, commit_oid)['cards']
+            self.record(commit_oid, manifest_changes(old_cards, new_cards))
+            old_cards = new_cards
+
+
+def manifest_changes(old_cards, new_cards):
+    '''
+    Guess the card changes between two manifests.
+
+    Returns [(old oid, new oid)] like model.Graph.commit_slot does.
+    '''
+    changes = []
+    matcher = difflib.SequenceMatcher(None, old_cards, new_cards, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        old, new = old_cards[i1:i2], new_cards[j1:j2]
+        # pair up replaced cards in order, the rest are deletions/creations
+        paired = min(len(old), len(new))
+        changes.extend(zip(old[:paired], new[:paired]))
+        changes.extend((o, None) for o in old[paired:])
+        changes.extend((None, n) for n in new[paired:])
+    return changes
+
+
+def load_card(datastore, oid):
+    obj = storable.Storable()
+    try:
+        obj.load(datastore, oid)
+    except storable.Error:
+        raise model.Error('Failed to find card %s' % oid)
+    return obj
@@ -5,10 +5,14 @@ import os
 
 from kvstore import KVStore
 from model import *
+from cardhistory import CardHistory
 
-dat = KVStore(sqlite3.connect(':memory:'), 'objects')
+conn = sqlite3.connect(':memory:')
+dat = KVStore(conn, 'objects')
 
 g = Graph(dat, None)
+history = CardHistory(conn)
+history.attach(g)
 
 c = g.new_card()
 c.obj['text'] = 'card 1'
@@ -17,7 +21,7 @@ c2.obj['text'] = 'number 2'
 c3 = g.new_card()
 c3.obj['text'] = 'numero tres'
 
-g.commit()
+first_commit = g.commit()
 
 # make an edge
 e1 = g.new_edge(c, c2)
@@ -41,3 +45,390 @@ g2 = Graph(dat, last_commit)
 assert set(g.obj['cards']) == set(g2.obj['cards'])
 assert set(g.obj['edges']) == set(g2.obj['edges'])
 
+
+# card history saw c created and deleted, and c3 created
+assert [v[0] for v in history.versions(c.saved_oid)] == [first_commit, last_commit]
+assert history.versions(c.saved_oid)[-1][1] is None
+assert history.last_change(c3.saved_oid) == first_commit
+
+# two processes committing to one file: neither loses the other's work
+import shutil
+import tempfile
+import gpfile
+
+directory = tempfile.mkdtemp()
+try:
+    path = os.path.join(directory, 'shared.gp')
+    a = gpfile.GraphPaperFile(path)
+    a.graph.new_card().text = 'from a'
+    a.commit()
+    b = gpfile.GraphPaperFile(path)
+    # a moves the card and adds another
+    a.graph.cards[0].x = 100
+    a.graph.new_card().text = 'second from a'
+    a.commit()
+    # b, still on the old head, draws an edge from the card to a new one
+    b_card = b.graph.new_card()
+    b_card.text = 'from b'
+    b.graph.new_edge(b.graph.cards[0], b_card)
+    b.commit()
+    assert b.head == a.config['head']
+    assert b.graph.obj['parent'] == a.head
+    texts = sorted(c.text for c in b.graph.cards)
+    assert texts == ['from a', 'from b', 'second from a']
+    moved = [c for c in b.graph.cards if c.text == 'from a'][0]
+    assert moved.x == 100
+    assert len(b.graph.edges) == 1
+    assert b.graph.edges[0].orig is moved and b.graph.edges[0].dest is b_card
+    assert a.refresh()
+    assert sorted(c.text for c in a.graph.cards) == texts
+    assert not a.refresh()
+finally:
+    shutil.rmtree(directory)
+
+# garbage collection leaves alone what another process is about to commit
+import retention
+directory = tempfile.mkdtemp()
+try:
+    path = os.path.join(directory, 'collected.gp')
+    a = gpfile.GraphPaperFile(path)
+    policy = retention.RetentionPolicy(0, 0)
+    policy.save(a.config)
+    a.graph.new_card().text = 'one'
+    for text in ('two', 'three'):
+        a.commit()
+        a.graph.cards[0].text = text
+    a.commit()
+    assert sum(a.thin_history(policy)) == 3
+    b = gpfile.GraphPaperFile(path)
+    a.graph.new_card().text = 'from a'
+    a.commit()
+    # b stores a card just like one only the thinned commits had, and a
+    # thins b's base away and collects garbage before b's commit lands
+    b.graph.cards[0].text = 'two'
+    b.graph.new_card().text = 'from b'
+    def collect(*args):
+        b.graph.commit_slot.remove(handle)
+        assert sum(a.maintain()) > 0
+    handle = b.graph.commit_slot.add(collect)
+    b.commit()
+    assert a.refresh()
+    assert sorted(c.text for c in a.graph.cards) == ['from a', 'from b', 'two']
+    b.close()
+    assert sum(a.maintain()) > 0
+    assert len(gpfile.sessions(a.config)) == 1
+finally:
+    shutil.rmtree(directory)
+
+# thinning goes a step at a time, and what's committed meanwhile ends up on
+# top of the thinned history
+directory = tempfile.mkdtemp()
+try:
+    a = gpfile.GraphPaperFile(os.path.join(directory, 'thinned.gp'))
+    a.graph.new_card().text = 'one'
+    for text in ('two', 'three'):
+        a.commit()
+        a.graph.cards[0].text = text
+    a.commit()
+    steps = a.thin_history(retention.RetentionPolicy(0, 0))
+    assert steps.next() == 0
+    a.graph.cards[0].text = 'four'
+    a.commit()
+    assert sum(steps) == 3
+    assert a.head == a.config['head']
+    texts = []
+    oid = a.head
+    while oid:
+        commit = load_commit(a.graph.datastore, oid)
+        texts.append(load_objects(a.graph.datastore, commit['cards']).next()[1]['text'])
+        oid = commit['parent']
+    assert texts == ['four', 'three']
+    a.graph.cards[0].text = 'five'
+    a.commit()
+finally:
+    shutil.rmtree(directory)
+
+# a snapshot in a read transaction keeps its commit while the file moves on
+import sqlprofile
+directory = tempfile.mkdtemp()
+try:
+    path = os.path.join(directory, 'snapshot.gp')
+    f = gpfile.GraphPaperFile(path)
+    # WAL only once asked for
+    assert sqlprofile.current(f.conn)['journal_mode'] == 'delete'
+    f.set_profile('wal')
+    assert sqlprofile.current(gpfile.GraphPaperFile(path).conn)['journal_mode'] == 'wal'
+    f.graph.new_card().text = 'first'
+    f.commit()
+    first = f.head
+    reader = sqlite3.connect(path, isolation_level=None)
+    reader.execute('begin')
+    snapshot = gpfile.Snapshot(reader)
+    assert snapshot.graph().cards[0].text == 'first'
+    f.graph.cards[0].text = 'second'
+    f.commit()
+    for freed in f.collect_garbage():
+        pass
+    assert snapshot.config['head'] == first
+    assert snapshot.graph().cards[0].text == 'first'
+    reader.execute('rollback')
+    assert gpfile.Snapshot(reader).graph().cards[0].text == 'second'
+    reader.close()
+finally:
+    shutil.rmtree(directory)
+
+# forks share unchanged cards, and copy them on write
+g = Graph(dat, last_commit)
+fork = g.fork()
+assert fork.cards[0].obj is g.cards[0].obj
+fork.cards[0].text = 'only in the fork'
+assert fork.cards[0].obj is not g.cards[0].obj
+assert g.cards[0].text != 'only in the fork'
+assert fork.cards[1].obj is g.cards[1].obj
+fork_commit = fork.commit()
+assert g.commit() != fork_commit
+assert Graph(dat, fork_commit).obj['parent'] == last_commit
+
+# a compact graph saves the same cards, and forks and reloads the same way
+small = Graph(dat, last_commit, compact=True)
+assert [c.text for c in small.cards] == [c.text for c in g.cards]
+small.cards[0].x = 12.5
+small.cards[1].text = 'compact'
+small.new_card().delete()
+small.new_edge(small.cards[0], small.new_card(5, 5, 1, 50))
+big = Graph(dat, last_commit)
+big.cards[0].x = 12.5
+big.cards[1].text = 'compact'
+big.new_card().delete()
+big.new_edge(big.cards[0], big.new_card(5, 5, 1, 50))
+small_fork = small.fork()
+small_commit = small.commit()
+assert small_commit and load_commit(dat, small_commit)['cards'] == \
+    load_commit(dat, big.commit())['cards']
+assert small.cards[-1].w == MIN_CARD_SIZE and not small.has_changes()
+assert small_fork.cards[1].text == 'compact' and small_fork.has_changes()
+small_fork.cards[1].text = 'fork'
+assert small.cards[1].text == 'compact'
+small.reload(last_commit)
+assert small.cards[1].text == g.cards[1].text
+kept = small.cards[0]
+small.reload(small_commit)
+assert small.cards[0].x == 12.5 and small.cards[0] is not kept
+small.reload(small_commit)
+assert small.cards[0].x == 12.5
+# rows of cards that left are reused, and so is what's saved about them
+assert len(small.table) == len(small.cards) + len(small.table.free)
+assert small.cards[1].obj == big.cards[1].obj and small.cards[1].obj.oid == big.cards[1].oid
+rows = len(small.table)
+for i in range(3):
+    small.reload(last_commit)
+    small.reload(small_commit)
+assert len(small.table) == rows
+small.cards[0].obj = big.cards[1].obj
+assert small.cards[0].text == 'compact' and not small.cards[0].dirty
+small.cards[0].obj = Graph(dat, small_commit).cards[0].obj
+assert not small.has_changes()
+table = small.table
+rows = [c.row for c in small.cards]
+table.move(rows, 10, 0)
+assert small.cards[0].x == 22.5 and small.cards[-1].x == 15
+assert table.within(rows, 0, 40, 20, 60) == [small.cards[-1].row]
+assert table.bounds(rows) == (10, 0, 52.5, 55)
+
+# a batch of edits is one commit and one notification, or nothing at all
+for compact in (False, True):
+    g = Graph(dat, small_commit, compact=compact)
+    commits = []
+    edits = []
+    g.commit_slot.add(lambda *args: commits.append(args))
+    g.edit_slot.add(lambda *args: edits.append(args))
+    before = [(c.text, c.x, c.y, c.saved_oid) for c in g.cards]
+    try:
+        with g.batch() as batch:
+            batch.move(g.cards, 5, 5)
+            batch.set_text(g.cards[0], 'lost')
+            batch.new_card(text='lost too')
+            batch.delete([g.cards[1]])
+            raise ValueError
+    except ValueError:
+        pass
+    assert [(c.text, c.x, c.y, c.saved_oid) for c in g.cards] == before
+    assert len(g.edges) == 1 and not g.has_changes() and not commits
+    moved, deleted = g.cards[0], g.cards[1]
+    with g.batch() as batch:
+        batch.move([moved], 5, 5)
+        new = batch.new_card(text='new')
+        deleted.delete()
+    assert len(commits) == 1 and g.obj['parent'] == small_commit
+    assert edits == [(batch.oid, [moved], [new], [deleted], [], [])]
+    assert [c.text for c in Graph(dat, batch.oid).cards] == \
+        [moved.text, g.cards[1].text, 'new']
+    if not compact:
+        # only what changed was copied, and nothing stays shared
+        assert not any(item.obj.shared for item in g.cards + g.edges)
+    # an edit from before the batch outlives a commit that fails
+    pending = g.cards[-1]
+    pending.text = 'pending'
+    x = pending.x
+    def failing_commit():
+        g.commit()
+        raise ValueError
+    try:
+        with g.batch(failing_commit) as failed:
+            failed.move([pending], 1, 1)
+    except ValueError:
+        pass
+    assert pending.dirty and pending.text == 'pending' and pending.x == x
+    assert g.obj.oid == batch.oid
+
+# a file's commits wait for its batch
+directory = tempfile.mkdtemp()
+try:
+    f = gpfile.GraphPaperFile(os.path.join(directory, 'batch.gp'))
+    base = f.head
+    with f.batch():
+        f.graph.new_card().text = 'one'
+        assert f.commit() == base
+        f.graph.new_card().text = 'two'
+        f.commit()
+    assert f.head != base and f.graph.obj['parent'] == base
+    assert f.config['head'] == f.head
+finally:
+    shutil.rmtree(directory)
+
+# branches
+directory = tempfile.mkdtemp()
+try:
+    path = os.path.join(directory, 'branches.gp')
+    f = gpfile.GraphPaperFile(path)
+    f.graph.new_card().text = 'on master'
+    f.commit()
+    f.create_branch('idea')
+    other = gpfile.GraphPaperFile(path)
+    f.checkout('idea')
+    kept = f.graph.cards[0]
+    f.graph.new_card().text = 'on idea'
+    f.commit()
+    # the checkout is f's own; other stays on master
+    assert not other.refresh() and other.branch() == 'master'
+    other.graph.new_card().text = 'on master too'
+    other.commit()
+    assert len(f.graph.cards) == 2 and not f.refresh()
+    assert len(gpfile.GraphPaperFile(path).graph.cards) == 2
+    f.checkout('master')
+    assert [c.text for c in f.graph.cards] == ['on master', 'on master too']
+    assert f.graph.cards[0] is kept
+    assert sorted(f.branches()) == ['idea', 'master']
+    f.checkout('idea')
+    assert len(f.graph.cards) == 2
+    # merging master brings its new card over, with nothing to conflict
+    assert f.merge(f.branches()['master']) == []
+    assert len(f.graph.cards) == 3
+    f.checkout('master')
+    f.delete_branch('idea')
+    assert f.branches().keys() == ['master']
+finally:
+    shutil.rmtree(directory)
+
+# fetching from another file copies only what's new
+directory = tempfile.mkdtemp()
+try:
+    a = gpfile.GraphPaperFile(os.path.join(directory, 'a.gp'))
+    b = gpfile.GraphPaperFile(os.path.join(directory, 'b.gp'))
+    for i in range(10):
+        a.graph.new_card().text = str(i)
+    a.commit()
+    # both start from the same empty commit
+    assert b.fetch(a, name='from_a') == 11
+    a.graph.cards[0].text = 'changed'
+    a.commit()
+    assert b.fetch(a, name='from_a') == 2
+    b.checkout('from_a')
+    assert b.graph.cards[0].text == 'changed'
+    assert b.history.versions(b.graph.cards[0].saved_oid)
+finally:
+    shutil.rmtree(directory)
+
+# a bundle carries only what's new since the commit given
+directory = tempfile.mkdtemp()
+try:
+    a = gpfile.GraphPaperFile(os.path.join(directory, 'a.gp'))
+    b = gpfile.GraphPaperFile(os.path.join(directory, 'b.gp'))
+    bundle_name = os.path.join(directory, 'update.gpbundle')
+    a.graph.new_card().text = 'first'
+    a.commit()
+    out = open(bundle_name, 'wb')
+    a.export_bundle(out)
+    out.close()
+    b.import_bundle(bundle_name, 'master')
+    assert b.graph.cards[0].text == 'first'
+    since = a.head
+    a.graph.new_card().text = 'second'
+    a.commit()
+    out = open(bundle_name, 'wb')
+    assert a.export_bundle(out, base=since) == 2
+    out.close()
+    assert b.import_bundle(bundle_name, 'master') == 2
+    assert [c.text for c in b.graph.cards] == ['first', 'second']
+finally:
+    shutil.rmtree(directory)
+
+# gptool round trips a board through JSON Lines, and verifies files
+import gptool
+import StringIO
+import sys
+directory = tempfile.mkdtemp()
+stdout = sys.stdout
+try:
+    a = os.path.join(directory, 'a.gp')
+    b = os.path.join(directory, 'b.gp')
+    exported = os.path.join(directory, 'a.jsonl')
+    f = gpfile.GraphPaperFile(a)
+    f.graph.new_edge(f.graph.new_card(), f.graph.new_card()).orig.text = 'from'
+    f.commit()
+    g = gpfile.GraphPaperFile(b)
+    sys.stdout = StringIO.StringIO()
+    assert gptool.main(['export', a, exported]) == 0
+    assert gptool.main(['import', b, exported]) == 0
+    assert gptool.main(['verify', b]) == 0
+    assert gptool.main(['verify', os.path.join(directory, 'missing.gp')]) == 1
+    g.refresh()
+    assert [e.orig.text for e in g.graph.edges] == ['from']
+    # layout works on a compact graph
+    import layout
+    if layout.numpy is not None:
+        assert gptool.main(['layout', b]) == 0
+        assert g.refresh()
+        assert g.graph.cards[0].x != g.graph.cards[1].x or g.graph.cards[0].y != g.graph.cards[1].y
+    # a deleted branch's commits can be found, and brought back
+    f.create_branch('idea')
+    f.checkout('idea')
+    f.graph.new_card().text = 'lost'
+    lost = f.commit()
+    f.checkout('master')
+    f.delete_branch('idea')
+    sys.stdout = StringIO.StringIO()
+    assert gptool.main(['history', a, '--lost']) == 0
+    assert sys.stdout.getvalue().split()[0] == lost
+    assert gptool.main(['branch', a, '--create', 'found', '--at', lost]) == 0
+    assert gpfile.GraphPaperFile(a).branches()['found'] == lost
+    sys.stdout = StringIO.StringIO()
+    assert gptool.main(['history', a, '--lost']) == 0
+    assert sys.stdout.getvalue() == ''
+    # the commands that only read work on files this version never wrote,
+    # and leave them as they were
+    old = os.path.join(directory, 'instructions.gp')
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instructions.gp'), old)
+    contents = open(old, 'rb').read()
+    for command in (['stats', old], ['history', old], ['diff', old], ['verify', old],
+                    ['export', old, exported]):
+        assert gptool.main(command) == 0, command
+    assert open(old, 'rb').read() == contents
+    assert gptool.main(['search', old, 'welcome']) == 0
+    assert 'Welcome' in sys.stdout.getvalue()
+    # its history is from before commits had times, and thinning keeps it
+    assert gptool.main(['thin', old, '--keep-all-hours', '0', '--hourly-days', '0']) == 0
+    assert 'dropped 0 commits' in sys.stdout.getvalue()
+finally:
+    sys.stdout = stdout
+    shutil.rmtree(directory)
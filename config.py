@@ -3,16 +3,18 @@ class ConfigDict(object):
     '''
     Given a sqlite connection, use it as a config database.
 
-    Creates a new table if one is not present.
+    Creates a new table if one is not present, unless create is False (for
+    read-only connections).
     '''
 
-    def __init__(self, connection):
+    def __init__(self, connection, create=True):
         self.conn = connection
-        self.conn.execute('''
-            create table if not exists config (
-                key text primary key constraint unique_key unique on conflict replace not null,
-                value text not null)''')
-        self.conn.commit()
+        if create:
+            self.conn.execute('''
+                create table if not exists config (
+                    key text primary key constraint unique_key unique on conflict replace not null,
+                    value text not null)''')
+            self.conn.commit()
 
     def __getitem__(self, key):
         result = self.conn.execute("select value from config where key = ?", (key,)).fetchone()
@@ -26,5 +28,34 @@ class ConfigDict(object):
         self.conn.execute("insert into config values (?, ?)", (key, value))
         self.conn.commit()
 
+    def __delitem__(self, key):
+        self.conn.execute("delete from config where key = ?", (key,))
+        self.conn.commit()
+
+    def items(self, prefix=''):
+        "[(key, value)] for the keys starting with prefix"
+        # not like, so % and _ in prefix aren't wildcards
+        return list(self.conn.execute(
+            "select key, value from config where substr(key, 1, ?) = ? order by key",
+            (len(prefix), prefix)))
+
+    def compare_and_set(self, key, expected, value):
+        '''
+        Set key to value only if its value is still expected (None meaning
+        unset). Atomic, even against other processes with the file open.
+        Returns whether it was set.
+        '''
+        if expected is None:
+            cur = self.conn.execute('''
+                insert into config select ?, ?
+                where not exists (select 1 from config where key = ?)''',
+                (key, value, key))
+        else:
+            cur = self.conn.execute(
+                "update config set value = ? where key = ? and value = ?",
+                (value, key, expected))
+        self.conn.commit()
+        return cur.rowcount == 1
+
     def get(self, key, default=None):
         return self[key] or default
@@ -0,0 +1,170 @@
+'''
+Checking a whole file: every object, and every branch's history.
+
+check() reads every stored object once, in storage order, and has a pool
+of worker processes decompress, rehash and decode them a batch at a time,
+so it goes about as fast as the file can be read. What comes back is the
+type of each object and the ends of each edge, which is all it takes to
+then walk back from each branch head checking every commit on the way:
+
+ * each object's contents hash to its key
+ * each commit's parent, cards and edges are there, and of the right type
+ * each edge's ends are cards on the same commit's board
+
+Everything wrong is reported, not just the first thing. Commits no branch
+leads to are garbage, and aren't checked: an interrupted garbage
+collection leaves them half deleted.
+'''
+
+import collections
+import itertools
+import multiprocessing
+import unittest
+
+import kvbackend
+import kvstore
+import model
+
+BATCH_SIZE = 1000
+
+# the KVStore a worker process decompresses and hashes with
+worker_store = None
+
+
+def init_worker(hash_name):
+    "Set up a worker process: hash_name is the file's hash"
+    global worker_store
+    worker_store = kvstore.KVStore(kvbackend.MemoryBackend(), hash_name=hash_name)
+
+def check_batch(rows):
+    '''
+    Rehash and decode rows, [(key, value as stored)]. Runs in the worker
+    processes. Returns ([(key, objtype, refs)] of the objects that are
+    fine, [(key, problem)] of those that aren't).
+    '''
+    found = []
+    problems = []
+    for key, value in rows:
+        if isinstance(value, unicode):
+            # sqlite hands JSON back as text
+            value = value.encode('utf-8')
+        try:
+            value = worker_store.decompress(value)
+        except ValueError as e:
+            problems.append((key, str(e)))
+            continue
+        if worker_store.hash(value) != key:
+            problems.append((key, 'contents don\'t match the key'))
+            continue
+        objtype, size, refs = worker_store.describe(value)
+        found.append((key, objtype, refs))
+    return found, problems
+
+def rehash(datastore, processes=None, batch_size=BATCH_SIZE):
+    '''
+    Generate check_batch() of every batch of objects in KVStore datastore.
+    processes is the size of the worker pool, the number of CPUs by
+    default; 1 does it all in this process.
+    '''
+    rows = datastore.backend.iterate(batch_size)
+    batches = iter(lambda: list(itertools.islice(rows, batch_size)), [])
+    if processes == 1:
+        init_worker(datastore.hash_name)
+        for batch in batches:
+            yield check_batch(batch)
+        return
+    # batches are read here, not in the pool's feeder thread: sqlite
+    # connections only work in the thread they were made in
+    pool = multiprocessing.Pool(processes, init_worker, (datastore.hash_name,))
+    window = 2 * (processes or multiprocessing.cpu_count())
+    pending = collections.deque()
+    try:
+        for batch in batches:
+            pending.append(pool.apply_async(check_batch, (batch,)))
+            if len(pending) > window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+def check(datastore, heads, processes=None, batch_size=BATCH_SIZE):
+    '''
+    Generate a line about each problem with KVStore datastore and the
+    history of the commits in heads, {branch name: commit oid}.
+    '''
+    # {oid: objtype} of every sound object, and {oid: (orig, dest)} of edges
+    kinds = {}
+    ends = {}
+    corrupt = set()
+    for found, problems in rehash(datastore, processes, batch_size):
+        for key, objtype, refs in found:
+            kinds[key] = objtype
+            if objtype == model.EDGE_OBJTYPE:
+                ends[key] = tuple((refs or '').split())
+        for key, problem in problems:
+            corrupt.add(key)
+            yield 'object %s: %s' % (key, problem)
+    def wrong(oid, objtype):
+        if oid in corrupt:
+            return '%s %s is corrupt' % (objtype, oid)
+        if oid not in kinds:
+            return '%s %s is missing' % (objtype, oid)
+        return '%s %s is a %s' % (objtype, oid, kinds[oid] or 'non-object')
+    checked = set()
+    for name, head in sorted(heads.iteritems()):
+        oid = head
+        while oid and oid not in checked:
+            if kinds.get(oid) != model.COMMIT_OBJTYPE:
+                yield 'branch %s: %s' % (name, wrong(oid, model.COMMIT_OBJTYPE))
+                break
+            checked.add(oid)
+            commit = model.load_commit(datastore, oid)
+            for problem in check_commit(commit, kinds, ends, wrong):
+                yield 'commit %s: %s' % (oid, problem)
+            oid = commit['parent']
+
+def check_commit(commit, kinds, ends, wrong):
+    "Generate the problems with the board of a commit"
+    cards = set(commit['cards'])
+    for oid in sorted(cards):
+        if kinds.get(oid) != model.CARD_OBJTYPE:
+            yield wrong(oid, model.CARD_OBJTYPE)
+    for oid in commit.get('edges', []):
+        if kinds.get(oid) != model.EDGE_OBJTYPE:
+            yield wrong(oid, model.EDGE_OBJTYPE)
+        elif len(ends[oid]) != 2 or not cards.issuperset(ends[oid]):
+            yield 'edge %s: an end isn\'t on the board' % oid
+
+
+class TestFsck(unittest.TestCase):
+
+    def testProblems(self):
+        store = kvstore.KVStore(kvbackend.MemoryBackend(), compression='zlib')
+        g = model.Graph(store, None)
+        a, b, c = g.new_card(), g.new_card(), g.new_card()
+        a.text, b.text, c.text = 'a' * 100, 'b', 'c'
+        g.new_edge(a, b)
+        first = g.commit()
+        self.assertEqual(list(check(store, {'main': first}, processes=2, batch_size=2)), [])
+        c.delete()
+        second = g.commit()
+        # a corrupted, b lost, and a commit with an edge to a card it lacks
+        store.backend.replace_many([(a.saved_oid, store.compress('a' * 99))])
+        store.delete_many([b.saved_oid])
+        edge = store.store('{"dest":"%s","objtype":"edge","orig":"%s"}' % (
+            c.saved_oid, b.saved_oid))
+        broken = model.save_commit(store, [a.saved_oid, b.saved_oid], [edge], None)
+        problems = list(check(store, {'main': second, 'broken': broken}, processes=1))
+        expected = ['object %s: contents don\'t match the key' % a.saved_oid,
+                    'commit %s: edge %s: an end isn\'t on the board' % (broken, edge)]
+        for commit in (broken, second, first):
+            expected.append('commit %s: card %s is corrupt' % (commit, a.saved_oid))
+            expected.append('commit %s: card %s is missing' % (commit, b.saved_oid))
+        self.assertEqual(sorted(problems), sorted(expected))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,24 @@
 from config import ConfigDict
-import sqlite3
+import binascii
+import contextlib
+import os
+import threading
+import time
 
 import model
 import model_v1
+import kvbackend
 import kvstore
+import objcodec
+import cardhistory
+import retention
+import merge
+import migrate
+import sqlprofile
+import readpool
+import transfer
+import bundle
+import search
 
 
 class Error(Exception):
@@ -15,34 +30,76 @@ class CorruptionError(Error):
     '''
     pass
 
+class ConflictError(Error):
+    '''
+    For when another process changed the file under us
+    '''
+    pass
+
 # The name for version two objects to live in
 # in case we need different tablenames for different formats.
 V2_TABLENAME = 'objects_v2'
 
+# config['head'] is the commit of DEFAULT_BRANCH, other branches are kept
+# under REF_PREFIX + name. Which one is checked out is up to each
+# GraphPaperFile; checking one out doesn't move other processes.
+DEFAULT_BRANCH = 'master'
+REF_PREFIX = 'ref:'
+
+# every open file keeps a Session under SESSION_PREFIX + a random id, so
+# garbage collection in other processes leaves alone what it may still
+# commit. One not heard from in SESSION_TIMEOUT seconds has died.
+SESSION_PREFIX = 'session:'
+SESSION_TIMEOUT = retention.DAY
+
 class GraphPaperFile(object):
     '''
     A loaded file. Coordinates migration, presents a model.Graph to the world.
     '''
 
-    def __init__(self, filename):
+    def __init__(self, filename, compact=False):
+        '''
+        Open the file at filename, making it if need be. With compact, the
+        graph keeps its cards in a model.CardTable, which takes a fraction
+        of the memory on a big board.
+        '''
         # must have self.graph valid at end of constructor
+        self.filename = filename
+        self.compact = compact
+        # the checked out branch, and the commit self.graph was loaded from
+        # or last committed; another process may have moved the branch on
+        self.branch_name = DEFAULT_BRANCH
+        self.head = None
+        # merge.Conflicts from rebasing our commits on other processes'
+        self.conflicts = []
+        # readpool.ReadPool, made on first use
+        self.readers = None
+        # search.SearchIndex, made on first use
+        self.text_index = None
         # sqlite open file
-        self.conn = sqlite3.connect(filename)
+        self.conn = sqlprofile.connect(filename)
         fresh_file = not table_exists(self.conn, 'config') # before making ConfigDict
         self.config = ConfigDict(self.conn)
-        datastore = kvstore.KVStore(self.conn, V2_TABLENAME)
+        self.apply_profile()
+        self.unshare_checkout()
+        datastore = self.make_datastore()
+        self.session = Session(self.config, datastore)
+        self.session.save(self.config['head'])
+        self.history = cardhistory.CardHistory(self.conn)
         # check for config format version
         version = self.config['version']
         if fresh_file:
             print 'fresh file'
-            self.graph = model.Graph(datastore, None)
+            self.graph = model.Graph(datastore, None, self.compact)
+            self.history.attach(self.graph)
             self.load_default_config()
             self.commit()
         else:
             if self.config['version'] is None:
                 # if no conf, migrate by creating empty graph, creating cards
                 # and loading it from a v1 DataStore
-                self.graph = model.Graph(datastore, None)
+                self.graph = model.Graph(datastore, None, self.compact)
+                self.history.attach(self.graph)
                 self.import_v1()
             # else, load commit
             elif version == '2':
@@ -50,11 +107,87 @@ class GraphPaperFile(object):
                 if head_ptr is None:
                     raise CorruptionError('No head pointer!')
                 try:
-                    self.graph = model.Graph(datastore, head_ptr)
+                    self.graph = model.Graph(datastore, head_ptr, self.compact)
+                    self.head = head_ptr
                     # after this, should be all loaded
+                    self.update_history()
                 except model.Error as e:
                     print 'failed to open gp file:', e
                     raise ValueError
+                self.history.attach(self.graph)
+        self.graph.commit_slot.add(self.index_commit)
+        self.session.save(self.head)
+
+    def make_datastore(self):
+        "A kvstore.KVStore for this file's objects, with its settings"
+        return make_datastore(self.conn, self.config)
+
+    def close(self):
+        "Close the file. Uncommitted changes are lost."
+        self.session.close()
+        if self.readers is not None:
+            self.readers.close()
+        self.conn.close()
+
+    def read_pool(self):
+        "The readpool.ReadPool for background work on this file, made on first use"
+        if self.readers is None:
+            self.readers = readpool.ReadPool(self.filename)
+        return self.readers
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        '''
+        Context manager giving a Snapshot of the file's latest commit on a
+        connection from the read pool, for reading from another thread.
+        '''
+        with self.read_pool().transaction() as conn:
+            yield Snapshot(conn)
+
+    def unshare_checkout(self):
+        '''
+        Files used to keep the checked out branch in config['branch'], and
+        its commit in config['head']. Put master back there.
+        '''
+        name = self.config['branch']
+        if name is None:
+            return
+        if name != DEFAULT_BRANCH:
+            master = self.config[REF_PREFIX + DEFAULT_BRANCH]
+            self.config[REF_PREFIX + name] = self.config['head']
+            if master is not None:
+                self.config['head'] = master
+                del self.config[REF_PREFIX + DEFAULT_BRANCH]
+        del self.config['branch']
+
+    def head_key(self):
+        "The config key of the checked out branch"
+        return branch_key(self.branch_name)
+
+    def set_head(self, head):
+        "Record that the graph is at commit head now"
+        self.head = head
+        self.config['card_history_head'] = head
+        self.session.save(head)
+
+    def apply_profile(self):
+        "Set up the connection per the file's storage profile"
+        name = self.config.get('storage_profile', sqlprofile.DEFAULT_PROFILE)
+        try:
+            sqlprofile.apply(self.conn, name)
+        except ValueError as e:
+            # written by a newer version, presumably; defaults will do
+            print e
+            sqlprofile.apply(self.conn, sqlprofile.DEFAULT_PROFILE)
+
+    def set_profile(self, name):
+        '''
+        Switch to the storage profile called name (from
+        sqlprofile.PROFILES), now and whenever the file is opened.
+        '''
+        sqlprofile.get_profile(name)
+        self.config['storage_profile'] = name
+        self.apply_profile()
 
     def load_default_config(self):
         "Default configuration for new files, including version number"
@@ -83,9 +216,500 @@ class GraphPaperFile(object):
         self.config['version'] = '2'
         self.conn.execute('drop table cards')
 
+    def update_history(self):
+        '''
+        Bring the card history index up to date with head, in case this
+        file was last written without it.
+        '''
+        head = self.config['head']
+        indexed = self.config['card_history_head']
+        if head != indexed:
+            self.history.catch_up(self.graph.datastore, head, indexed)
+            self.config['card_history_head'] = head
+
+    def retention_policy(self):
+        "The retention.RetentionPolicy saved in this file, or None"
+        return retention.RetentionPolicy.from_config(self.config)
+
+    def thin_history(self, policy):
+        '''
+        Generator that drops the commits policy doesn't keep, a batch at a
+        time, yielding the number dropped by each step. Commits made on
+        the branch meanwhile, here or elsewhere, are moved on top of the
+        thinned history at the end.
+
+        Run collect_garbage() afterwards to actually free them.
+        '''
+        datastore = self.graph.datastore
+        old_head = self.head
+        absorbed = []
+        for batch in retention.thin(datastore, old_head, policy):
+            absorbed.extend(batch)
+            yield 0
+        if not absorbed:
+            return
+        while True:
+            current = self.config[self.head_key()]
+            grafted = retention.graft(datastore, current, old_head, absorbed[-1][1])
+            if grafted is None:
+                # the branch was rewound or thinned elsewhere meanwhile;
+                # try again some other time
+                return
+            head, moved = grafted
+            if self.config.compare_and_set(self.head_key(), current, head):
+                break
+        absorbed.extend(moved)
+        self.history.rewrite_commits(absorbed)
+        # self.head is old_head or one of the moved commits; same cards and
+        # edges, new parent
+        head = dict(absorbed)[self.head]
+        self.set_head(head)
+        self.graph.obj.load(datastore, head)
+        yield len(absorbed) - len(set(new for old, new in absorbed))
+
+    def collect_garbage(self):
+        '''
+        Generator that frees unreachable objects a batch at a time,
+        yielding the number freed by each batch. Whatever other sessions
+        have stored since they last saved is left alone, and so is
+        everything reachable from their heads.
+        '''
+        datastore = self.graph.datastore
+        self.session.save(self.head)
+        generation = min([datastore.generation()] +
+                         [g for head, g in sessions(self.config)])
+        roots = lambda: [self.config['head'], self.head] + self.branches().values() + \
+            [head for head, g in sessions(self.config)]
+        marked = set()
+        if sqlprofile.current(self.conn)['journal_mode'] == 'wal':
+            # readers don't hold up commits; walk the branches' history
+            # on a snapshot without holding up the editor either
+            for step in self.mark_in_background(marked):
+                yield 0
+        garbage_batches = retention.collect_garbage(datastore, roots,
+                                                    generation=generation,
+                                                    marked=marked)
+        for garbage in garbage_batches:
+            self.history.forget(garbage)
+            yield len(garbage)
+
+    def mark_in_background(self, marked):
+        '''
+        Generator that adds everything the file's branches reach to the set
+        marked (see retention.mark_reachable()), reading a snapshot in
+        another thread. Yields while that runs.
+        '''
+        failed = []
+        def mark():
+            try:
+                with self.snapshot() as snapshot:
+                    for head in branches(snapshot.config).values():
+                        retention.mark_reachable(snapshot.datastore, head, marked)
+            except Exception as e:
+                failed.append(e)
+        thread = threading.Thread(target=mark)
+        thread.daemon = True
+        thread.start()
+        while thread.is_alive():
+            yield
+            thread.join(0.01)
+        if failed:
+            raise failed[0]
+
+    def maintain(self):
+        '''
+        Generator that fills in the types of objects stored without them,
+        then applies the saved retention policy, if any, and collects
+        garbage, doing a little work per step.
+        '''
+        # let other processes know we're still here
+        self.session.save(self.head)
+        for done in self.graph.datastore.backfill_types():
+            yield 0
+        policy = self.retention_policy()
+        if policy is None:
+            return
+        for dropped in self.thin_history(policy):
+            yield 0
+        for freed in self.collect_garbage():
+            yield freed
+
+    def migrate(self, codec=None, hash_name=None, key_format=None,
+                compression=None):
+        '''
+        Change how objects are stored: their codec (a name from
+        objcodec.CODECS), the hash their keys are made with (a name from
+        kvstore.HASHES), the key format (from kvstore.KEY_FORMATS) or
+        compression (from kvstore.COMPRESSIONS). None leaves a setting
+        alone.
+
+        Changing the codec or hash changes every oid, so all of history is
+        rewritten and the old objects freed. Returns the number of objects
+        rewritten.
+        '''
+        # check the names before touching anything
+        if codec is not None:
+            objcodec.get_codec(codec)
+        if hash_name is not None:
+            kvstore.get_hash(hash_name)
+        if compression is not None:
+            self.graph.datastore.check_compression(compression)
+        # save any pending changes first, they'd be lost on reload
+        self.commit()
+        old_store = self.graph.datastore
+        if key_format is not None:
+            old_store.backend.convert_keys(key_format)
+            self.config['key_format'] = key_format
+        if codec is not None:
+            self.config['codec'] = codec
+        if hash_name is not None:
+            self.config['hash'] = hash_name
+        if (codec is None or objcodec.get_codec(codec) is old_store.codec) and (
+                hash_name is None or hash_name == old_store.hash_name):
+            # same oids; only keys or compression change, in place
+            if compression is not None:
+                old_store.recompress(compression)
+                self.config['compression'] = compression
+            return 0
+        if compression is not None:
+            self.config['compression'] = compression
+        new_store = self.make_datastore()
+        head, oid_map = migrate.recode(old_store, new_store, self.head)
+        refs = [(branch_key(name), oid) for name, oid in self.branches().iteritems()
+                if name != self.branch_name]
+        for key, oid in refs:
+            migrate.recode(old_store, new_store, oid, oid_map)
+        self.history.rewrite_oids(oid_map)
+        if not self.config.compare_and_set(self.head_key(), self.head, head):
+            raise ConflictError('another process committed during the migration')
+        for key, oid in refs:
+            self.config[key] = oid_map[oid]
+        self.session.datastore = new_store
+        self.set_head(head)
+        self.graph = model.Graph(new_store, head, self.compact)
+        self.history.attach(self.graph)
+        self.graph.commit_slot.add(self.index_commit)
+        # every oid changed; the next search rebuilds the index
+        del self.config[search.HEAD_KEY]
+        for freed in self.collect_garbage():
+            pass
+        return len(oid_map)
+
     def commit(self):
-        self.config['head'] = self.graph.commit()
+        '''
+        Commit the graph and make it the head. If another process moved
+        the head on since we last did, our changes are rebased onto theirs
+        (see rebase()) and the graph reloaded with the result. Returns the
+        new head. While a batch() is open this does nothing; the batch
+        commits when it's done.
+        '''
+        if self.graph.open_batch is not None:
+            return self.head
+        base = self.head
+        head = self.graph.commit()
+        # self.history recorded the commit through graph.commit_slot
+        rebased = False
+        while not self.config.compare_and_set(self.head_key(), base, head):
+            theirs = self.config[self.head_key()]
+            if theirs is None:
+                raise ConflictError('another process deleted branch "%s"' % self.branch_name)
+            head = self.rebase(base, head, theirs)
+            base = theirs
+            rebased = True
+        self.set_head(head)
+        if rebased:
+            self.graph.reload(head)
+        return head
+
+    def batch(self):
+        '''
+        A model.Batch of edits to the graph, committed through commit() in
+        one go however many times commit() is called meanwhile.
+        '''
+        return self.graph.batch(self.commit)
+
+    def branch(self):
+        "Name of the checked out branch"
+        return self.branch_name
+
+    def branches(self):
+        "{name: commit oid} of every branch"
+        return branches(self.config)
+
+    def create_branch(self, name, oid=None):
+        '''
+        Start a branch called name at commit oid, or the head.
+        '''
+        if not name or name == DEFAULT_BRANCH or not self.config.compare_and_set(
+                REF_PREFIX + name, None, oid or self.head):
+            raise Error('branch "%s" already exists' % name)
+
+    def delete_branch(self, name):
+        '''
+        Delete branch name. Its commits are freed by the next garbage
+        collection, unless other branches have them too. The default
+        branch can't be deleted.
+        '''
+        if name == self.branch():
+            raise Error('can\'t delete the checked out branch')
+        if name == DEFAULT_BRANCH:
+            raise Error('can\'t delete the default branch')
+        if self.config[REF_PREFIX + name] is None:
+            raise Error('no branch "%s"' % name)
+        del self.config[REF_PREFIX + name]
+
+    def checkout(self, name):
+        '''
+        Switch to branch name: its commit becomes the head, and the graph
+        is reloaded with it, keeping the Card and Edge objects the two
+        branches share. Pending changes are committed to the current branch
+        first. Only this GraphPaperFile switches; the file opens on the
+        default branch.
+        '''
+        if name == self.branch_name:
+            return
+        target = self.config[branch_key(name)]
+        if target is None:
+            raise Error('no branch "%s"' % name)
+        if self.graph.has_changes():
+            self.commit()
+        self.branch_name = name
+        self.set_head(target)
+        self.graph.reload(target)
+
+    def fetch(self, other, branch=None, name=None):
+        '''
+        Copy branch of GraphPaperFile other (its checked out one by
+        default) into this file, as branch name (the same name by default).
+        Only objects this file lacks are copied, without decoding them.
+
+        An existing branch is only moved forward, never rewound or
+        diverged; fetch under another name and merge() instead. Returns the
+        number of objects copied.
+        '''
+        branch = branch or other.branch()
+        name = name or branch
+        oid = other.branches().get(branch)
+        if oid is None:
+            raise Error('no branch "%s" to fetch' % branch)
+        datastore = self.graph.datastore
+        copied, boundary = transfer.transfer(other.graph.datastore, datastore, oid)
+        self.history.catch_up(datastore, oid, boundary)
+        self.fast_forward(name, oid)
+        return copied
+
+    def export_bundle(self, out, branch=None, base=None):
+        '''
+        Write a bundle (see bundle.py) of branch, the checked out one by
+        default, to file object out: everything new since commit or branch
+        base, or the whole history. Returns the number of objects written.
+        '''
+        branches = self.branches()
+        branch = branch or self.branch()
+        if branch not in branches:
+            raise Error('no branch "%s"' % branch)
+        base = branches.get(base, base)
+        return bundle.export(self.graph.datastore, out, branches[branch], base)
+
+    def import_bundle(self, filename, name):
+        '''
+        Import the bundle at filename as branch name, moving it forward if
+        it exists. Returns the number of objects that were new.
+        '''
+        b = bundle.Bundle(filename)
+        try:
+            datastore = self.graph.datastore
+            stored = bundle.import_bundle(b, datastore)
+            self.history.catch_up(datastore, b.head, b.base)
+            self.fast_forward(name, b.head)
+        finally:
+            b.close()
+        return stored
+
+    def fast_forward(self, name, oid):
+        '''
+        Move branch name on to commit oid, or create it there. Raises Error
+        if oid doesn't descend from where it is.
+        '''
+        datastore = self.graph.datastore
+        current = self.branches().get(name)
+        if current is None:
+            self.create_branch(name, oid)
+        elif current != oid:
+            if merge.common_ancestor(datastore, current, oid) != current:
+                raise Error('branch "%s" has diverged from %s' % (name, oid))
+            if name != self.branch():
+                if not self.config.compare_and_set(branch_key(name), current, oid):
+                    raise ConflictError('another process moved branch "%s"' % name)
+            elif self.config.compare_and_set(self.head_key(), self.head, oid):
+                self.set_head(oid)
+                self.graph.reload(oid)
+            else:
+                raise ConflictError('another process committed meanwhile')
+
+    def search_index(self):
+        "The search.SearchIndex of this file, made on first use"
+        if self.text_index is None:
+            self.text_index = search.SearchIndex(self.conn)
+        return self.text_index
+
+    def index_commit(self, commit_oid, card_changes, edge_changes):
+        "Keep the search index, once there is one, up with our commits"
+        if self.text_index is not None or self.config[search.HEAD_KEY] is not None:
+            self.search_index().record(self.graph.datastore, commit_oid,
+                                       card_changes, self.head)
+
+    def search(self, query, limit=20):
+        '''
+        Return [(card oid, snippet)] for the cards on the board matching
+        query, best first (see search.py). Uncommitted changes aren't
+        searched. The index is built on first use, and caught up with
+        commits from elsewhere as needed.
+        '''
+        index = self.search_index()
+        index.update(self.graph.datastore, self.head)
+        return index.search(query, limit)
+
+    def refresh(self):
+        '''
+        Catch up with commits made by other processes. Returns whether
+        there were any. Uncommitted changes to the graph are lost.
+        '''
+        head = self.config[self.head_key()]
+        if head is None or head == self.head:
+            return False
+        self.graph.reload(head)
+        self.set_head(head)
+        return True
+
+    def rebase(self, base, ours, theirs):
+        '''
+        Make a commit on top of theirs with the changes from base to ours,
+        by a three-way merge (see merge.py). base is the parent of ours, and
+        an ancestor of theirs. Returns the new commit's oid; conflicts go
+        in self.conflicts.
+        '''
+        result = merge.merge(self.graph.datastore, base, ours, theirs,
+                             self.history.identity)
+        head = result.commit(self.graph.datastore, theirs, int(time.time()))
+        self.history.record(head, result.changes_from_theirs)
+        self.conflicts.extend(result.conflicts)
+        return head
+
+    def merge(self, other):
+        '''
+        Merge commit other into the graph and commit the result. Pending
+        changes are committed first. Returns the list of merge.Conflicts,
+        where our version of a field or card was kept.
+        '''
+        if self.graph.has_changes():
+            self.commit()
+        datastore = self.graph.datastore
+        base = merge.common_ancestor(datastore, self.head, other)
+        if base == other:
+            return [] # already merged
+        if base == self.head:
+            # nothing of ours to merge; just move on to other
+            head = other
+            conflicts = []
+        else:
+            result = merge.merge(datastore, base, self.head, other, self.history.identity)
+            head = result.commit(datastore, self.head, int(time.time()))
+            self.history.record(head, result.changes_from_ours)
+            conflicts = result.conflicts
+        if not self.config.compare_and_set(self.head_key(), self.head, head):
+            raise ConflictError('another process committed during the merge')
+        self.set_head(head)
+        self.graph.reload(head)
+        return conflicts
+
+
+
+
+def branches(config):
+    "{name: commit oid} of every branch in a file's config"
+    refs = dict((key[len(REF_PREFIX):], oid)
+                for key, oid in config.items(REF_PREFIX))
+    refs[DEFAULT_BRANCH] = config['head']
+    return refs
+
+def branch_key(name):
+    "The config key branch name's commit is kept under"
+    if name == DEFAULT_BRANCH:
+        return 'head'
+    return REF_PREFIX + name
+
+def sessions(config, now=None):
+    '''
+    [(head, generation)] of the live Sessions on a file's config, deleting
+    those that have died.
+    '''
+    if now is None:
+        now = time.time()
+    live = []
+    for key, value in config.items(SESSION_PREFIX):
+        seen, head, generation = value.split()
+        if now - float(seen) > SESSION_TIMEOUT:
+            del config[key]
+        else:
+            live.append((None if head == '-' else head, int(generation)))
+    return live
+
+class Session(object):
+    '''
+    What one process has open of a file: the commit it's working from, and
+    the datastore generation (see kvbackend) as of then. Anything it goes
+    on to commit is either reachable from there, or stored after that
+    generation, and garbage collection elsewhere has to leave both alone.
+    '''
+
+    def __init__(self, config, datastore):
+        self.config = config
+        self.datastore = datastore
+        self.key = SESSION_PREFIX + binascii.hexlify(os.urandom(8))
+
+    def save(self, head):
+        "Work from commit head, and whatever is stored from now on"
+        generation = self.datastore.generation()
+        self.config[self.key] = '%d %s %d' % (time.time(), head or '-', generation)
+        # no collection goes past our own generation while we're open, so
+        # what's stored after it never needs freshening
+        self.datastore.safe_generation = generation
+
+    def close(self):
+        del self.config[self.key]
+
+def make_datastore(conn, config, create=True):
+    '''
+    A kvstore.KVStore for the objects of the file open on conn, with the
+    settings in its ConfigDict config. create=False for read-only conns.
+    '''
+    backend = kvbackend.SQLiteBackend(conn, V2_TABLENAME,
+        config.get('key_format', kvstore.DEFAULT_KEY_FORMAT), create)
+    return kvstore.KVStore(backend, None,
+        config.get('codec', objcodec.DEFAULT_CODEC),
+        config.get('hash', kvstore.DEFAULT_HASH),
+        config.get('compression', kvstore.DEFAULT_COMPRESSION))
+
+
+class Snapshot(object):
+    '''
+    The file open on conn, as of one commit, without loading the board:
+    conn, config, datastore and head, the oid of the commit. Nothing is
+    written opening it, so conn can be read-only. Inside a read transaction
+    on conn, in WAL mode (see sqlprofile), it's the file as it was when the
+    transaction began, however much another connection commits meanwhile.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.config = ConfigDict(conn, create=False)
+        self.head = self.config['head']
+        self.datastore = make_datastore(conn, self.config, create=False)
 
+    def graph(self):
+        "Load the head commit as a model.Graph. Don't commit it."
+        return model.Graph(self.datastore, self.head)
 
 
 def table_exists(conn, tablename):
@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+'''
+Command line tool for working on .gp files without the GUI.
+
+Usage: gptool.py <command> [options] <file>
+
+Run with -h for the list of commands. Never imports Tkinter, so it works
+on machines without a display. Commands that only read open the file
+without loading the board (see open_snapshot()), and go through big commits a
+batch of objects at a time, so memory stays flat however big the file.
+'''
+
+import argparse
+import os
+import sys
+
+import gpfile
+import model
+import kvstore
+import objcodec
+import retention
+import sqlprofile
+
+
+# GraphPaperFiles and gpfile.Sessions to close when the command is done
+opened = []
+
+def open_file(filename, compact=False):
+    "The GraphPaperFile at filename, which has to exist already"
+    if not os.path.exists(filename):
+        raise gpfile.Error('no such file: %s' % filename)
+    f = gpfile.GraphPaperFile(filename, compact)
+    opened.append(f)
+    return f
+
+
+def open_snapshot(filename):
+    '''
+    A gpfile.Snapshot of the file at filename: its conn, config, head and
+    datastore, without loading the board. It's outside a transaction, so
+    it can write too.
+    '''
+    if not os.path.exists(filename):
+        raise gpfile.Error('no such file: %s' % filename)
+    return gpfile.Snapshot(sqlprofile.connect(filename))
+
+
+def resolve(snapshot, name):
+    '''
+    The commit oid that name means: a branch, a commit oid, or the default
+    branch if None.
+    '''
+    if name is None:
+        return snapshot.head
+    refs = gpfile.branches(snapshot.config)
+    if name in refs:
+        return refs[name]
+    if snapshot.datastore.contains(name):
+        return name
+    raise gpfile.Error('no branch or commit "%s"' % name)
+
+
+def start_writing(snapshot):
+    '''
+    Open a gpfile.Session on the snapshot's file, so garbage collection in
+    other processes leaves alone what's stored before advance().
+    '''
+    session = gpfile.Session(snapshot.config, snapshot.datastore)
+    session.save(snapshot.head)
+    opened.append(session)
+
+
+def advance(snapshot, head):
+    '''
+    Move the snapshot's file on to commit head, made on top of its head,
+    without loading the board.
+    '''
+    import cardhistory
+    cardhistory.CardHistory(snapshot.conn).catch_up(snapshot.datastore, head, snapshot.head)
+    if not snapshot.config.compare_and_set('head', snapshot.head, head):
+        raise gpfile.ConflictError('another process committed meanwhile')
+    snapshot.config['card_history_head'] = head
+
+
+def first_line(card):
+    return card.get('text', '').split('\n', 1)[0][:60]
+
+
+def cmd_thin(args):
+    '''
+    Thin out old history according to a retention policy, then free the
+    objects only the dropped commits used.
+    '''
+    f = open_file(args.file)
+    if args.keep_all_hours is not None:
+        policy = retention.RetentionPolicy(args.keep_all_hours, args.hourly_days)
+        if args.save:
+            policy.save(f.config)
+    else:
+        policy = f.retention_policy()
+        if policy is None:
+            print 'no retention policy saved in %s; pass --keep-all-hours' % args.file
+            return 1
+    dropped = sum(f.thin_history(policy))
+    freed = sum(f.collect_garbage())
+    print 'dropped %d commits, freed %d objects' % (dropped, freed)
+    if args.vacuum:
+        f.conn.execute('vacuum')
+    return 0
+
+
+def cmd_migrate(args):
+    '''
+    Change how objects are stored: codec, hash and key format.
+    '''
+    f = open_file(args.file)
+    count = f.migrate(args.codec, args.hash, args.keys, args.compression)
+    print 'rewrote %d objects; codec %s, hash %s, %s keys, compression %s' % (
+        count, f.config['codec'] or objcodec.DEFAULT_CODEC,
+        f.config['hash'] or kvstore.DEFAULT_HASH,
+        f.config['key_format'] or kvstore.DEFAULT_KEY_FORMAT,
+        f.config['compression'] or kvstore.DEFAULT_COMPRESSION)
+    if args.vacuum:
+        f.conn.execute('vacuum')
+    return 0
+
+
+def cmd_stats(args):
+    '''
+    Print object counts and storage sizes.
+    '''
+    snapshot = open_snapshot(args.file)
+    head = model.load_commit(snapshot.datastore, snapshot.head)
+    print 'head:           %s' % snapshot.head
+    print 'branches:       %d' % len(gpfile.branches(snapshot.config))
+    print 'cards:          %d' % len(head['cards'])
+    print 'edges:          %d' % len(head.get('edges', []))
+    stats = snapshot.datastore.stats()
+    print 'objects:        %d (%d compressed)' % (stats['objects'], stats['compressed'])
+    print 'raw size:       %d bytes' % stats['raw_bytes']
+    print 'stored size:    %d bytes' % stats['stored_bytes']
+    if stats['stored_bytes']:
+        print 'compression:    %.2fx' % (float(stats['raw_bytes']) / stats['stored_bytes'])
+    return 0
+
+
+def cmd_profile(args):
+    '''
+    Show or change the sqlite storage profile.
+    '''
+    f = open_file(args.file)
+    if args.profile is not None:
+        f.set_profile(args.profile)
+    print 'profile: %s' % f.config.get('storage_profile', sqlprofile.DEFAULT_PROFILE)
+    for pragma, value in sorted(sqlprofile.current(f.conn).iteritems()):
+        print '  %-14s %s' % (pragma, value)
+    return 0
+
+
+def cmd_branch(args):
+    '''
+    List, create or delete branches. The default one, which the file opens
+    on, is starred.
+    '''
+    f = open_file(args.file)
+    if args.delete:
+        f.delete_branch(args.delete)
+    if args.create:
+        oid = f.branches().get(args.at, args.at)
+        if oid is not None and not f.graph.datastore.contains(oid):
+            raise gpfile.Error('no branch or commit "%s"' % oid)
+        f.create_branch(args.create, oid)
+    current = f.branch()
+    for name, oid in sorted(f.branches().iteritems()):
+        print '%s %-20s %s' % (name == current and '*' or ' ', name, oid)
+    return 0
+
+
+def cmd_fetch(args):
+    '''
+    Copy a branch from another file, only sending what's new.
+    '''
+    source = open_file(args.source)
+    target = open_file(args.file)
+    copied = target.fetch(source, args.branch, args.name)
+    print 'copied %d objects' % copied
+    return 0
+
+
+def cmd_bundle(args):
+    '''
+    Write the objects new since a commit to a bundle file.
+    '''
+    f = open_file(args.file)
+    if args.output == '-':
+        count = f.export_bundle(sys.stdout, args.branch, args.since)
+    else:
+        with open(args.output, 'wb') as out:
+            count = f.export_bundle(out, args.branch, args.since)
+        print 'wrote %d objects to %s' % (count, args.output)
+    return 0
+
+
+def cmd_unbundle(args):
+    '''
+    Import a bundle file as a branch.
+    '''
+    f = open_file(args.file)
+    stored = f.import_bundle(args.bundle, args.name)
+    print 'stored %d new objects; %s is at %s' % (stored, args.name, f.branches()[args.name])
+    return 0
+
+
+def cmd_export(args):
+    '''
+    Write a commit's board as JSON Lines (see jsonl.py).
+    '''
+    import jsonl
+    snapshot = open_snapshot(args.file)
+    oid = resolve(snapshot, args.commit)
+    if args.output == '-':
+        jsonl.dump(snapshot.datastore, oid, sys.stdout)
+    else:
+        with open(args.output, 'w') as out:
+            count = jsonl.dump(snapshot.datastore, oid, out)
+        print 'wrote %d lines to %s' % (count, args.output)
+    return 0
+
+
+def cmd_import(args):
+    '''
+    Add the cards and edges from a JSON Lines export to the board, in one
+    commit.
+    '''
+    import jsonl
+    snapshot = open_snapshot(args.file)
+    start_writing(snapshot)
+    datastore = snapshot.datastore
+    source = sys.stdin if args.input == '-' else open(args.input)
+    try:
+        head = jsonl.load(datastore, source, snapshot.head)
+    except jsonl.Error as e:
+        raise gpfile.Error('%s: %s' % (args.input, e))
+    finally:
+        source.close()
+    advance(snapshot, head)
+    commit = model.load_commit(datastore, head)
+    print 'imported %s; %d cards and %d edges on the board' % (
+        args.input, len(commit['cards']), len(commit['edges']))
+    return 0
+
+
+def cmd_bulk(args):
+    '''
+    Make a card of each note in a directory of text and Markdown files, a
+    Markdown file or a CSV file, in one commit.
+    '''
+    import bulkimport
+    snapshot = open_snapshot(args.file)
+    start_writing(snapshot)
+    if os.path.isdir(args.source):
+        notes = bulkimport.read_directory(args.source)
+    elif args.source.lower().endswith('.csv'):
+        notes = bulkimport.read_csv(args.source, args.column)
+    else:
+        notes = bulkimport.read_markdown(args.source)
+    try:
+        head, count = bulkimport.import_notes(
+            snapshot.datastore, notes, snapshot.head,
+            args.columns or bulkimport.DEFAULT_COLUMNS, args.processes)
+    except (IOError, ValueError) as e:
+        raise gpfile.Error(str(e))
+    advance(snapshot, head)
+    print 'made %d cards' % count
+    return 0
+
+
+def cmd_search(args):
+    '''
+    Full-text search of the cards on the board, best matches first.
+    '''
+    import search
+    snapshot = open_snapshot(args.file)
+    try:
+        index = search.SearchIndex(snapshot.conn)
+    except search.Error as e:
+        raise gpfile.Error(str(e))
+    index.update(snapshot.datastore, snapshot.head)
+    for oid, snippet in index.search(args.query, args.limit):
+        print '%s %s' % (oid, snippet.replace('\n', ' '))
+    return 0
+
+
+def cmd_layout(args):
+    '''
+    Lay the cards out automatically, in one commit.
+    '''
+    import layout
+    # only geometry is needed, and big boards are what need laying out
+    f = open_file(args.file, compact=True)
+    try:
+        moved = layout.layout_graph(f.graph, iterations=args.iterations)
+    except layout.Error as e:
+        raise gpfile.Error(str(e))
+    f.commit()
+    print 'laid out %d cards' % len(moved)
+    return 0
+
+
+def cmd_gc(args):
+    '''
+    Free objects no branch can reach any more.
+    '''
+    f = open_file(args.file)
+    print 'freed %d objects' % sum(f.collect_garbage())
+    if args.vacuum:
+        f.conn.execute('vacuum')
+    return 0
+
+
+def cmd_verify(args):
+    '''
+    Check that every object matches its key, and that every branch has all
+    the objects its history needs. Prints each problem found.
+    '''
+    import fsck
+    snapshot = open_snapshot(args.file)
+    problems = 0
+    for problem in fsck.check(snapshot.datastore, gpfile.branches(snapshot.config),
+                              args.processes):
+        print problem
+        problems += 1
+    if problems:
+        print '%d problems' % problems
+        return 1
+    print 'ok'
+    return 0
+
+
+def cmd_diff(args):
+    '''
+    List the cards and edges that differ between two commits.
+    '''
+    import cardhistory
+    snapshot = open_snapshot(args.file)
+    datastore = snapshot.datastore
+    new = model.load_commit(datastore, resolve(snapshot, args.new))
+    if args.old is not None:
+        old = model.load_commit(datastore, resolve(snapshot, args.old))
+    elif new['parent']:
+        old = model.load_commit(datastore, new['parent'])
+    else:
+        old = {'cards': [], 'edges': []}
+    changes = cardhistory.manifest_changes(old['cards'], new['cards'])
+    changed = [oid for change in changes for oid in change if oid is not None]
+    cards = dict(model.load_objects(datastore, changed))
+    for old_oid, new_oid in changes:
+        if old_oid is None:
+            print '+ card %s %s' % (new_oid, first_line(cards[new_oid]))
+        elif new_oid is None:
+            print '- card %s %s' % (old_oid, first_line(cards[old_oid]))
+        else:
+            fields = sorted(field for field in set(cards[old_oid]).union(cards[new_oid])
+                            if cards[old_oid].get(field) != cards[new_oid].get(field))
+            print '~ card %s %s (%s)' % (new_oid, first_line(cards[new_oid]), ', '.join(fields))
+    old_edges = set(old.get('edges', []))
+    new_edges = set(new.get('edges', []))
+    for sign, edges in (('+', new_edges - old_edges), ('-', old_edges - new_edges)):
+        for edge_oid, edge in model.load_objects(datastore, sorted(edges)):
+            print '%s edge %s %s -> %s' % (sign, edge_oid, edge['orig'], edge['dest'])
+    return 0
+
+
+def cmd_history(args):
+    '''
+    List commits, newest first, or the versions of one card, or the
+    commits no branch leads to any more.
+    '''
+    import time
+    snapshot = open_snapshot(args.file)
+    datastore = snapshot.datastore
+    if args.card:
+        import cardhistory
+        history = cardhistory.CardHistory(snapshot.conn)
+        for commit_oid, card_oid in history.versions(args.card):
+            print '%s %s' % (commit_oid, card_oid or 'deleted')
+        return 0
+    if args.lost:
+        heads = gpfile.branches(snapshot.config).values()
+        commits = [(oid, model.load_commit(datastore, oid))
+                   for oid in retention.lost_commits(datastore, heads)]
+        commits.sort(key=lambda (oid, commit): commit.get('time'), reverse=True)
+        for oid, commit in commits[:args.limit]:
+            when = commit.get('time')
+            print '%s %-19s %6d cards %6d edges' % (
+                oid, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)) if when else '-',
+                len(commit['cards']), len(commit.get('edges', [])))
+        return 0
+    oid = resolve(snapshot, args.commit)
+    commit = model.load_commit(datastore, oid)
+    shown = 0
+    while oid and (args.limit is None or shown < args.limit):
+        parent = commit['parent'] and model.load_commit(datastore, commit['parent'])
+        cards = set(commit['cards'])
+        parent_cards = set(parent['cards']) if parent else set()
+        when = commit.get('time')
+        # commits from before commit times have none
+        print '%s %-19s %6d cards %6d edges  +%d -%d' % (
+            oid, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)) if when else '-',
+            len(cards), len(commit.get('edges', [])),
+            len(cards - parent_cards), len(parent_cards - cards))
+        oid, commit = commit['parent'], parent
+        shown += 1
+    return 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Work on GraphPaper files without the GUI.')
+    commands = parser.add_subparsers(title='commands')
+
+    thin = commands.add_parser('thin',
+        help='drop old commits per a retention policy and free their objects')
+    thin.add_argument('file')
+    thin.add_argument('--keep-all-hours', type=float,
+        help='keep every commit younger than this (default: saved policy)')
+    thin.add_argument('--hourly-days', type=float, default=7,
+        help='then keep one commit per hour for this many days, '
+             'and one per day after that')
+    thin.add_argument('--save', action='store_true',
+        help='save the policy in the file for background thinning')
+    thin.add_argument('--vacuum', action='store_true',
+        help='shrink the file afterwards')
+    thin.set_defaults(func=cmd_thin)
+
+    migrate = commands.add_parser('migrate',
+        help='rewrite all objects in another format')
+    migrate.add_argument('file')
+    migrate.add_argument('--codec', choices=sorted(objcodec.CODECS),
+        help='object encoding')
+    migrate.add_argument('--hash', choices=sorted(kvstore.HASHES),
+        help='hash function objects are keyed by')
+    migrate.add_argument('--keys', choices=kvstore.KEY_FORMATS,
+        help='store keys as hex text or raw blobs')
+    migrate.add_argument('--compression', choices=kvstore.COMPRESSIONS,
+        help='compress stored objects')
+    migrate.add_argument('--vacuum', action='store_true',
+        help='shrink the file afterwards')
+    migrate.set_defaults(func=cmd_migrate)
+
+    stats = commands.add_parser('stats', help='show object counts and sizes')
+    stats.add_argument('file')
+    stats.set_defaults(func=cmd_stats)
+
+    profile = commands.add_parser('profile',
+        help='show or set how sqlite is tuned for the file')
+    profile.add_argument('file')
+    profile.add_argument('profile', nargs='?', choices=sorted(sqlprofile.PROFILES),
+        help='profile to switch to')
+    profile.set_defaults(func=cmd_profile)
+
+    branch = commands.add_parser('branch', help='list, create or delete branches')
+    branch.add_argument('file')
+    branch.add_argument('--create', metavar='NAME',
+        help='start a branch at the head')
+    branch.add_argument('--at', metavar='COMMIT',
+        help='commit or branch to start it at instead, say one history --lost lists')
+    branch.add_argument('--delete', metavar='NAME',
+        help='delete a branch')
+    branch.set_defaults(func=cmd_branch)
+
+    fetch = commands.add_parser('fetch', help='copy a branch from another file')
+    fetch.add_argument('file')
+    fetch.add_argument('source', help='file to copy from')
+    fetch.add_argument('--branch', help='branch to copy (default: %s)' % gpfile.DEFAULT_BRANCH)
+    fetch.add_argument('--as', dest='name', metavar='NAME',
+        help='name for the branch here (default: the same)')
+    fetch.set_defaults(func=cmd_fetch)
+
+    bundle = commands.add_parser('bundle', help='write new objects to a bundle file')
+    bundle.add_argument('file')
+    bundle.add_argument('output', help='bundle file to write, - for stdout')
+    bundle.add_argument('--branch', help='branch to bundle (default: %s)' % gpfile.DEFAULT_BRANCH)
+    bundle.add_argument('--since', metavar='COMMIT',
+        help='commit or branch the receiving file already has (default: bundle everything)')
+    bundle.set_defaults(func=cmd_bundle)
+
+    unbundle = commands.add_parser('unbundle', help='import a bundle file as a branch')
+    unbundle.add_argument('file')
+    unbundle.add_argument('bundle')
+    unbundle.add_argument('--as', dest='name', metavar='NAME', default=gpfile.DEFAULT_BRANCH,
+        help='branch to import it as (default: %(default)s)')
+    unbundle.set_defaults(func=cmd_unbundle)
+
+    export = commands.add_parser('export', help='write a board as JSON Lines')
+    export.add_argument('file')
+    export.add_argument('output', nargs='?', default='-',
+        help='file to write (default: stdout)')
+    export.add_argument('--commit', help='commit or branch (default: the head)')
+    export.set_defaults(func=cmd_export)
+
+    import_ = commands.add_parser('import', help='add cards from a JSON Lines export')
+    import_.add_argument('file')
+    import_.add_argument('input', help='file written by export, - for stdin')
+    import_.set_defaults(func=cmd_import)
+
+    bulk = commands.add_parser('bulk', help='make cards from a pile of notes')
+    bulk.add_argument('file')
+    bulk.add_argument('source',
+        help='directory of .txt/.md files, a .csv file, or a Markdown file')
+    bulk.add_argument('--column', help='CSV column with the text (default: "text", or all)')
+    bulk.add_argument('--columns', type=int,
+        help='cards per row (default: 50)')
+    bulk.add_argument('--processes', type=int,
+        help='worker processes (default: one per CPU)')
+    bulk.set_defaults(func=cmd_bulk)
+
+    search = commands.add_parser('search', help='find cards by their text')
+    search.add_argument('file')
+    search.add_argument('query',
+        help='words, "a phrase" or prefix* (sqlite FTS5 syntax)')
+    search.add_argument('--limit', type=int, default=20,
+        help='show at most this many (default: %(default)s)')
+    search.set_defaults(func=cmd_search)
+
+    layout = commands.add_parser('layout', help='lay the cards out automatically')
+    layout.add_argument('file')
+    layout.add_argument('--iterations', type=int, default=100,
+        help='steps of the simulation (default: %(default)s)')
+    layout.set_defaults(func=cmd_layout)
+
+    gc = commands.add_parser('gc', help='free unreachable objects')
+    gc.add_argument('file')
+    gc.add_argument('--vacuum', action='store_true',
+        help='give the space back to the filesystem')
+    gc.set_defaults(func=cmd_gc)
+
+    verify = commands.add_parser('verify', help='check objects and history')
+    verify.add_argument('file')
+    verify.add_argument('--processes', type=int,
+        help='worker processes (default: one per CPU)')
+    verify.set_defaults(func=cmd_verify)
+
+    diff = commands.add_parser('diff', help='compare two commits')
+    diff.add_argument('file')
+    diff.add_argument('old', nargs='?', help='commit or branch (default: new\'s parent)')
+    diff.add_argument('new', nargs='?', help='commit or branch (default: the head)')
+    diff.set_defaults(func=cmd_diff)
+
+    history = commands.add_parser('history', help='list commits')
+    history.add_argument('file')
+    history.add_argument('--commit', help='commit or branch to start from (default: the head)')
+    history.add_argument('--limit', type=int, help='list at most this many')
+    history.add_argument('--card', metavar='OID',
+        help='list the versions of a card instead')
+    history.add_argument('--lost', action='store_true',
+        help='list the commits no branch leads to instead, until gc frees them')
+    history.set_defaults(func=cmd_history)
+
+    return parser
+
+
+def main(argv):
+    args = make_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except gpfile.Error as e:
+        print >>sys.stderr, 'gptool: %s' % e
+        return 1
+    finally:
+        while opened:
+            opened.pop().close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
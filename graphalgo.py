@@ -0,0 +1,343 @@
+'''
+Graph algorithms over a board's cards and edges.
+
+CardGraph numbers the cards 0 to n-1 and keeps the edges as two CSR
+(compressed sparse row) adjacency structures, one each way, in arrays:
+the cards edges go out to from card i are targets[offsets[i]:offsets[i + 1]].
+That's a few machine words per edge rather than a Python object, and walking
+it is plain indexing, so everything here takes time linear in the number of
+cards and edges, and a million edges is a matter of seconds.
+
+A CardGraph is built from a model.Graph, for the cards on screen, or
+straight from a commit, without making any model objects; either way what
+goes in and comes out is what it was built from, model.Cards or card oids.
+Directions are OUT (along edges), IN (against them) or BOTH (ignoring
+which way they go).
+'''
+
+import collections
+import itertools
+import unittest
+from array import array
+
+import model
+
+OUT = 'out'
+IN = 'in'
+BOTH = 'both'
+
+
+class Error(Exception):
+    pass
+
+
+def csr(count, origs, dests):
+    '''
+    Return (offsets, targets) for count nodes and the edges from origs[i]
+    to dests[i], with each node's targets in edge order.
+    '''
+    offsets = array('l', [0]) * (count + 1)
+    for orig in origs:
+        offsets[orig + 1] += 1
+    for i in xrange(count):
+        offsets[i + 1] += offsets[i]
+    targets = array('l', [0]) * len(origs)
+    fill = array('l', offsets)
+    for orig, dest in itertools.izip(origs, dests):
+        targets[fill[orig]] = dest
+        fill[orig] += 1
+    return offsets, targets
+
+
+class CardGraph(object):
+    '''
+    The cards of a board, numbered, and its edges in CSR form.
+
+    Members:
+    * cards: what the cards are, a list in number order
+    * out, into: (offsets, targets) of the edges going out of each card,
+      and coming into it
+    '''
+
+    def __init__(self, cards, ends, key=None):
+        '''
+        cards is a list; ends an iterable of (orig, dest) pairs of cards;
+        key(card) gives what a card is known by, the card itself by
+        default. Edges with an end that isn't one of cards are ignored.
+        '''
+        self.cards = cards
+        self.key = key or (lambda card: card)
+        self.numbers = {}
+        for i, card in enumerate(cards):
+            # identical cards can share a key; the first is the one
+            self.numbers.setdefault(self.key(card), i)
+        origs = array('l')
+        dests = array('l')
+        for orig, dest in ends:
+            orig = self.numbers.get(self.key(orig))
+            dest = self.numbers.get(self.key(dest))
+            if orig is not None and dest is not None:
+                origs.append(orig)
+                dests.append(dest)
+        self.out = csr(len(cards), origs, dests)
+        self.into = csr(len(cards), dests, origs)
+
+    @classmethod
+    def from_graph(cls, graph):
+        "A CardGraph of the model.Cards of model.Graph graph"
+        # id() since identical cards are equal
+        return cls(list(graph.cards), ((e.orig, e.dest) for e in graph.edges), id)
+
+    @classmethod
+    def from_commit(cls, datastore, oid):
+        "A CardGraph of the card oids of commit oid, decoding only its edges"
+        commit = model.load_commit(datastore, oid)
+        edges = model.load_objects(datastore, commit.get('edges', []))
+        return cls(list(commit['cards']),
+                   ((edge['orig'], edge['dest']) for edge_oid, edge in edges))
+
+    def number(self, card):
+        try:
+            return self.numbers[self.key(card)]
+        except KeyError:
+            raise Error('not one of the cards: %r' % (card,))
+
+    def neighbours(self, i, direction=OUT):
+        "Generate the numbers of the cards card i has an edge to, from or either"
+        for offsets, targets in self.csrs(direction):
+            for j in xrange(offsets[i], offsets[i + 1]):
+                yield targets[j]
+
+    def csrs(self, direction):
+        if direction == OUT:
+            return (self.out,)
+        elif direction == IN:
+            return (self.into,)
+        elif direction == BOTH:
+            return (self.out, self.into)
+        raise ValueError('unknown direction: %r' % (direction,))
+
+    def search(self, starts, direction=OUT, depth_first=False):
+        '''
+        Return the numbers of the cards reachable from those numbered
+        starts, them included, in breadth or depth first order.
+        '''
+        csrs = self.csrs(direction)
+        seen = array('b', [0]) * len(self.cards)
+        order = []
+        if depth_first:
+            # a stack of the cards still to visit, pushed in reverse so
+            # they're visited in edge order
+            stack = list(reversed(starts))
+            while stack:
+                i = stack.pop()
+                if seen[i]:
+                    continue
+                seen[i] = 1
+                order.append(i)
+                for offsets, targets in reversed(csrs):
+                    for j in xrange(offsets[i + 1] - 1, offsets[i] - 1, -1):
+                        if not seen[targets[j]]:
+                            stack.append(targets[j])
+            return order
+        for i in starts:
+            if not seen[i]:
+                seen[i] = 1
+                order.append(i)
+        # order doubles as the queue
+        for i in order:
+            for offsets, targets in csrs:
+                for j in xrange(offsets[i], offsets[i + 1]):
+                    k = targets[j]
+                    if not seen[k]:
+                        seen[k] = 1
+                        order.append(k)
+        return order
+
+    def cards_of(self, numbers):
+        return [self.cards[i] for i in numbers]
+
+    def bfs(self, card, direction=OUT):
+        "The cards reachable from card, nearest first"
+        return self.cards_of(self.search([self.number(card)], direction))
+
+    def dfs(self, card, direction=OUT):
+        "The cards reachable from card, depth first"
+        return self.cards_of(self.search([self.number(card)], direction, True))
+
+    def component_numbers(self):
+        '''
+        Return (number of components, array of each card's component),
+        connected ignoring direction, numbered in order of their first card.
+        '''
+        labels = array('l', [-1]) * len(self.cards)
+        count = 0
+        for i in xrange(len(self.cards)):
+            if labels[i] < 0:
+                for j in self.search([i], BOTH):
+                    labels[j] = count
+                count += 1
+        return count, labels
+
+    def components(self):
+        "Lists of the cards connected to each other ignoring direction, biggest first"
+        count, labels = self.component_numbers()
+        members = [[] for i in xrange(count)]
+        for i, label in enumerate(labels):
+            members[label].append(self.cards[i])
+        members.sort(key=len, reverse=True)
+        return members
+
+    def shortest_path(self, start, end, direction=BOTH):
+        '''
+        The cards on a shortest path from start to end, both included, by
+        number of edges, or None if there is none.
+        '''
+        start = self.number(start)
+        end = self.number(end)
+        csrs = self.csrs(direction)
+        previous = array('l', [-1]) * len(self.cards)
+        previous[start] = start
+        queue = collections.deque([start])
+        while queue and previous[end] < 0:
+            i = queue.popleft()
+            for offsets, targets in csrs:
+                for j in xrange(offsets[i], offsets[i + 1]):
+                    k = targets[j]
+                    if previous[k] < 0:
+                        previous[k] = i
+                        queue.append(k)
+        if previous[end] < 0:
+            return None
+        path = [end]
+        while path[-1] != start:
+            path.append(previous[path[-1]])
+        path.reverse()
+        return self.cards_of(path)
+
+    def topological_order(self):
+        '''
+        The cards ordered so every edge goes forward, ties in card order.
+        Raise Error if there's a cycle.
+        '''
+        offsets, targets = self.out
+        into_offsets = self.into[0]
+        waiting = array('l', (into_offsets[i + 1] - into_offsets[i]
+                              for i in xrange(len(self.cards))))
+        order = [i for i in xrange(len(self.cards)) if not waiting[i]]
+        for i in order:
+            for j in xrange(offsets[i], offsets[i + 1]):
+                k = targets[j]
+                waiting[k] -= 1
+                if not waiting[k]:
+                    order.append(k)
+        if len(order) < len(self.cards):
+            raise Error('the edges go round in a cycle; %d cards are on or after one' % (
+                len(self.cards) - len(order)))
+        return self.cards_of(order)
+
+    def strong_components(self):
+        '''
+        Lists of the numbers of the cards that can all reach each other, by
+        Tarjan's algorithm, without recursion.
+        '''
+        offsets, targets = self.out
+        count = len(self.cards)
+        index = array('l', [-1]) * count
+        low = array('l', [0]) * count
+        on_stack = array('b', [0]) * count
+        stack = []
+        found = []
+        counter = 0
+        for root in xrange(count):
+            if index[root] >= 0:
+                continue
+            # (card, position in its targets) of the cards being visited
+            work = [(root, offsets[root])]
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            while work:
+                i, pos = work[-1]
+                if pos < offsets[i + 1]:
+                    work[-1] = (i, pos + 1)
+                    k = targets[pos]
+                    if index[k] < 0:
+                        index[k] = low[k] = counter
+                        counter += 1
+                        stack.append(k)
+                        on_stack[k] = 1
+                        work.append((k, offsets[k]))
+                    elif on_stack[k] and index[k] < low[i]:
+                        low[i] = index[k]
+                    continue
+                work.pop()
+                if work and low[i] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[i]
+                if low[i] == index[i]:
+                    component = []
+                    while True:
+                        k = stack.pop()
+                        on_stack[k] = 0
+                        component.append(k)
+                        if k == i:
+                            break
+                    found.append(component)
+        return found
+
+    def cycles(self):
+        '''
+        Lists of the cards that are on cycles together: every card in one
+        can reach every other along edges.
+        '''
+        offsets, targets = self.out
+        cycles = []
+        for component in self.strong_components():
+            i = component[0]
+            if len(component) > 1 or i in targets[offsets[i]:offsets[i + 1]]:
+                cycles.append(self.cards_of(sorted(component)))
+        return cycles
+
+
+class TestCardGraph(unittest.TestCase):
+
+    def setUp(self):
+        import kvbackend
+        import kvstore
+        self.store = kvstore.KVStore(kvbackend.MemoryBackend())
+        self.graph = model.Graph(self.store, None)
+        # a -> b -> c -> a, c -> d; e on its own
+        self.a, self.b, self.c, self.d, self.e = cards = [
+            self.graph.new_card() for i in range(5)]
+        for card, text in zip(cards, 'abcde'):
+            card.text = text
+        for orig, dest in ((0, 1), (1, 2), (2, 0), (2, 3)):
+            self.graph.new_edge(cards[orig], cards[dest])
+        self.cg = CardGraph.from_graph(self.graph)
+
+    def texts(self, cards):
+        return ''.join(card.text for card in cards)
+
+    def testTraversal(self):
+        self.assertEqual(self.texts(self.cg.bfs(self.b)), 'bcad')
+        self.assertEqual(self.texts(self.cg.bfs(self.d, IN)), 'dcba')
+        self.assertEqual(self.texts(self.cg.dfs(self.a)), 'abcd')
+        self.assertEqual([self.texts(c) for c in self.cg.components()], ['abcd', 'e'])
+        self.assertEqual(self.texts(self.cg.shortest_path(self.d, self.a)), 'dca')
+        self.assertEqual(self.texts(self.cg.shortest_path(self.a, self.d, OUT)), 'abcd')
+        self.assertEqual(self.cg.shortest_path(self.d, self.a, OUT), None)
+        self.assertEqual(self.cg.shortest_path(self.a, self.e), None)
+
+    def testOrder(self):
+        self.assertEqual([self.texts(c) for c in self.cg.cycles()], ['abc'])
+        self.assertRaises(Error, self.cg.topological_order)
+        self.graph.edges[2].delete()
+        cg = CardGraph.from_commit(self.store, self.graph.commit())
+        self.assertEqual(cg.cycles(), [])
+        order = cg.topological_order()
+        self.assertEqual(order, [self.a.saved_oid, self.e.saved_oid, self.b.saved_oid,
+                                 self.c.saved_oid, self.d.saved_oid])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,9 +5,14 @@ import os
 
 from Tkinter import *
 import tkFileDialog
+import tkMessageBox
+import tkSimpleDialog
 
 import model
 import gpfile
+import graphalgo
+import layout
+import search
 
 from viewportcard import ViewportCard
 from viewportedge import ViewportEdge
@@ -46,24 +51,15 @@ class GPViewport(Frame):
         self.canvas.bind("<B1-Motion>", self.mousemove)
         self.canvas.bind("<Configure>", self.resize)
         # load cards
-        cards_by_id = {}
         self.cards = []
-        for card in self.data.get_cards():
-            new = ViewportCard(self, self.gpfile, card)
-            self.cards.append(new)
-            cards_by_id[card.obj.oid] = new
+        self.add_cards(self.data.get_cards())
         self.reset_scroll_region()
         # load edges
         self.edges = []
-        for edge in self.data.get_edges():
-            new = ViewportEdge(
-                self,
-                self.gpfile,
-                edge,
-                cards_by_id[edge.orig.obj.oid],
-                cards_by_id[edge.dest.obj.oid]
-            )
-            self.edges.append(new)
+        self.add_edges(self.data.get_edges())
+        # follow commits from other processes, and batches of edits
+        self.data.head_slot.add(self.head_changed)
+        self.data.edit_slot.add(self.batch_committed)
         # set up scrolling
         self.yscroll["command"] = self.canvas.yview
         self.xscroll["command"] = self.canvas.xview
@@ -74,9 +70,78 @@ class GPViewport(Frame):
         # set up drag scrolling
         self.dragging = False
         self.last_drag_coords = None
+        # (query, index of the hit shown) of the last find()
+        self.last_find = None
+        # the cards last focused, newest last, and those select() highlighted
+        self.focused = []
+        self.selection = []
         # um, yeah.
         self.fix_z_order()
 
+    def add_cards(self, cards):
+        for card in cards:
+            self.cards.append(ViewportCard(self, self.gpfile, card))
+
+    def add_edges(self, edges):
+        # model.Card -> ViewportCard; id() since identical cards are equal
+        by_card = dict((id(vc.card), vc) for vc in self.cards)
+        for edge in edges:
+            new = ViewportEdge(
+                self,
+                self.gpfile,
+                edge,
+                by_card[id(edge.orig)],
+                by_card[id(edge.dest)]
+            )
+            self.edges.append(new)
+
+    def head_changed(self, oid, removed_cards, added_cards, removed_edges, added_edges):
+        '''
+        The graph was reloaded with another commit; redraw what changed.
+        '''
+        self.show_changes(removed_cards, added_cards, removed_edges, added_edges)
+
+    def batch_committed(self, oid, changed, added, removed, added_edges, removed_edges):
+        '''
+        A batch of edits was committed; move the cards it moved, and show
+        what it added and removed.
+        '''
+        by_card = dict((id(vc.card), vc) for vc in self.cards)
+        for card in changed:
+            vc = by_card.get(id(card))
+            if vc is not None:
+                x, y = vc.canvas_coords()
+                vc.window.move(card.x - x, card.y - y)
+                vc.geometry_callback()
+        self.show_changes(removed, added, removed_edges, added_edges)
+
+    def show_changes(self, removed_cards, added_cards, removed_edges, added_edges):
+        "Take cards and edges off the canvas and put others on"
+        removed = set(map(id, removed_edges))
+        for ve in [ve for ve in self.edges if id(ve.edge) in removed]:
+            # not ve.delete(), that deletes the model edge too
+            self.canvas.delete(ve.itemid)
+            ve.orig = None
+            ve.dest = None
+            self.edges.remove(ve)
+        removed = set(map(id, removed_cards))
+        for vc in [vc for vc in self.cards if id(vc.card) in removed]:
+            for handle in vc.edge_handles or ():
+                self.canvas.delete(handle)
+            vc.window.destroy()
+            self.cards.remove(vc)
+        # a batch's new cards may be up already
+        shown = set(id(vc.card) for vc in self.cards)
+        self.add_cards([c for c in added_cards if id(c) not in shown])
+        shown = set(id(ve.edge) for ve in self.edges)
+        self.add_edges([e for e in added_edges if id(e) not in shown])
+        self.fix_z_order()
+        self.reset_scroll_region()
+
+    def busy(self):
+        "Whether a card is being edited or dragged"
+        return any(vc.editing or vc.moving or vc.resize_state for vc in self.cards)
+
     def reset_scroll_region(self):
         # set scroll region to bounding box of all card rects
         # with, say, 20 px margin
@@ -127,7 +192,7 @@ class GPViewport(Frame):
             self.gpfile,
             self.data.new_card(x, y, w, h)
         )
-        self.data.commit()
+        self.gpfile.commit()
         self.cards.append(newcard)
         return newcard
 
@@ -177,6 +242,112 @@ class GPViewport(Frame):
         #print 'canvas_mouse_coords', canvas_mouse_coords, 'window_coords', window_coords, 'edge scroll', scroll_x, scroll_y
         return scroll_x, scroll_y
 
+    def find(self, *args):
+        '''
+        Ask for a search and jump to the best matching card. Searching for
+        the same thing again goes on to the next match.
+        '''
+        last_query, last_hit = self.last_find or ('', -1)
+        query = tkSimpleDialog.askstring('Find', 'Find cards with:',
+                                         initialvalue=last_query, parent=self)
+        if not query:
+            return
+        hit = last_hit + 1 if query == last_query else 0
+        try:
+            results = self.gpfile.search(query, hit + 1)
+        except search.Error as e:
+            tkMessageBox.showerror('Find', str(e), parent=self)
+            return
+        by_oid = dict((vc.card.saved_oid, vc) for vc in self.cards)
+        found = [by_oid[oid] for oid, snippet in results if oid in by_oid]
+        if not found:
+            self.last_find = None
+            tkMessageBox.showinfo('Find', 'No more cards with "%s"' % query, parent=self)
+            return
+        self.last_find = (query, hit)
+        self.show_card(found[-1])
+
+    def show_card(self, vc):
+        "Scroll card vc into the middle of the view and focus it"
+        x0, y0, x1, y1 = [float(n) for n in str(self.canvas['scrollregion']).split()]
+        c = vc.card
+        x = c.x + c.w / 2.0 - self.canvas.winfo_width() / 2.0
+        y = c.y + c.h / 2.0 - self.canvas.winfo_height() / 2.0
+        self.canvas.xview(MOVETO, (x - x0) / (x1 - x0))
+        self.canvas.yview(MOVETO, (y - y0) / (y1 - y0))
+        self.save_scroll_pos()
+        vc.text.focus_set()
+
+    def card_focused(self, vc):
+        self.focused = [c for c in self.focused if c is not vc][-1:] + [vc]
+
+    def select(self, vcs):
+        "Highlight the ViewportCards vcs instead of those highlighted before"
+        for vc in self.selection:
+            if vc in self.cards:
+                vc.unhighlight()
+        self.selection = list(vcs)
+        for vc in self.selection:
+            vc.highlight()
+
+    def select_graph(self, what):
+        '''
+        Select cards by how they're connected, what being one of:
+         * 'reachable': those the focused card leads to
+         * 'connected': those connected to the focused card any way
+         * 'path': those on a shortest path from the card focused before to
+           the focused card
+         * 'cycles': those on a cycle
+        '''
+        focused = [vc for vc in self.focused if vc in self.cards]
+        needed = {'path': 2, 'cycles': 0}.get(what, 1)
+        if len(focused) < needed:
+            tkMessageBox.showinfo('Select', 'Click on %s first' % (
+                'two cards' if needed == 2 else 'a card'), parent=self)
+            return
+        cg = graphalgo.CardGraph.from_graph(self.data)
+        if what == 'reachable':
+            cards = cg.bfs(focused[-1].card)
+        elif what == 'connected':
+            cards = cg.bfs(focused[-1].card, graphalgo.BOTH)
+        elif what == 'path':
+            cards = cg.shortest_path(focused[0].card, focused[1].card) or []
+        else:
+            cards = [card for cycle in cg.cycles() for card in cycle]
+        by_card = dict((id(vc.card), vc) for vc in self.cards)
+        self.select([by_card[id(card)] for card in cards])
+
+    def lay_out(self, selected=False):
+        '''
+        Lay out all the cards, or just the selected ones among the rest,
+        in one commit.
+        '''
+        vcs = [vc for vc in self.selection if vc in self.cards] if selected else self.cards
+        if not vcs:
+            tkMessageBox.showinfo('Lay Out', 'Select some cards first', parent=self)
+            return
+        # batch_committed() moves the cards on the canvas
+        try:
+            with self.gpfile.batch():
+                layout.layout_graph(self.data, [vc.card for vc in vcs])
+        except layout.Error as e:
+            tkMessageBox.showerror('Lay Out', str(e), parent=self)
+
+    def delete_selection(self):
+        "Delete the selected cards and their edges, in one commit"
+        vcs = [vc for vc in self.selection if vc in self.cards]
+        if not vcs:
+            tkMessageBox.showinfo('Delete', 'Select some cards first', parent=self)
+            return
+        if not tkMessageBox.askokcancel(
+                'Delete?', 'Delete %d cards and all their edges?' % len(vcs), parent=self):
+            return
+        # the cards go from the canvas now, their edges once it commits
+        with self.gpfile.batch():
+            for vc in vcs:
+                vc.remove()
+        self.selection = []
+
     def doubleclick(self, event):
         '''Create a new card on the canvas and focus it'''
         default_w = int(self.config["default_card_w"] or 200)
@@ -213,6 +384,12 @@ class GPViewport(Frame):
 
 
 class GPApp(object):
+    # ms between background maintenance steps, and between runs
+    MAINTENANCE_STEP = 50
+    MAINTENANCE_INTERVAL = 10 * 60 * 1000
+    # ms between checks for commits by other processes
+    REFRESH_INTERVAL = 2000
+
     def __init__(self, filename):
         self.root = Tk()
         self.root["bg"] = "green"
@@ -234,7 +411,26 @@ class GPApp(object):
         # edit menu
         editmenu = Menu(rootmenu, tearoff=0)
         rootmenu.add_cascade(menu=editmenu, label='Edit')
+        editmenu.add_command(label="Find", command=self.find)
         editmenu.add_command(label="Default Card Size", state='disabled')
+        # select menu
+        selectmenu = Menu(rootmenu, tearoff=0)
+        rootmenu.add_cascade(menu=selectmenu, label='Select')
+        for label, what in (('Reachable From Card', 'reachable'),
+                            ('Connected To Card', 'connected'),
+                            ('Path Between Last Two Cards', 'path'),
+                            ('Cycles', 'cycles')):
+            selectmenu.add_command(label=label,
+                                   command=lambda what=what: self.select_graph(what))
+        selectmenu.add_command(label='None', command=lambda: self.viewport.select([]))
+        selectmenu.add_separator()
+        selectmenu.add_command(label='Lay Out All',
+                               command=lambda: self.viewport.lay_out())
+        selectmenu.add_command(label='Lay Out Selection',
+                               command=lambda: self.viewport.lay_out(True))
+        selectmenu.add_separator()
+        selectmenu.add_command(label='Delete Selection',
+                               command=lambda: self.viewport.delete_selection())
         self.root.config(menu=rootmenu)
         # settings for tkFileDialog
         self.file_dialog_settings = dict(
@@ -242,12 +438,47 @@ class GPApp(object):
             filetypes = (('GraphPaper files', '.gp'), ('sqlite files', '.sqlite')),
             title = 'GraphPaper'
         )
-        # set ctrl-o to open, ctrl-n to new
+        # set ctrl-o to open, ctrl-n to new, ctrl-f to find
         self.root.bind('<Control-o>', self.choosefile)
         self.root.bind('<Control-n>', self.newfile)
+        self.root.bind('<Control-f>', self.find)
+        # thin history and collect garbage in the background
+        self.maintenance = None
+        self.root.after(self.MAINTENANCE_INTERVAL, self.maintenance_step)
+        self.root.after(self.REFRESH_INTERVAL, self.refresh_step)
+
+    def refresh_step(self):
+        '''
+        Show commits other processes made to the file, unless that would
+        pull a card out from under the user.
+        '''
+        if not self.viewport.busy():
+            self.viewport.gpfile.refresh()
+        self.root.after(self.REFRESH_INTERVAL, self.refresh_step)
+
+    def maintenance_step(self):
+        '''
+        Do one step of gpfile maintenance, then schedule the next one.
+        '''
+        if self.maintenance is None:
+            self.maintenance = self.viewport.gpfile.maintain()
+        try:
+            self.maintenance.next()
+        except StopIteration:
+            self.maintenance = None
+            self.root.after(self.MAINTENANCE_INTERVAL, self.maintenance_step)
+        else:
+            self.root.after(self.MAINTENANCE_STEP, self.maintenance_step)
+
+    def find(self, *args):
+        self.viewport.find()
+
+    def select_graph(self, what):
+        self.viewport.select_graph(what)
 
     def mainloop(self):
         self.root.mainloop()
+        self.viewport.gpfile.close()
 
     def openfile(self, filename):
         # creates new GPViewport
@@ -257,6 +488,9 @@ class GPApp(object):
         filename = filename or self.default_filename
         if self.viewport:
             self.viewport.destroy()
+            self.viewport.gpfile.close()
+        # maintenance of the old file is abandoned; it's safe to stop anywhere
+        self.maintenance = None
         self.viewport = GPViewport(self.root, gpfile.GraphPaperFile(filename))
         self.root.title('%s - GraphPaper' % filename)
 
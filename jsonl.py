@@ -0,0 +1,178 @@
+'''
+Boards as JSON Lines: one JSON object per line.
+
+An export is a commit line, then a line per card, then a line per edge:
+
+  {"type": "commit", "id": <oid>, "cards": <count>, "edges": <count>, "time": ...}
+  {"type": "card", "id": <oid>, "text": ..., "x": ..., "y": ..., "w": ..., "h": ...}
+  {"type": "edge", "orig": <card id>, "dest": <card id>}
+
+The commit's time is null for commits from before they had one. Loading
+goes by the card and edge lines; the commit line is only information.
+
+Both ways go a line and a batch of objects at a time, so a dump of any
+size takes the same memory, apart from the commit's list of oids, which
+the commit object holds anyway. Cards imported with the same codec and
+hash keep their oids; otherwise edges are pointed at the new ones.
+'''
+
+import json
+import unittest
+
+import kvstore
+import model
+import storable
+
+
+class Error(Exception):
+    pass
+
+
+def line(obj):
+    return json.dumps(obj, sort_keys=True) + '\n'
+
+def export(datastore, oid, batch_size=1000):
+    "Generate the lines of commit oid's board"
+    commit = model.load_commit(datastore, oid)
+    edges = commit.get('edges', [])
+    yield line({'type': 'commit', 'id': oid, 'time': commit.get('time'),
+                'cards': len(commit['cards']), 'edges': len(edges)})
+    for objects, objtype in ((commit['cards'], 'card'), (edges, 'edge')):
+        for obj_oid, obj in model.load_objects(datastore, objects, batch_size):
+            obj.pop(model.objtype, None)
+            obj['type'] = objtype
+            if objtype == 'card':
+                obj['id'] = obj_oid
+            yield line(obj)
+
+def load(datastore, lines, parent=None, batch_size=1000):
+    '''
+    Store the cards and edges in lines, an iterable of JSON lines like
+    export() makes, and commit them on top of commit parent, along with
+    what's there already. Returns the new commit's oid.
+
+    Objects are stored batch_size at a time, and nothing is committed
+    until they all are.
+    '''
+    if parent is not None:
+        commit = model.load_commit(datastore, parent)
+        cards = list(commit['cards'])
+        edges = list(commit.get('edges', []))
+    else:
+        cards = []
+        edges = []
+    known = set(cards)
+    # {id in lines: oid here} for cards that didn't keep theirs
+    renamed = {}
+    # [(exported id, encoded card)] and [(encoded edge, None, info)] waiting
+    # to be stored
+    pending_cards = []
+    pending_edges = []
+    def flush():
+        keys = datastore.store_many([(encoded, None, (model.CARD_OBJTYPE, None))
+                                     for card_id, encoded in pending_cards])
+        for (card_id, encoded), key in zip(pending_cards, keys):
+            if card_id is not None and key != card_id:
+                renamed[card_id] = key
+            cards.append(key)
+            known.add(key)
+        edges.extend(datastore.store_many(pending_edges))
+        del pending_cards[:]
+        del pending_edges[:]
+    for number, text in enumerate(lines, 1):
+        if not text.strip():
+            continue
+        try:
+            fields = json.loads(text)
+            objtype = fields.pop('type')
+        except (ValueError, KeyError, AttributeError):
+            raise Error('line %d: not an exported object' % number)
+        if objtype == 'card':
+            obj = storable.Storable({model.objtype: model.CARD_OBJTYPE, 'text': '',
+                                     'x': 0, 'y': 0, 'w': model.MIN_CARD_SIZE,
+                                     'h': model.MIN_CARD_SIZE})
+            card_id = fields.pop('id', None)
+            obj.update(fields)
+            pending_cards.append((card_id, obj.encode(datastore.codec)))
+        elif objtype == 'edge':
+            if pending_cards:
+                # edges can refer to any card before them
+                flush()
+            obj = storable.Storable(fields)
+            obj[model.objtype] = model.EDGE_OBJTYPE
+            for end in ('orig', 'dest'):
+                obj[end] = renamed.get(obj.get(end), obj.get(end))
+                if obj[end] not in known:
+                    raise Error('line %d: edge to unknown card %s' % (number, obj[end]))
+            pending_edges.append((obj.encode(datastore.codec), None,
+                                  kvstore.object_info(obj)))
+        elif objtype != 'commit':
+            raise Error('line %d: unknown type "%s"' % (number, objtype))
+        if len(pending_cards) + len(pending_edges) >= batch_size:
+            flush()
+    flush()
+    return model.save_commit(datastore, cards, edges, parent)
+
+def dump(datastore, oid, out):
+    "Write commit oid's board to file object out. Returns the number of lines."
+    count = 0
+    for text in export(datastore, oid):
+        out.write(text)
+        count += 1
+    return count
+
+
+class TestJsonl(unittest.TestCase):
+
+    def store(self, codec='json'):
+        import kvbackend
+        import kvstore
+        return kvstore.KVStore(kvbackend.MemoryBackend(), codec=codec)
+
+    def setUp(self):
+        self.source = self.store()
+        g = model.Graph(self.source, None)
+        a = g.new_card(10, 20, 300, 400)
+        a.text = u'line one\nline two \u2603'
+        b = g.new_card(-5, 7)
+        g.new_edge(a, b)
+        self.head = g.commit()
+        self.lines = list(export(self.source, self.head, batch_size=1))
+
+    def testRoundTrip(self):
+        self.assertEqual(len(self.lines), 4)
+        target = self.store()
+        head = load(target, iter(self.lines), batch_size=1)
+        original = model.load_commit(self.source, self.head)
+        loaded = model.load_commit(target, head)
+        # same contents, same oids
+        self.assertEqual(loaded['cards'], original['cards'])
+        self.assertEqual(loaded['edges'], original['edges'])
+
+    def testOtherCodec(self):
+        target = self.store(codec='binary')
+        head = load(target, self.lines)
+        g = model.Graph(target, head)
+        self.assertEqual(g.cards[0].text, u'line one\nline two \u2603')
+        self.assertEqual((g.cards[1].x, g.cards[1].y), (-5, 7))
+        self.assertEqual((g.edges[0].orig, g.edges[0].dest), (g.cards[0], g.cards[1]))
+        # loading again adds to what's there
+        head = load(target, self.lines, head)
+        self.assertEqual(len(model.Graph(target, head).cards), 4)
+
+    def testUntimedCommit(self):
+        # commits from before commit times
+        commit = model.load_commit(self.source, self.head)
+        del commit['time']
+        old = commit.save(self.source)
+        lines = list(export(self.source, old))
+        self.assertEqual(json.loads(lines[0])['time'], None)
+        target = self.store()
+        self.assertEqual(model.load_commit(target, load(target, lines))['cards'],
+                         commit['cards'])
+
+    def testBadEdge(self):
+        self.assertRaises(Error, load, self.store(), self.lines[3:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,876 @@
+'''
+Storage backends for kvstore.KVStore.
+
+A backend maps keys (40 character hex strings) to stored values (byte
+strings) and knows nothing about hashing, codecs or compression; KVStore
+does all that on top. Every backend has the same interface:
+
+ * get(key) -> value or None
+ * get_many(keys) -> {key: value} for the keys that are present
+ * contains(key) -> bool
+ * present(keys) -> the set of keys that are present
+ * store_many([(key, value)]): store in one go, skipping keys already there
+ * replace_many([(key, value)]): overwrite values of existing keys
+ * delete_many(keys, generation=None)
+ * iterate(batch_size) -> generator of (key, value)
+ * keys(batch_size, generation=None) -> generator of keys
+ * generation() -> a number that only grows as values are stored, or None
+ * freshen(keys, generation=None) -> how many of keys are present
+
+A backend that sets typed also keeps each object's type, size and refs
+(see kvstore.object_info()) beside it, so objects can be listed by
+type without decoding them:
+
+ * store_typed([(key, value, objtype, size, refs)]): like store_many()
+ * set_types([(key, objtype, size, refs)]): for values stored without
+ * keys_of_type(objtype, batch_size) -> generator of keys
+ * untyped(batch_size) -> generator of (key, value) stored without
+
+iterate() and keys() must tolerate the backend being changed between the
+items they yield, since garbage collection deletes as it goes.
+
+A backend other processes may be writing to at the same time keeps a
+generation. Given one, keys() and delete_many() leave alone whatever was
+stored after it, and freshen() makes keys that are there already count as
+stored now, so garbage collection can skip what another process has stored
+but not committed yet; given a generation, only those stored up to it,
+as the rest are safe already. Backends without one ignore the argument.
+'''
+
+import binascii
+import mmap
+import os
+import re
+import struct
+import unittest
+import zlib
+
+tablename_re = re.compile(r'^[a-zA-Z][\w]*$')
+def is_valid_tablename(name):
+    return tablename_re.match(name) is not None
+
+# SQLiteBackend stores keys as 40 character hex text or raw 20 byte blobs
+KEY_FORMATS = ('text', 'blob')
+DEFAULT_KEY_FORMAT = 'text'
+
+
+class Backend(object):
+    '''
+    Default implementations of the derived parts of the interface.
+    '''
+
+    typed = False
+
+    def store_typed(self, rows):
+        self.store_many((row[0], row[1]) for row in rows)
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def contains(self, key):
+        return self.get(key) is not None
+
+    def present(self, keys):
+        return set(key for key in keys if self.contains(key))
+
+    def keys(self, batch_size=1000, generation=None):
+        for key, value in self.iterate(batch_size):
+            yield key
+
+    def generation(self):
+        return None
+
+    def freshen(self, keys, generation=None):
+        return len(self.present(keys))
+
+    def close(self):
+        pass
+
+
+def to_db(value):
+    "Wrap value so sqlite stores it as text only if it's JSON"
+    if value[:1] == '{':
+        return value
+    return buffer(value)
+
+def from_db(value):
+    "Undo to_db"
+    if isinstance(value, buffer):
+        return str(value)
+    return value
+
+
+class SQLiteBackend(Backend):
+    '''
+    Stores values in a table of a sqlite connection.
+
+    Keys are stored as hex text, or as raw 20 byte blobs with the 'blob'
+    key_format, halving the size of the primary key index. Values in the
+    json codec are stored as text, anything else as blobs.
+
+    The objtype, size and refs columns, with an index on objtype, make it
+    typed. Tables from before they existed get them added, empty, on
+    construction; rows stored without them are NULL there until set_types().
+
+    Its generation is the highest rowid. freshen() moves rows up to new
+    rowids, and the newest row is never deleted with a generation given,
+    so rowids aren't reused.
+
+    With create=False the objects table must exist already, and nothing
+    is written on construction, so it works on a read-only connection.
+    Such a connection to a table without the type columns isn't typed.
+    '''
+
+    TYPE_COLUMNS = (('objtype', 'text'), ('size', 'integer'), ('refs', 'text'))
+
+    def __init__(self, conn, tablename, key_format=DEFAULT_KEY_FORMAT, create=True):
+        self.conn = conn
+        if key_format not in KEY_FORMATS:
+            raise ValueError('invalid key format: "%s"' % key_format)
+        self.key_format = key_format
+        if is_valid_tablename(tablename):
+            self.tablename = tablename
+        else:
+            raise ValueError('invalid tablename: "%s"' % tablename)
+        if create:
+            # create the table if it doesn't exist with proper constraints
+            # I think we'll do the uniqueness checking manually
+            self.conn.execute('''
+                create table if not exists %s (
+                    key %s unique primary key not null,
+                    value text,
+                    objtype text,
+                    size integer,
+                    refs text)''' % (self.tablename, self.key_format))
+            self.add_type_columns()
+            self.conn.commit()
+        columns = [row[1] for row in self.conn.execute(
+            'pragma table_info(%s)' % self.tablename)]
+        self.typed = 'objtype' in columns
+        self.sql = self.make_sql(self.tablename)
+
+    def add_type_columns(self):
+        "Add the type columns and index to a table made without them"
+        columns = [row[1] for row in self.conn.execute(
+            'pragma table_info(%s)' % self.tablename)]
+        for name, column_type in self.TYPE_COLUMNS:
+            if name not in columns:
+                self.conn.execute('alter table %s add column %s %s' % (
+                    self.tablename, name, column_type))
+        self.conn.execute('create index if not exists %s_objtype on %s (objtype)' % (
+            self.tablename, self.tablename))
+
+    # statements are formatted once per table, and sqlite3 keeps each one
+    # prepared in its statement cache, keyed by the exact string
+    GET_MANY_CHUNK = 500
+
+    @classmethod
+    def make_sql(cls, tablename):
+        return {
+            'get': 'select value from %s where key = ?' % tablename,
+            'get_many': 'select key, value from %s where key in (%s)' % (
+                tablename, ','.join('?' * cls.GET_MANY_CHUNK)),
+            'present': 'select key from %s where key in (%s)' % (
+                tablename, ','.join('?' * cls.GET_MANY_CHUNK)),
+            'store': 'insert or ignore into %s (key, value) values (?, ?)' % tablename,
+            'store_typed': '''insert or ignore into %s (key, value, objtype, size, refs)
+                values (?, ?, ?, ?, ?)''' % tablename,
+            'set_types': 'update %s set objtype = ?, size = ?, refs = ? where key = ?' % tablename,
+            'replace': 'update %s set value = ? where key = ?' % tablename,
+            'delete': 'delete from %s where key = ?' % tablename,
+            'delete_older': '''delete from %s where key = ? and rowid <= ?
+                and rowid < (select max(rowid) from %s)''' % (tablename, tablename),
+            'freshen': '''update %s set rowid = (select max(rowid) from %s) + 1
+                where key = ? and rowid <= ?''' % (tablename, tablename),
+            'generation': 'select coalesce(max(rowid), 0) from %s' % tablename,
+            'set_key': 'update %s set key = ? where rowid = ?' % tablename,
+        }
+
+    def to_db_key(self, key):
+        "Convert a hex key to how it's stored. Raise TypeError if invalid."
+        if self.key_format == 'blob':
+            return buffer(binascii.unhexlify(key))
+        return key
+
+    def from_db_key(self, key):
+        if self.key_format == 'blob':
+            return binascii.hexlify(key)
+        return key
+
+    def get(self, key):
+        try:
+            key = self.to_db_key(key)
+        except TypeError:
+            # not hex, can't be a key
+            return None
+        result = self.conn.execute(self.sql['get'], (key,)).fetchone()
+        if result:
+            return from_db(result[0])
+        return None
+
+    def get_many(self, keys):
+        found = {}
+        for key, value in self.select_many('get_many', keys):
+            found[self.from_db_key(key)] = from_db(value)
+        return found
+
+    def present(self, keys):
+        return set(self.from_db_key(row[0]) for row in self.select_many('present', keys))
+
+    def select_many(self, statement, keys):
+        '''
+        Run one of the 'key in (...)' statements for keys, a chunk at a time,
+        and generate the rows.
+        '''
+        keys = list(keys)
+        size = self.GET_MANY_CHUNK
+        # stay well under sqlite's limit on parameters
+        for start in xrange(0, len(keys), size):
+            chunk = []
+            for key in keys[start:start + size]:
+                try:
+                    chunk.append(self.to_db_key(key))
+                except TypeError:
+                    pass
+            if not chunk:
+                continue
+            # pad short chunks by repeating a key, to reuse one statement
+            chunk.extend(chunk[-1:] * (size - len(chunk)))
+            for row in self.conn.execute(self.sql[statement], chunk):
+                yield row
+
+    def store_many(self, pairs):
+        self.conn.executemany(self.sql['store'],
+            ((self.to_db_key(key), to_db(value)) for key, value in pairs))
+        self.conn.commit()
+
+    def store_typed(self, rows):
+        self.conn.executemany(self.sql['store_typed'],
+            ((self.to_db_key(key), to_db(value), objtype, size, refs)
+             for key, value, objtype, size, refs in rows))
+        self.conn.commit()
+
+    def set_types(self, rows):
+        self.conn.executemany(self.sql['set_types'],
+            ((objtype, size, refs, self.to_db_key(key))
+             for key, objtype, size, refs in rows))
+        self.conn.commit()
+
+    def keys_of_type(self, objtype, batch_size=1000):
+        for rowid, key in self.rows('key', batch_size, 'objtype = ?', (objtype,)):
+            yield self.from_db_key(key)
+
+    def untyped(self, batch_size=1000):
+        for rowid, key, value in self.rows('key, value', batch_size, 'objtype is null'):
+            yield self.from_db_key(key), from_db(value)
+
+    def replace_many(self, pairs):
+        self.conn.executemany(self.sql['replace'],
+            ((to_db(value), self.to_db_key(key)) for key, value in pairs))
+        self.conn.commit()
+
+    def delete_many(self, keys, generation=None):
+        if generation is None:
+            self.conn.executemany(self.sql['delete'],
+                ((self.to_db_key(key),) for key in keys))
+        else:
+            self.conn.executemany(self.sql['delete_older'],
+                ((self.to_db_key(key), generation) for key in keys))
+        self.conn.commit()
+
+    def generation(self):
+        return self.conn.execute(self.sql['generation']).fetchone()[0]
+
+    def freshen(self, keys, generation=None):
+        if generation is None:
+            generation = self.generation()
+        cur = self.conn.executemany(self.sql['freshen'],
+            ((self.to_db_key(key), generation) for key in keys))
+        self.conn.commit()
+        if cur.rowcount == len(keys):
+            return cur.rowcount
+        # the rest were either newer than generation or already gone
+        return len(self.present(keys))
+
+    def rows(self, columns='key', batch_size=1000, where='1', parameters=()):
+        '''
+        Generate (rowid, <columns>) for every row as stored, or those
+        matching the where clause, fetching batch_size rows at a time. Safe
+        to change the table while iterating.
+        '''
+        sql = '''
+            select rowid, %s from %s where %s and rowid > ?
+            order by rowid limit ?''' % (columns, self.tablename, where)
+        last = -1
+        while True:
+            rows = self.conn.execute(sql, tuple(parameters) + (last, batch_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            last = rows[-1][0]
+
+    def iterate(self, batch_size=1000):
+        for rowid, key, value in self.rows('key, value', batch_size):
+            yield self.from_db_key(key), from_db(value)
+
+    def keys(self, batch_size=1000, generation=None):
+        if generation is None:
+            rows = self.rows('key', batch_size)
+        else:
+            rows = self.rows('key', batch_size, 'rowid <= ?', (generation,))
+        for rowid, key in rows:
+            yield self.from_db_key(key)
+
+    def convert_keys(self, key_format):
+        '''
+        Rewrite every stored key in key_format, in one transaction, and use
+        that format from now on.
+        '''
+        if key_format not in KEY_FORMATS:
+            raise ValueError('invalid key format: "%s"' % key_format)
+        if key_format == self.key_format:
+            return
+        if key_format == 'blob':
+            convert = lambda key: buffer(binascii.unhexlify(key))
+        else:
+            convert = lambda key: binascii.hexlify(key)
+        for rowid, key in self.rows('key'):
+            self.conn.execute(self.sql['set_key'], (convert(key), rowid))
+        self.conn.commit()
+        self.key_format = key_format
+
+class MemoryBackend(Backend):
+    '''
+    Keeps everything in a dict. Nothing is saved; good for tests,
+    benchmarks and scratch work.
+    '''
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def contains(self, key):
+        return key in self.data
+
+    def store_many(self, pairs):
+        for key, value in pairs:
+            self.data.setdefault(key, value)
+
+    def replace_many(self, pairs):
+        for key, value in pairs:
+            if key in self.data:
+                self.data[key] = value
+
+    def delete_many(self, keys, generation=None):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def iterate(self, batch_size=1000):
+        # snapshot the keys, so deleting while iterating is fine
+        for key in list(self.data):
+            value = self.data.get(key)
+            if value is not None:
+                yield key, value
+
+class LogBackend(Backend):
+    '''
+    Appends values to a log file, and reads them back through mmap.
+
+    Nothing in the log is ever overwritten, which makes writes cheap. The
+    log starts with MAGIC and a random 8 byte generation, then each record
+    is a one byte type, a 20 byte raw key, a 4 byte big endian length, the
+    crc32 of the data and the data:
+     * OBJECT_RECORD: a stored value
+     * DELETE_RECORD: the key has been deleted (the data is empty)
+    A key's newest record wins, and records of other types are skipped.
+
+    Where each value lives is kept in an open addressing hash table in
+    <filename>.idx, which is mmapped and searched in place rather than
+    loaded. The index says how much of the log it covers; records written
+    since are in self.recent until checkpoint() rewrites it, which happens
+    every CHECKPOINT_RECORDS records and on close(). So after a crash the
+    index is merely behind, and opening scans the log from where it stops,
+    cutting off a record the crash tore. An index that's missing or belongs
+    to another generation of the log is rebuilt from a full scan.
+
+    Deleted and replaced values take up space until compact().
+    '''
+
+    MAGIC = 'GPLOG2\n'
+    INDEX_MAGIC = 'GPIDX2\n\0'
+    OBJECT_RECORD = 'o'
+    DELETE_RECORD = 'd'
+    log_header = struct.Struct('>7s8s')
+    record_header = struct.Struct('>c20sII')
+    # magic, log generation, log length covered, slot count
+    index_header = struct.Struct('>8s8sQQ')
+    # raw key, offset of data (0 for an empty slot), length
+    index_slot = struct.Struct('>20sQI')
+    slot_hash = struct.Struct('>Q')
+
+    CHECKPOINT_RECORDS = 20000
+
+    def __init__(self, filename, sync=False):
+        '''
+        Open or create the log at filename. With sync, every write is
+        fsynced before returning.
+        '''
+        self.filename = filename
+        self.index_filename = filename + '.idx'
+        self.sync = sync
+        self.open()
+
+    def open(self):
+        self.file = open(self.filename, 'a+b')
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() == 0:
+            self.file.write(self.log_header.pack(self.MAGIC, os.urandom(8)))
+            self.file.flush()
+        self.map = None
+        self.map_size = 0
+        self.remap()
+        self.log_generation = self.log_header.unpack_from(self.map)[1]
+        # {raw key: (offset of data, length), or None if deleted} for the
+        # records the index file doesn't cover
+        self.recent = {}
+        covered = self.load_index()
+        end = self.scan(covered)
+        if end < self.map_size:
+            # torn by a crash; anything appended after it would be lost
+            self.file.truncate(end)
+            self.remap()
+        if self.index_map is None:
+            self.checkpoint()
+
+    def remap(self):
+        "Make sure everything written so far is visible through self.map"
+        self.file.flush()
+        size = os.fstat(self.file.fileno()).st_size
+        if size != self.map_size:
+            # the old map isn't closed: buffers from view() may still use it
+            self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+            self.map_size = size
+        if size < self.log_header.size or self.map[:len(self.MAGIC)] != self.MAGIC:
+            raise IOError('%s is not a GraphPaper object log' % self.filename)
+
+    def load_index(self):
+        '''
+        Map the index file if it's there and matches the log, and return
+        how much of the log it covers.
+        '''
+        self.index_map = None
+        self.index_slots = 0
+        start = self.log_header.size
+        try:
+            with open(self.index_filename, 'rb') as f:
+                index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return start
+        if len(index_map) < self.index_header.size:
+            return start
+        magic, generation, covered, slots = self.index_header.unpack_from(index_map)
+        size = self.index_header.size + slots * self.index_slot.size
+        if (magic != self.INDEX_MAGIC or generation != self.log_generation or
+                covered > self.map_size or len(index_map) != size or
+                slots & (slots - 1)):
+            return start
+        self.index_map = index_map
+        self.index_slots = slots
+        return covered
+
+    def index_lookup(self, index_map, slots, raw_key):
+        "Location of raw_key in the given index, or None"
+        if not slots:
+            return None
+        mask = slots - 1
+        # keys are hashes already, so their first bytes will do
+        i = self.slot_hash.unpack_from(raw_key)[0] & mask
+        while True:
+            key, offset, length = self.index_slot.unpack_from(
+                index_map, self.index_header.size + i * self.index_slot.size)
+            if offset == 0:
+                return None
+            if key == raw_key:
+                return offset, length
+            i = (i + 1) & mask
+
+    def locate(self, raw_key):
+        "(offset of data, length) of the value for raw_key, or None"
+        if raw_key is None:
+            return None
+        if raw_key in self.recent:
+            return self.recent[raw_key]
+        return self.index_lookup(self.index_map, self.index_slots, raw_key)
+
+    def locations(self):
+        '''
+        Generate (raw key, location) for every value. The index being
+        searched is held on to, so a checkpoint meanwhile does no harm.
+        '''
+        index_map, slots = self.index_map, self.index_slots
+        for i in xrange(slots):
+            raw_key, offset, length = self.index_slot.unpack_from(
+                index_map, self.index_header.size + i * self.index_slot.size)
+            if offset:
+                location = self.locate(raw_key)
+                if location is not None:
+                    yield raw_key, location
+        for raw_key in list(self.recent):
+            if self.index_lookup(index_map, slots, raw_key) is None:
+                location = self.locate(raw_key)
+                if location is not None:
+                    yield raw_key, location
+
+    def checkpoint(self):
+        '''
+        Write a new index file covering the whole log, and empty
+        self.recent. The log is fsynced first, so the index never claims
+        more than is on disk.
+        '''
+        self.remap()
+        os.fsync(self.file.fileno())
+        live = list(self.locations())
+        slots = 1
+        while slots * 3 < len(live) * 4:
+            slots *= 2
+        slots_start = self.index_header.size
+        table = bytearray(slots_start + slots * self.index_slot.size)
+        self.index_header.pack_into(table, 0, self.INDEX_MAGIC, self.log_generation,
+                                    self.map_size, slots)
+        used = bytearray(slots)
+        mask = slots - 1
+        for raw_key, (offset, length) in live:
+            i = self.slot_hash.unpack_from(raw_key)[0] & mask
+            while used[i]:
+                i = (i + 1) & mask
+            used[i] = 1
+            self.index_slot.pack_into(table, slots_start + i * self.index_slot.size,
+                                      raw_key, offset, length)
+        temp = self.index_filename + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(table)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, self.index_filename)
+        self.recent = {}
+        self.load_index()
+
+    def scan(self, offset):
+        '''
+        Index the records from offset to the end of the log, and return
+        where the last intact record ends.
+        '''
+        self.remap()
+        header_size = self.record_header.size
+        while offset + header_size <= self.map_size:
+            rectype, raw_key, length, crc = self.record_header.unpack_from(self.map, offset)
+            data_offset = offset + header_size
+            if data_offset + length > self.map_size:
+                break
+            if zlib.crc32(buffer(self.map, data_offset, length)) & 0xffffffff != crc:
+                break
+            self.index_record(rectype, raw_key, data_offset, length)
+            offset = data_offset + length
+        return offset
+
+    def index_record(self, rectype, raw_key, data_offset, length):
+        if rectype == self.OBJECT_RECORD:
+            self.recent[raw_key] = (data_offset, length)
+        elif rectype == self.DELETE_RECORD:
+            self.recent[raw_key] = None
+
+    def pack_record(self, rectype, raw_key, data):
+        return self.record_header.pack(rectype, raw_key, len(data),
+                                       zlib.crc32(data) & 0xffffffff)
+
+    def append(self, records):
+        '''
+        Write [(type, raw key, data)] to the end of the log and index them.
+        '''
+        if not records:
+            return
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        chunks = []
+        for rectype, raw_key, data in records:
+            header = self.pack_record(rectype, raw_key, data)
+            chunks.append(header)
+            chunks.append(data)
+            self.index_record(rectype, raw_key, offset + len(header), len(data))
+            offset += len(header) + len(data)
+        self.file.write(''.join(chunks))
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        if len(self.recent) >= self.CHECKPOINT_RECORDS:
+            self.checkpoint()
+
+    def view(self, location):
+        '''
+        A buffer over the data at location, straight out of the map, with
+        no copying. It stays valid after the log grows or is closed.
+        '''
+        offset, length = location
+        if offset + length > self.map_size:
+            self.remap()
+        return buffer(self.map, offset, length)
+
+    def read(self, location):
+        offset, length = location
+        if offset + length > self.map_size:
+            self.remap()
+        return self.map[offset:offset + length]
+
+    @staticmethod
+    def raw_key(key):
+        "Raw form of a hex key, or None if it isn't one"
+        try:
+            raw = binascii.unhexlify(key)
+        except TypeError:
+            return None
+        if len(raw) != 20:
+            return None
+        return raw
+
+    def get(self, key):
+        location = self.locate(self.raw_key(key))
+        if location is None:
+            return None
+        return self.read(location)
+
+    def get_view(self, key):
+        "Like get(), but returns a buffer from view()"
+        location = self.locate(self.raw_key(key))
+        if location is None:
+            return None
+        return self.view(location)
+
+    def contains(self, key):
+        return self.locate(self.raw_key(key)) is not None
+
+    def store_many(self, pairs):
+        records = []
+        seen = set()
+        for key, value in pairs:
+            raw = self.raw_key(key)
+            if raw is None:
+                raise ValueError('invalid key: %r' % key)
+            if raw not in seen and self.locate(raw) is None:
+                seen.add(raw)
+                records.append((self.OBJECT_RECORD, raw, value))
+        self.append(records)
+
+    def replace_many(self, pairs):
+        self.append([(self.OBJECT_RECORD, self.raw_key(key), value)
+                     for key, value in pairs if self.contains(key)])
+
+    def delete_many(self, keys, generation=None):
+        self.append([(self.DELETE_RECORD, self.raw_key(key), '')
+                     for key in keys if self.contains(key)])
+
+    def iterate(self, batch_size=1000):
+        for raw_key, location in self.locations():
+            yield binascii.hexlify(raw_key), self.read(location)
+
+    def keys(self, batch_size=1000, generation=None):
+        for raw_key, location in self.locations():
+            yield binascii.hexlify(raw_key)
+
+    def size(self):
+        self.remap()
+        return self.map_size
+
+    def compact(self, keep=None):
+        '''
+        Rewrite the log with nothing but its current values, dropping the
+        deleted and replaced ones. If keep is given, only values whose keys
+        are in it are kept, so passing the oids reachable from the heads
+        (see retention.mark_reachable) drops unreachable objects too.
+
+        The new log is written beside the old one and renamed over it, so a
+        crash part way leaves the old log as it was. Returns the number of
+        bytes freed.
+        '''
+        before = self.size()
+        temp = self.filename + '.compact'
+        with open(temp, 'wb') as out:
+            out.write(self.log_header.pack(self.MAGIC, os.urandom(8)))
+            for raw_key, location in self.locations():
+                if keep is not None and binascii.hexlify(raw_key) not in keep:
+                    continue
+                data = self.view(location)
+                out.write(self.pack_record(self.OBJECT_RECORD, raw_key, data))
+                out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        self.file.close()
+        os.rename(temp, self.filename)
+        # the new generation makes the old index invalid; open rebuilds it
+        self.open()
+        return before - self.map_size
+
+    def close(self):
+        if self.recent:
+            self.checkpoint()
+        self.map = None
+        self.index_map = None
+        self.file.close()
+
+
+class TestBackends(unittest.TestCase):
+    '''
+    Every backend should behave the same.
+    '''
+
+    def backends(self):
+        import sqlite3
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            yield SQLiteBackend(sqlite3.connect(':memory:'), 'objects')
+            yield SQLiteBackend(sqlite3.connect(':memory:'), 'objects', 'blob')
+            yield MemoryBackend()
+            log = LogBackend(os.path.join(directory, 'test.gplog'))
+            yield log
+            log.close()
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def testContract(self):
+        a, b, c = 'a' * 40, 'b' * 40, 'c' * 40
+        for backend in self.backends():
+            backend.store_many([(a, '{"x":1}'), (b, '\x01binary\x00')])
+            backend.store_many([(a, 'ignored, a exists')])
+            self.assertEqual(backend.get(a), '{"x":1}')
+            self.assertEqual(backend.get(b), '\x01binary\x00')
+            self.assertEqual(backend.get(c), None)
+            self.assertEqual(backend.get('not a key'), None)
+            self.assertTrue(backend.contains(a))
+            self.assertFalse(backend.contains(c))
+            self.assertEqual(backend.get_many([a, c]), {a: '{"x":1}'})
+            backend.replace_many([(b, '\x02packed')])
+            self.assertEqual(backend.get(b), '\x02packed')
+            self.assertEqual(sorted(backend.keys()), [a, b])
+            for key in backend.keys():
+                backend.delete_many([key])
+            self.assertEqual(list(backend.iterate()), [])
+
+    def testStoreWorksOnAll(self):
+        import kvstore
+        for backend in self.backends():
+            store = kvstore.KVStore(backend, compression='zlib')
+            key = store.store('{"text":"%s"}' % ('x' * 100))
+            self.assertEqual(store.get(key), '{"text":"%s"}' % ('x' * 100))
+            self.assertEqual(store.store('{"text":"%s"}' % ('x' * 100)), key)
+            generation = store.generation()
+            self.assertEqual(list(store.keys(generation=generation)), [key])
+            store.delete_many([key], generation)
+
+    def testTypes(self):
+        import sqlite3
+        import kvstore
+        import model
+        conn = sqlite3.connect(':memory:')
+        # a table from before the type columns
+        conn.execute('create table objects (key text unique primary key not null, value text)')
+        old = kvstore.KVStore(MemoryBackend())
+        g = model.Graph(old, None)
+        a, b = g.new_card(), g.new_card()
+        a.text, b.text = 'a', 'b'
+        g.new_edge(a, b)
+        first = g.commit()
+        conn.executemany('insert into objects values (?, ?)', old.iterate())
+        conn.commit()
+        reader = SQLiteBackend(conn, 'objects', create=False)
+        self.assertFalse(reader.typed)
+        self.assertEqual(kvstore.KVStore(reader).get(first), old.get(first))
+        store = kvstore.KVStore(conn, 'objects')
+        self.assertTrue(store.backend.typed)
+        g = model.Graph(store, first)
+        g.new_card()
+        second = g.commit()
+        self.assertEqual(list(old.keys_of_type('commit')), [first])
+        self.assertEqual(sorted(store.keys_of_type('commit')), sorted([first, second]))
+        self.assertEqual(list(store.backend.keys_of_type('commit')), [second])
+        self.assertEqual(list(store.backfill_types(batch_size=2)), [2, 4])
+        self.assertEqual(list(store.backend.untyped()), [])
+        self.assertEqual(len(list(store.backend.keys_of_type('card'))), 3)
+        edge = list(store.keys_of_type('edge'))[0]
+        self.assertEqual(conn.execute('select refs from objects where key = ?', (edge,)).fetchone(),
+                         ('%s %s' % (a.saved_oid, b.saved_oid),))
+        # objects are typed from what the caller says, or not at all
+        plain = store.store('{"objtype":"card"}')
+        self.assertEqual([key for key, value in store.backend.untyped()], [plain])
+
+    def testGeneration(self):
+        import sqlite3
+        a, b, c = 'a' * 40, 'b' * 40, 'c' * 40
+        backend = SQLiteBackend(sqlite3.connect(':memory:'), 'objects')
+        self.assertEqual(backend.generation(), 0)
+        backend.store_many([(a, 'a'), (b, 'b')])
+        generation = backend.generation()
+        # c is new, and a freshened is as new as c
+        backend.store_many([(c, 'c')])
+        self.assertEqual(backend.freshen([a, 'd' * 40]), 1)
+        self.assertEqual(list(backend.keys(generation=generation)), [b])
+        self.assertEqual(list(backend.keys()), [b, c, a])
+        # given a generation, only rows up to it move
+        self.assertEqual(backend.freshen([c, a, 'd' * 40], generation), 2)
+        self.assertEqual(list(backend.keys()), [b, c, a])
+        self.assertEqual(backend.freshen([b, c], generation), 2)
+        self.assertEqual(list(backend.keys()), [c, a, b])
+        # the newest is kept, whatever the generation
+        backend.delete_many([a, b, c], backend.generation())
+        self.assertEqual(list(backend.keys()), [b])
+        backend.store_many([(a, 'a')])
+        self.assertTrue(backend.generation() > generation + 1)
+
+    def testLogRecovery(self):
+        import tempfile
+        a, b, c = 'a' * 40, 'b' * 40, 'c' * 40
+        filename = os.path.join(tempfile.mkdtemp(), 'test.gplog')
+        log = LogBackend(filename)
+        log.store_many([(a, 'value a'), (b, 'value b')])
+        log.checkpoint()
+        log.store_many([(c, 'value c')])
+        log.delete_many([a])
+        # crash: the index misses the last records, and one is torn
+        log.file.write(log.pack_record(LogBackend.OBJECT_RECORD, '\xdd' * 20, 'lost') + 'lo')
+        log.file.flush()
+        size = log.size()
+        log = LogBackend(filename)
+        self.assertEqual(log.size(), size - log.record_header.size - 2)
+        self.assertEqual(sorted(log.keys()), [b, c])
+        self.assertEqual(log.get(c), 'value c')
+        log.close()
+        # a lost index is rebuilt
+        os.remove(filename + '.idx')
+        log = LogBackend(filename)
+        self.assertEqual(sorted(log.keys()), [b, c])
+        self.assertEqual(str(log.get_view(b)), 'value b')
+        log.store_many([(a, 'value a again')])
+        log.replace_many([(b, 'value b again')])
+        freed = log.compact(keep=set([a, b]))
+        self.assertTrue(freed > 0)
+        self.assertEqual(sorted(log.keys()), [a, b])
+        log.close()
+        log = LogBackend(filename)
+        self.assertEqual(log.get(b), 'value b again')
+        log.close()
+        directory = os.path.dirname(filename)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,73 +1,324 @@
 
 import hashlib
-import re
+import zlib
+
+import kvbackend
+import objcodec
 
 def sha1(dat):
     hasher = hashlib.sha1()
     hasher.update(dat)
     return hasher.hexdigest()
 
-tablename_re = re.compile(r'^[a-zA-Z][\w]*$')
-def is_valid_tablename(name):
-    return tablename_re.match(name) is not None
+# hash functions keys can be made with, by the name saved in file configs.
+# All of them must make 160 bit keys. Python 2's hashlib has nothing of that
+# size faster than SHA1 (BLAKE2 needs Python 3.6), so that's the only one.
+HASHES = {'sha1': sha1}
+DEFAULT_HASH = 'sha1'
+
+def get_hash(name):
+    '''
+    Return the hash function called name. Raise ValueError if it's unknown.
+    '''
+    try:
+        return HASHES[name]
+    except KeyError:
+        raise ValueError('unknown hash: "%s"' % name)
+
+# how SQLiteBackend stores keys; see kvbackend
+KEY_FORMATS = kvbackend.KEY_FORMATS
+DEFAULT_KEY_FORMAT = kvbackend.DEFAULT_KEY_FORMAT
+
+# Values can be stored compressed. Stored values then start with a header
+# byte that objcodec data never starts with ('{' and minibin.FORMAT):
+# ZLIB_HEADER is followed by plain zlib data.
+ZLIB_HEADER = '\x02'
+COMPRESSIONS = ('none', 'zlib')
+DEFAULT_COMPRESSION = 'none'
+is_valid_tablename = kvbackend.is_valid_tablename
+
+def object_info(obj):
+    '''
+    Return (objtype, refs) of a decoded object as a typed backend keeps
+    them: its objtype ('' if it has none), and the oids it points at that
+    aren't in a list, space separated: a commit's parent, an edge's ends.
+    refs is None if there are none.
+    '''
+    objtype = obj.get('objtype') or ''
+    if objtype == 'commit':
+        refs = [obj.get('parent')]
+    elif objtype == 'edge':
+        refs = [obj.get('orig'), obj.get('dest')]
+    else:
+        refs = []
+    return objtype, ' '.join(ref for ref in refs if ref) or None
 
 class KVStore(object):
     '''
-    Puts a basic hash-based key-value interface on sqlite
+    Puts a basic hash-based key-value interface on a storage backend
 
     Two basic operations: get(key) -> value and store(value) -> key.
-    Underneath, it SHA1s the data to get the key.
+    Underneath, it SHA1s (or whatever hash_name says) the data to get the
+    key. Where the data goes is up to the backend (see kvbackend); given a
+    sqlite connection and table name it uses a kvbackend.SQLiteBackend.
+
+    The codec member is the objcodec module Storables are saved with.
+
+    With compression set to 'zlib', values are stored compressed whenever
+    that makes them smaller. Keys are still hashes of the uncompressed
+    values, and get() always returns uncompressed values.
     '''
 
-    def __init__(self, conn, tablename):
+    def __init__(self, backend, tablename=None, codec=objcodec.DEFAULT_CODEC,
+                 hash_name=DEFAULT_HASH, key_format=DEFAULT_KEY_FORMAT,
+                 compression=DEFAULT_COMPRESSION):
         '''
-        Use the named table in the sqlite connection to store values.
-        Create the table if necessary.
+        Store values in backend. If tablename is given, backend is a sqlite
+        connection, and the named table in it is used (and created if
+        necessary) with key_format.
         '''
-        self.conn = conn
-        if is_valid_tablename(tablename):
-            self.tablename = tablename
-        else:
-            raise ValueError('invalid tablename: "%s"' % tablename)
-        # create the table if it doesn't exist with proper constraints
-        # I think we'll do the uniqueness checking manually
-        self.conn.execute('''
-            create table if not exists %s (
-                key text unique primary key not null,
-                value text)''' % self.tablename)
-        self.conn.commit()
+        if tablename is not None:
+            backend = kvbackend.SQLiteBackend(backend, tablename, key_format)
+        self.backend = backend
+        self.codec = objcodec.get_codec(codec)
+        self.hash_name = hash_name
+        self.hash = get_hash(hash_name)
+        self.check_compression(compression)
+        self.compression = compression
+        # rows stored after this can't be garbage collected yet, and don't
+        # need freshening; see gpfile.Session
+        self.safe_generation = None
 
     def get(self, key):
         '''
         Get the blob referred to or None
         '''
-        cur = self.conn.execute('''
-            select value from %s where key = ?
-        ''' % self.tablename, (key,))
-        result = cur.fetchone()
-        if result:
-            return result[0]
+        value = self.backend.get(key)
+        if value is not None:
+            return self.decompress(value)
         return None
 
-    def store(self, value):
+    def get_many(self, keys):
+        '''
+        Return {key: blob} for the keys that are present
+        '''
+        found = self.backend.get_many(keys)
+        for key, value in found.iteritems():
+            found[key] = self.decompress(value)
+        return found
+
+    def contains(self, key):
+        return self.backend.contains(key)
+
+    def store(self, value, key=None, info=None):
         '''
         Store a blob, return the key. Raise ValueError if there's a collision.
         Hope springs eternal...
+
+        If the caller already knows the key for value, it can pass it to
+        skip hashing. Likewise info, the object_info() of value, which a
+        typed backend keeps; without it the value is stored untyped, for
+        backfill_types() to fill in.
         '''
-        key = sha1(value)
-        cur_value = self.get(key)
-        if cur_value is not None:
-            if cur_value == value:
-                return key
-            else:
-                raise ValueError('holy crap, SHA1 collision! """%s""", """%s"""' % (repr(value), repr(cur_value)))
-        # key is new
-        self.conn.execute('''
-            insert into %s values (?, ?)
-        ''' % self.tablename, (key, value))
-        self.conn.commit()
-        return key
+        return self.store_many([(value, key, info)])[0]
+
+    def store_many(self, items):
+        '''
+        Store many blobs in one go. items is a list of (blob, key or None),
+        or (blob, key or None, info or None), as for store(). Returns the
+        list of keys.
+        '''
+        keys = []
+        infos = {}
+        for item in items:
+            value, key = item[:2]
+            if key is None:
+                key = self.hash(value)
+            keys.append(key)
+            if len(item) > 2 and item[2] is not None:
+                infos[key] = item[2]
+        existing = self.get_many(keys)
+        new = {}
+        for key, item in zip(keys, items):
+            value = item[0]
+            cur_value = existing.get(key)
+            if cur_value is None:
+                new[key] = value
+            elif cur_value != value:
+                raise ValueError('holy crap, %s collision! """%s""", """%s"""' % (self.hash_name, repr(value), repr(cur_value)))
+        # what's here already may be garbage, about to be collected by
+        # another process: make it as new as what we store now
+        if existing and self.backend.freshen(
+                existing, self.safe_generation) < len(existing):
+            # too late for some
+            present = self.backend.present(existing)
+            for key, value in existing.iteritems():
+                if key not in present:
+                    new[key] = value
+        typed = [(key, value) for key, value in new.iteritems() if key in infos]
+        if typed and self.backend.typed:
+            self.backend.store_typed(
+                (key, self.compress(value), infos[key][0], len(value), infos[key][1])
+                for key, value in typed)
+            for key, value in typed:
+                del new[key]
+        if new:
+            self.backend.store_many(
+                (key, self.compress(value)) for key, value in new.iteritems())
+        return keys
+
+    def describe(self, value):
+        '''
+        Return (objtype, size, refs) of uncompressed value as a typed backend
+        keeps them (see object_info()) by decoding it, for values stored
+        without them. Those that aren't objects get objtype ''.
+        '''
+        try:
+            obj = objcodec.decode(value)
+        except ValueError:
+            obj = None
+        if not isinstance(obj, dict):
+            return '', len(value), None
+        objtype, refs = object_info(obj)
+        return objtype, len(value), refs
+
+    def keys_of_type(self, objtype, batch_size=1000):
+        '''
+        Generate the keys of the objects of objtype. With a typed backend
+        that's an index lookup, apart from anything not yet backfilled;
+        otherwise everything gets decoded.
+        '''
+        if self.backend.typed:
+            for key in self.backend.keys_of_type(objtype, batch_size):
+                yield key
+            untyped = self.backend.untyped(batch_size)
+        else:
+            untyped = self.backend.iterate(batch_size)
+        for key, value in untyped:
+            if self.describe(self.decompress(value))[0] == objtype:
+                yield key
+
+    def backfill_types(self, batch_size=1000):
+        '''
+        Fill in the types of objects stored before the backend kept them,
+        or copied in by copy_from(). A generator: yields the number done
+        after each batch.
+        '''
+        if not self.backend.typed:
+            return
+        done = 0
+        rows = []
+        for key, value in self.backend.untyped(batch_size):
+            rows.append((key,) + self.describe(self.decompress(value)))
+            if len(rows) >= batch_size:
+                self.backend.set_types(rows)
+                done += len(rows)
+                rows = []
+                yield done
+        if rows:
+            self.backend.set_types(rows)
+            done += len(rows)
+            yield done
+
+    def delete_many(self, keys, generation=None):
+        '''
+        Remove the values for keys, or those stored up to generation. Only
+        for garbage collection; nothing reachable should ever be deleted.
+        '''
+        self.backend.delete_many(keys, generation)
+
+    def keys(self, batch_size=1000, generation=None):
+        '''
+        Generate all keys, or those stored up to generation, fetching
+        batch_size at a time. Safe to delete keys while iterating.
+        '''
+        return self.backend.keys(batch_size, generation)
+
+    def generation(self):
+        '''
+        A number that only grows as objects are stored, or None if the
+        backend doesn't keep one (see kvbackend).
+        '''
+        return self.backend.generation()
+
+    def iterate(self, batch_size=1000):
+        "Generate (key, blob) for everything stored"
+        for key, value in self.backend.iterate(batch_size):
+            yield key, self.decompress(value)
 
     def getall(self):
-        return list(self.conn.execute('select * from %s' % self.tablename))
+        return list(self.iterate())
 
+    def check_compression(self, compression):
+        if compression not in COMPRESSIONS:
+            raise ValueError('invalid compression: "%s"' % compression)
+
+    def compress(self, value):
+        '''
+        Return value as it should be stored: compressed if that's on and
+        makes it smaller, otherwise as is.
+        '''
+        if self.compression == 'none':
+            return value
+        packed = ZLIB_HEADER + zlib.compress(value, zlib.Z_BEST_COMPRESSION)
+        if len(packed) < len(value):
+            return packed
+        return value
+
+    def decompress(self, stored):
+        "Undo compress()"
+        if stored[:1] == ZLIB_HEADER:
+            try:
+                return zlib.decompress(stored[1:])
+            except zlib.error:
+                raise ValueError('corrupt compressed value')
+        return stored
+
+    def copy_from(self, source, keys):
+        '''
+        Copy the values of keys from KVStore source just as they're stored,
+        without decompressing, decoding or hashing them. Both must use the
+        same hash. Returns the keys that weren't found in source.
+        '''
+        if source.hash_name != self.hash_name:
+            raise ValueError('can\'t copy %s keyed objects into a %s keyed store' % (
+                source.hash_name, self.hash_name))
+        keys = list(keys)
+        found = source.backend.get_many(keys)
+        # left untyped, as they're not decoded; backfill_types() fills them in
+        self.backend.store_many(found.iteritems())
+        return [key for key in keys if key not in found]
+
+    def recompress(self, compression):
+        '''
+        Rewrite every stored value with compression (from COMPRESSIONS),
+        and use it from now on. Keys don't change.
+        '''
+        self.check_compression(compression)
+        self.compression = compression
+        changed = []
+        for key, value in self.backend.iterate():
+            raw = self.decompress(value)
+            packed = self.compress(raw)
+            # uncompressed values that stay that way can be left alone
+            if packed is not raw or value is not raw:
+                changed.append((key, packed))
+            if len(changed) >= 1000:
+                self.backend.replace_many(changed)
+                changed = []
+        self.backend.replace_many(changed)
+
+    def stats(self):
+        '''
+        Return a dict of counts and sizes: objects, stored_bytes, raw_bytes
+        and compressed (how many objects are stored compressed).
+        '''
+        stats = dict(objects=0, stored_bytes=0, raw_bytes=0, compressed=0)
+        for key, value in self.backend.iterate():
+            raw = self.decompress(value)
+            stats['objects'] += 1
+            stats['stored_bytes'] += len(value)
+            stats['raw_bytes'] += len(raw)
+            if raw is not value:
+                stats['compressed'] += 1
+        return stats
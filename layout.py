@@ -0,0 +1,317 @@
+'''
+Automatic layout: spreading cards out so connected ones are near each
+other and nothing overlaps.
+
+layout() is a force-directed layout done on whole NumPy arrays at a time:
+card boxes go in as an (n, 4) array, edges as an (m, 2) array of card
+numbers, and the new positions come out. Cards push each other apart,
+harder the more edges they have, edges pull their ends together, and a
+little gravity keeps it all from drifting off, much as in ForceAtlas2.
+Repulsion is grid-based, so each step takes time linear in the number of
+cards and edges rather than quadratic: cards near each other, found by
+sorting them into grid cells, push on each other exactly, and the cards in
+each cell of a coarse grid over them all push on those in other cells as
+one mass at their centroid, as in Barnes and Hut's method cut to one level.
+Cards are treated as discs as wide as their diagonals, so big cards get
+more room, and a last pass pushes apart any boxes still overlapping.
+
+Cards can be held still: they push and pull the others but don't move,
+which is how a selection is laid out among the rest.
+
+Needs NumPy, which is optional; without it layout() raises Error.
+'''
+
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import model
+
+ITERATIONS = 100
+# space left between boxes by remove_overlaps()
+GAP = 20
+OVERLAP_PASSES = 200
+# how hard edges pull, against how hard cards push
+ATTRACTION = 5
+# the coarse grid is FAR_CELLS by FAR_CELLS
+FAR_CELLS = 12
+# cards worked out at once against every coarse cell
+FAR_CHUNK = 4096
+
+
+class Error(Exception):
+    pass
+
+
+def near_pairs(points, cell_size):
+    '''
+    Return arrays (i, j) numbering every two of points, an (n, 2) array,
+    in the same or next to each other cells of a grid of cell_size: every
+    two closer than cell_size, and some further apart. Each pair comes up
+    once.
+    '''
+    cells = numpy.floor(points / cell_size).astype(numpy.int64)
+    cells -= cells.min(axis=0)
+    # a spare column each side, so cells next to each other differ by 1
+    width = cells[:, 0].max() + 3
+    keys = cells[:, 0] + 1 + (cells[:, 1] + 1) * width
+    order = numpy.argsort(keys, kind='mergesort')
+    # the occupied cells, and where their points start in order
+    occupied, starts, counts = numpy.unique(keys[order], return_index=True,
+                                            return_counts=True)
+    firsts = []
+    seconds = []
+    # half the neighbouring cells, so each pair of cells comes up once
+    for dx, dy in ((0, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+        target = occupied + dx + dy * width
+        found = numpy.minimum(numpy.searchsorted(occupied, target), len(occupied) - 1)
+        a = numpy.nonzero(occupied[found] == target)[0]
+        b = found[a]
+        # every point of cell a with every point of cell b
+        sizes = counts[a] * counts[b]
+        total = sizes.sum()
+        if not total:
+            continue
+        within = numpy.arange(total) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        across = numpy.repeat(counts[b], sizes)
+        first = order[numpy.repeat(starts[a], sizes) + within // across]
+        second = order[numpy.repeat(starts[b], sizes) + within % across]
+        if (dx, dy) == (0, 0):
+            keep = first < second
+            first, second = first[keep], second[keep]
+        firsts.append(first)
+        seconds.append(second)
+    if not firsts:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty
+    return numpy.concatenate(firsts), numpy.concatenate(seconds)
+
+def need_numpy():
+    if numpy is None:
+        raise Error('automatic layout needs NumPy')
+
+def spread(centers, movable, scale, random):
+    '''
+    Scatter the movable cards at random over a square big enough for them
+    around where they are, if they're crowded into less than that.
+    '''
+    moving = centers[movable]
+    side = scale * numpy.sqrt(len(moving))
+    extent = moving.max(axis=0) - moving.min(axis=0)
+    if extent[0] * extent[1] >= side * side / 4:
+        return
+    middle = moving.mean(axis=0)
+    centers[movable] = middle + (random.random_sample(moving.shape) - 0.5) * side
+
+def layout(boxes, ends, movable=None, iterations=ITERATIONS, seed=0):
+    '''
+    Lay out cards: boxes is an (n, 4) array of each card's x, y, w and h,
+    ends an (m, 2) array of the card numbers at either end of each edge.
+    movable is a boolean array of the cards that may move; all of them by
+    default. Returns an (n, 2) float array of the cards' new x and y.
+    '''
+    need_numpy()
+    boxes = numpy.asarray(boxes, dtype=float).reshape(-1, 4)
+    ends = numpy.asarray(ends, dtype=numpy.int64).reshape(-1, 2)
+    ends = ends[ends[:, 0] != ends[:, 1]]
+    count = len(boxes)
+    if movable is None:
+        movable = numpy.ones(count, dtype=bool)
+    movable = numpy.asarray(movable, dtype=bool)
+    if not movable.any():
+        return boxes[:, :2].copy()
+    random = numpy.random.RandomState(seed)
+    # each card's disc is as wide as the card's diagonal
+    sizes = numpy.hypot(boxes[:, 2], boxes[:, 3])
+    centers = boxes[:, :2] + boxes[:, 2:] / 2.0
+    # the ideal gap between the discs of connected cards
+    k = boxes[movable, 2:].mean() / 2
+    spread(centers, movable, sizes.mean() + k, random)
+    cutoff = k + sizes.max()
+    # cards with more edges push harder, so a card's neighbours have room
+    weights = 1.0 + numpy.bincount(ends.ravel(), minlength=count)
+    # pull towards the middle, as strong as the push out of a disc of cards
+    # sizes.mean() + k apart, so it ends up about that big
+    gravity = numpy.pi * k * k * weights.mean() / (sizes.mean() + k) ** 2
+    temperature = k * numpy.sqrt(movable.sum()) / 10
+    for step in xrange(iterations):
+        force = numpy.zeros((count, 2))
+        # repulsion between cards near each other
+        i, j = near_pairs(centers, cutoff)
+        delta = centers[i] - centers[j]
+        distance = numpy.hypot(delta[:, 0], delta[:, 1])
+        near = distance < cutoff
+        i, j, delta, distance = i[near], j[near], delta[near], distance[near]
+        if len(i):
+            # cards right on top of each other go apart any which way
+            same = distance < 1e-6
+            if same.any():
+                angle = random.random_sample(same.sum()) * 2 * numpy.pi
+                delta[same] = numpy.column_stack((numpy.cos(angle), numpy.sin(angle)))
+                distance[same] = 1.0
+            gap = numpy.maximum(distance - (sizes[i] + sizes[j]) / 2, k / 100)
+            strength = numpy.where(gap < k, weights[i] * weights[j] * k * k / gap, 0)
+            add_forces(force, i, j, delta * (strength / distance)[:, numpy.newaxis])
+        force += far_forces(centers, weights, k)
+        force += (gravity * weights)[:, numpy.newaxis] * (centers[movable].mean(axis=0) - centers)
+        # attraction along edges
+        if len(ends):
+            i, j = ends[:, 0], ends[:, 1]
+            delta = centers[j] - centers[i]
+            distance = numpy.maximum(numpy.hypot(delta[:, 0], delta[:, 1]), 1e-6)
+            gap = numpy.maximum(distance - (sizes[i] + sizes[j]) / 2, 0)
+            strength = ATTRACTION * gap / distance
+            add_forces(force, i, j, delta * strength[:, numpy.newaxis])
+        # move each card along its force, at most the temperature
+        length = numpy.maximum(numpy.hypot(force[:, 0], force[:, 1]), 1e-9)
+        step_length = numpy.minimum(length, temperature)
+        force *= (step_length / length)[:, numpy.newaxis]
+        centers[movable] += force[movable]
+        temperature *= 1 - 1.0 / (iterations - step + 1)
+    positions = centers - boxes[:, 2:] / 2.0
+    remove_overlaps(positions, boxes[:, 2:], movable)
+    return positions
+
+def far_forces(centers, weights, k, cells=FAR_CELLS, chunk=FAR_CHUNK):
+    '''
+    Return the (n, 2) repulsion on each card from the cards in the other
+    cells of a cells by cells grid over them all, each cell's cards taken
+    together at their centroid, as heavy as their weights put together.
+    '''
+    low = centers.min(axis=0)
+    size = (centers.max(axis=0) - low) / cells + 1e-9
+    cell = numpy.minimum(((centers - low) / size).astype(numpy.int64), cells - 1)
+    keys = cell[:, 0] + cell[:, 1] * cells
+    mass = numpy.bincount(keys, weights, cells * cells)
+    occupied = numpy.nonzero(mass)[0]
+    centroids = numpy.column_stack([
+        numpy.bincount(keys, weights * centers[:, axis], cells * cells)[occupied]
+        / mass[occupied] for axis in (0, 1)])
+    mass = mass[occupied]
+    # |a - b|^2 = |a|^2 + |b|^2 - 2a.b, so it's all matrix products
+    centroid_squares = (centroids * centroids).sum(axis=1)
+    force = numpy.zeros_like(centers)
+    for start in xrange(0, len(centers), chunk):
+        part = slice(start, start + chunk)
+        points = centers[part]
+        squared = ((points * points).sum(axis=1)[:, numpy.newaxis] + centroid_squares
+                   - 2 * points.dot(centroids.T))
+        weight = mass * (k * k) / numpy.maximum(squared, k * k)
+        weight[keys[part, numpy.newaxis] == occupied] = 0
+        force[part] = points * weight.sum(axis=1)[:, numpy.newaxis] - weight.dot(centroids)
+    return force * weights[:, numpy.newaxis]
+
+def add_forces(force, i, j, pushes):
+    "Add pushes, an (m, 2) array, to the forces on cards i and take them from cards j"
+    for axis in (0, 1):
+        force[:, axis] += numpy.bincount(i, pushes[:, axis], len(force))
+        force[:, axis] -= numpy.bincount(j, pushes[:, axis], len(force))
+
+def remove_overlaps(positions, sizes, movable, gap=GAP, passes=OVERLAP_PASSES):
+    '''
+    Push boxes at positions, an (n, 2) array changed in place, with sizes,
+    (n, 2), apart until there's at least gap between them, or passes runs
+    out. Each overlap is undone along the axis that takes least moving,
+    by whichever of the two boxes are movable.
+
+    The overlapping pairs are found for all boxes at once, then undone one
+    at a time, each from where the ones before left the boxes, so a push
+    goes right through a crowd in one pass rather than bouncing about in it.
+    '''
+    cell = sizes.max() + gap
+    for step in xrange(passes):
+        centers = positions + sizes / 2.0
+        i, j = near_pairs(centers, cell)
+        room = (sizes[i] + sizes[j]) / 2.0 + gap
+        hit = ((numpy.abs(centers[j] - centers[i]) < room).all(axis=1)
+               & (movable[i] | movable[j]))
+        if not hit.any():
+            return
+        moved = 0
+        for a, b in zip(i[hit].tolist(), j[hit].tolist()):
+            delta = centers[b] - centers[a]
+            overlap = (sizes[a] + sizes[b]) / 2.0 + gap - numpy.abs(delta)
+            if (overlap <= 0).any():
+                continue
+            axis = 0 if overlap[0] < overlap[1] else 1
+            push = overlap[axis] if delta[axis] >= 0 else -overlap[axis]
+            share = float(movable[a] + movable[b])
+            if movable[a]:
+                centers[a, axis] -= push / share
+            if movable[b]:
+                centers[b, axis] += push / share
+            moved += 1
+        positions[:] = centers - sizes / 2.0
+        if not moved:
+            return
+
+def layout_graph(graph, cards=None, iterations=ITERATIONS):
+    '''
+    Lay out the cards of model.Graph graph, only moving cards if it's
+    given, and set their x and y. The caller commits. Returns the cards
+    moved.
+    '''
+    need_numpy()
+    all_cards = graph.cards
+    numbers = dict((id(card), i) for i, card in enumerate(all_cards))
+    boxes = [(c.x, c.y, c.w, c.h) for c in all_cards]
+    ends = [(numbers[id(e.orig)], numbers[id(e.dest)]) for e in graph.edges]
+    if cards is None:
+        movable = None
+        cards = all_cards
+    else:
+        movable = numpy.zeros(len(all_cards), dtype=bool)
+        for card in cards:
+            movable[numbers[id(card)]] = True
+    positions = layout(boxes, ends, movable, iterations)
+    for card in cards:
+        x, y = positions[numbers[id(card)]]
+        card.x, card.y = int(round(x)), int(round(y))
+    return list(cards)
+
+
+class TestLayout(unittest.TestCase):
+
+    def setUp(self):
+        if numpy is None:
+            self.skipTest('no NumPy')
+        import kvbackend
+        import kvstore
+        self.graph = model.Graph(kvstore.KVStore(kvbackend.MemoryBackend()), None)
+
+    def overlapping(self, cards):
+        for a in cards:
+            for b in cards:
+                if a is not b and (a.x < b.x + b.w and b.x < a.x + a.w and
+                                   a.y < b.y + b.h and b.y < a.y + a.h):
+                    return True
+        return False
+
+    def testPile(self):
+        # a chain of 30 cards all in one place, and 10 more on their own
+        cards = [self.graph.new_card(0, 0, 200, 150) for i in range(40)]
+        for a, b in zip(cards[:29], cards[1:30]):
+            self.graph.new_edge(a, b)
+        layout_graph(self.graph)
+        self.assertFalse(self.overlapping(cards))
+        # connected cards end up nearer each other than the rest
+        def distance(a, b):
+            return numpy.hypot(a.x - b.x, a.y - b.y)
+        linked = numpy.mean([distance(a, b) for a, b in zip(cards[:29], cards[1:30])])
+        apart = numpy.mean([distance(a, b) for a in cards[:30] for b in cards[30:]])
+        self.assertTrue(linked < apart)
+
+    def testSelection(self):
+        fixed = self.graph.new_card(0, 0, 200, 150)
+        cards = [self.graph.new_card(50, 50, 100, 100) for i in range(5)]
+        for card in cards:
+            self.graph.new_edge(fixed, card)
+        self.assertEqual(layout_graph(self.graph, cards), cards)
+        self.assertEqual((fixed.x, fixed.y), (0, 0))
+        self.assertFalse(self.overlapping([fixed] + cards))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,443 @@
+'''
+Three-way merge of commits.
+
+Two commits that grew apart from a common ancestor, the base, are merged by
+working out what each side changed since the base and doing both. All of
+that is done on the oid lists in the three commits: a card or edge with the
+same oid on both sides is the same, so only the objects that changed are
+ever decoded, and merging two lightly edited big boards is quick.
+
+Identical cards share an oid, so a manifest is a multiset: each copy of an
+oid is a card of its own, known by the oid and how many copies come before
+it, (oid, n). Which new version of a card replaced which old one is looked
+up with an identity function (CardHistory.identity, normally), falling back
+to their order in the manifests, as CardHistory.catch_up() does. A card is
+known by its (oid, n) in the base on both sides; a new card is known by its
+(oid, n) on its side and the side, (oid, n, side), so two sides making the
+same new card make two cards.
+
+When both sides changed the same card, their changes are merged field by
+field. If they changed the same field differently, or one side deleted a
+card the other changed, that's a Conflict: ours wins the field, and a
+changed card beats a deletion, keeping the edges the changing side has to
+it, so nothing is lost without being reported.
+
+Edges have no identity of their own; they're known by the cards at their
+ends, and counted: the merge has as many edges between two cards as ours
+and theirs have between them, less the base's. Moving or editing a card
+re-saves the edges to it, which is not a change to the edge.
+'''
+
+import collections
+import unittest
+
+import cardhistory
+import model
+import storable
+
+# card fields that are merged one by one
+CARD_FIELDS = ('text', 'x', 'y', 'w', 'h')
+
+
+class Conflict(object):
+    '''
+    A card both sides changed incompatibly.
+
+    * card: its oid in the base
+    * base, ours, theirs: its oid on each side, None if deleted there
+    * fields: the fields both changed differently, or None if one side
+      deleted it
+    * merged: oid of the version in the merge result
+    '''
+
+    def __init__(self, card, base, ours, theirs, fields, merged):
+        self.card = card
+        self.base = base
+        self.ours = ours
+        self.theirs = theirs
+        self.fields = fields
+        self.merged = merged
+
+    def __repr__(self):
+        return 'Conflict(%s, fields=%r)' % (self.card, self.fields)
+
+
+class MergeResult(object):
+    '''
+    The merged manifests: cards and edges, lists of oids, and conflicts,
+    a list of Conflicts. changes_from_ours and changes_from_theirs are
+    [(old oid, merged oid)] for every card that differs from that side, like
+    model.Graph.commit_slot gives, for whichever the merge is committed on.
+    '''
+
+    def __init__(self, cards, edges, conflicts, changes_from_ours, changes_from_theirs):
+        self.cards = cards
+        self.edges = edges
+        self.conflicts = conflicts
+        self.changes_from_ours = changes_from_ours
+        self.changes_from_theirs = changes_from_theirs
+
+    def commit(self, datastore, parent, commit_time):
+        "Save the result as a commit on top of parent, and return its oid"
+        return model.save_commit(datastore, self.cards, self.edges, parent, commit_time)
+
+
+def common_ancestor(datastore, a, b):
+    '''
+    The newest commit both a and b descend from, or None if they have
+    nothing in common. Walks both histories at once, so it only goes as
+    far back as the ancestor.
+    '''
+    seen_a = set()
+    seen_b = set()
+    while a or b:
+        if a:
+            if a in seen_b:
+                return a
+            seen_a.add(a)
+            a = model.load_commit(datastore, a)['parent']
+        if b:
+            if b in seen_a:
+                return b
+            seen_b.add(b)
+            b = model.load_commit(datastore, b)['parent']
+    return None
+
+
+def tagged(oids):
+    "The manifest oids as (oid, n), n counting the copies of oid before it"
+    counts = {}
+    tags = []
+    for oid in oids:
+        n = counts.get(oid, 0)
+        counts[oid] = n + 1
+        tags.append((oid, n))
+    return tags
+
+
+def side_changes(base_tags, side_tags, side, identity):
+    '''
+    What one side did to a manifest since base, given both as tagged().
+
+    Returns {key: (base oid, new oid)}, key being the base (oid, n), or
+    (oid, n, side) for new objects. Either oid is None for creations and
+    deletions.
+    '''
+    base_set = set(base_tags)
+    side_set = set(side_tags)
+    removed = [tag for tag in base_tags if tag not in side_set]
+    added = [tag for tag in side_tags if tag not in base_set]
+    changes = {}
+    if identity is not None and removed and added:
+        by_identity = {}
+        for tag in removed:
+            by_identity.setdefault(identity(tag[0]) or tag[0], []).append(tag)
+        unmatched = []
+        for new_tag in added:
+            old_tags = by_identity.get(identity(new_tag[0]) or new_tag[0])
+            if not old_tags:
+                unmatched.append(new_tag)
+            else:
+                old_tag = old_tags.pop(0)
+                changes[old_tag] = (old_tag[0], new_tag[0])
+        removed = [tag for tag in removed if tag not in changes]
+        added = unmatched
+    # whatever's left is paired up in order
+    for old_tag, new_tag in cardhistory.manifest_changes(removed, added):
+        key = old_tag or new_tag + (side,)
+        changes[key] = (old_tag and old_tag[0], new_tag and new_tag[0])
+    return changes
+
+
+def merge_card(datastore, base_oid, ours_oid, theirs_oid):
+    '''
+    Merge two changed versions of a card field by field. Returns (merged
+    oid, fields both changed differently).
+    '''
+    base = cardhistory.load_card(datastore, base_oid)
+    ours = cardhistory.load_card(datastore, ours_oid)
+    theirs = cardhistory.load_card(datastore, theirs_oid)
+    merged = storable.Storable()
+    merged.update(ours)
+    conflicting = []
+    for field in CARD_FIELDS:
+        if ours.get(field) == base.get(field):
+            if field in theirs:
+                merged[field] = theirs[field]
+        elif theirs.get(field) != base.get(field) and theirs.get(field) != ours.get(field):
+            conflicting.append(field)
+    return merged.save(datastore), conflicting
+
+
+def merge(datastore, base, ours, theirs, identity=None):
+    '''
+    Merge commits ours and theirs, whose common ancestor is base (None for
+    an empty board), and return a MergeResult.
+
+    identity(card oid) -> the card's identity or None, to pair up old and
+    new versions of cards; CardHistory.identity does.
+    '''
+    def manifest(oid, field):
+        if oid is None:
+            return []
+        return model.load_commit(datastore, oid).get(field, [])
+    base_cards = tagged(manifest(base, 'cards'))
+    our_cards = tagged(manifest(ours, 'cards'))
+    their_cards = tagged(manifest(theirs, 'cards'))
+    our_changes = side_changes(base_cards, our_cards, 'ours', identity)
+    their_changes = side_changes(base_cards, their_cards, 'theirs', identity)
+    merged = {}
+    conflicts = []
+    # {key: side} of cards one side deleted and the other changed
+    revived = {}
+    for key in set(our_changes).union(their_changes):
+        if key not in their_changes:
+            merged[key] = our_changes[key][1]
+        elif key not in our_changes:
+            merged[key] = their_changes[key][1]
+        else:
+            base_oid, ours_oid = our_changes[key]
+            theirs_oid = their_changes[key][1]
+            if ours_oid == theirs_oid:
+                merged[key] = ours_oid
+            elif ours_oid is None or theirs_oid is None:
+                # changed beats deleted
+                merged[key] = ours_oid or theirs_oid
+                revived[key] = 'ours' if ours_oid else 'theirs'
+                conflicts.append(Conflict(key[0], base_oid, ours_oid, theirs_oid,
+                                          None, merged[key]))
+            else:
+                # new cards' keys name their side, so both sides only
+                # change base cards; base_oid is never None here
+                merged[key], fields = merge_card(datastore, base_oid, ours_oid, theirs_oid)
+                if fields:
+                    conflicts.append(Conflict(key[0], base_oid, ours_oid, theirs_oid,
+                                              fields, merged[key]))
+    # {oid on either side: key}, for the edges; an oid in the base is the
+    # first card with it there, as the edges to it can't say which
+    base_oids = set(oid for oid, n in base_cards)
+    keys = {}
+    for changes in (our_changes, their_changes):
+        for key, (old_oid, new_oid) in changes.iteritems():
+            keys.setdefault(new_oid, key)
+    card_key = lambda oid: (oid, 0) if oid in base_oids else keys.get(oid, (oid, 0))
+    final = lambda key: merged[key] if key in merged else key[0]
+    # base order, then new cards, ours first
+    cards = [final(tag) for tag in base_cards if final(tag) is not None]
+    for side, tags in (('ours', our_cards), ('theirs', their_cards)):
+        cards.extend(merged[tag + (side,)] for tag in tags if tag + (side,) in merged)
+    edges = merge_edges(datastore, manifest(base, 'edges'), manifest(ours, 'edges'),
+                        manifest(theirs, 'edges'), card_key, final, revived)
+    def changes_from(side_changes):
+        changes = []
+        for key, card_oid in merged.iteritems():
+            if key in side_changes:
+                side_oid = side_changes[key][1]
+            else:
+                # a base card this side left alone, or the other side's new one
+                side_oid = key[0] if len(key) == 2 else None
+            if side_oid != card_oid:
+                changes.append((side_oid, card_oid))
+        return changes
+    return MergeResult(cards, edges, conflicts,
+                       changes_from(our_changes), changes_from(their_changes))
+
+
+def merge_edges(datastore, base, ours, theirs, card_key, final, revived={}):
+    '''
+    Merge the edge manifests, given card_key(card oid) -> the card's key
+    and final(key) -> its oid in the merge, or None if it was deleted.
+    revived is {key: 'ours' or 'theirs'} for cards kept from that side
+    though the other deleted them; they keep that side's edges.
+    '''
+    loaded = {}
+    def load(edge_oid):
+        if edge_oid not in loaded:
+            edge = storable.Storable()
+            try:
+                edge.load(datastore, edge_oid)
+            except storable.Error:
+                raise model.Error('Failed to find edge %s' % edge_oid)
+            loaded[edge_oid] = edge
+        return loaded[edge_oid]
+    def edge_key(edge_oid):
+        edge = load(edge_oid)
+        return card_key(edge['orig']), card_key(edge['dest'])
+    # an edge only has its ends, so copies of it both sides still have
+    # join cards neither side touched: changing or deleting a card
+    # re-saves or drops the edges to it. They stay as they are, and only
+    # the rest get decoded.
+    stable = collections.Counter(base) & collections.Counter(ours) & \
+        collections.Counter(theirs)
+    def changed(side):
+        "side's edges less the stable ones"
+        left = stable.copy()
+        for edge_oid in side:
+            if left[edge_oid]:
+                left[edge_oid] -= 1
+            else:
+                yield edge_oid
+    changes = [list(changed(side)) for side in (base, ours, theirs)]
+    counts = [collections.Counter(edge_key(e) for e in side) for side in changes]
+    # how many edges between each pair of cards the merge has
+    wanted = counts[1] + counts[2] - counts[0]
+    for key in set(counts[0]) | set(counts[1]) | set(counts[2]):
+        sides = set(revived[card] for card in key if card in revived)
+        if len(sides) == 1:
+            # the deleting side dropped these edges along with the card
+            wanted[key] = counts[1 if sides == set(['ours']) else 2][key]
+        elif sides:
+            # each end was deleted by the other side; neither has the edge
+            wanted[key] = 0
+    edges = []
+    # base order, then new edges, ours first
+    left = stable.copy()
+    for edge_oid in base + changes[1] + changes[2]:
+        if left[edge_oid]:
+            left[edge_oid] -= 1
+            edges.append(edge_oid)
+            continue
+        key = edge_key(edge_oid)
+        if not wanted[key]:
+            continue
+        wanted[key] -= 1
+        orig, dest = final(key[0]), final(key[1])
+        if orig is None or dest is None:
+            # the other side deleted a card this side linked to
+            continue
+        edge = load(edge_oid)
+        if edge['orig'] != orig or edge['dest'] != dest:
+            edge = storable.Storable(edge)
+            edge['orig'] = orig
+            edge['dest'] = dest
+            edge_oid = edge.save(datastore)
+        edges.append(edge_oid)
+    return edges
+
+
+class TestMerge(unittest.TestCase):
+
+    def setUp(self):
+        import kvbackend
+        import kvstore
+        self.store = kvstore.KVStore(kvbackend.MemoryBackend())
+        g = model.Graph(self.store, None)
+        for text in 'abc':
+            g.new_card().text = text
+        g.new_edge(g.cards[0], g.cards[1])
+        self.base = g.commit()
+
+    def side(self):
+        "A graph at the base commit, and its cards by text"
+        g = model.Graph(self.store, self.base)
+        return g, dict((c.text, c) for c in g.cards)
+
+    def merged(self, ours, theirs):
+        base = common_ancestor(self.store, ours, theirs)
+        self.assertEqual(base, self.base)
+        result = merge(self.store, base, ours, theirs)
+        g = model.Graph(self.store, result.commit(self.store, theirs, 0))
+        return result, g, dict((c.text, c) for c in g.cards)
+
+    def testDisjoint(self):
+        g, cards = self.side()
+        cards['a'].text = 'a2'
+        cards['b'].x = 50
+        ours = g.commit()
+        g, cards = self.side()
+        cards['b'].y = 70
+        cards['c'].delete()
+        g.new_edge(g.new_card(), cards['a']).orig.text = 'd'
+        theirs = g.commit()
+        result, g, cards = self.merged(ours, theirs)
+        self.assertEqual(result.conflicts, [])
+        self.assertEqual(sorted(cards), ['a2', 'b', 'd'])
+        self.assertEqual((cards['b'].x, cards['b'].y), (50, 70))
+        self.assertEqual(sorted((e.orig.text, e.dest.text) for e in g.edges),
+                         [('a2', 'b'), ('d', 'a2')])
+
+    def testConflicts(self):
+        g, cards = self.side()
+        cards['a'].text = 'ours'
+        cards['b'].text = 'changed'
+        ours = g.commit()
+        g, cards = self.side()
+        cards['a'].text = 'theirs'
+        cards['b'].delete()
+        theirs = g.commit()
+        result, g, cards = self.merged(ours, theirs)
+        self.assertEqual(sorted(cards), ['c', 'changed', 'ours'])
+        self.assertEqual(sorted(c.fields for c in result.conflicts), [None, ['text']])
+        # the edge went with b on their side, but b survived, and keeps
+        # the edge it has on ours
+        self.assertEqual([(e.orig.text, e.dest.text) for e in g.edges],
+                         [('ours', 'changed')])
+
+    def testChangedKeepsEdges(self):
+        g, cards = self.side()
+        cards['a'].delete()
+        ours = g.commit()
+        g, cards = self.side()
+        cards['a'].x = 10
+        g.new_edge(cards['c'], cards['a'])
+        theirs = g.commit()
+        result, g, cards = self.merged(ours, theirs)
+        self.assertEqual([c.fields for c in result.conflicts], [None])
+        self.assertEqual(sorted((e.orig.text, e.dest.text) for e in g.edges),
+                         [('a', 'b'), ('c', 'a')])
+
+    def testDeletedEdge(self):
+        g, cards = self.side()
+        g.edges[0].delete()
+        ours = g.commit()
+        g, cards = self.side()
+        cards['a'].x = 100
+        theirs = g.commit()
+        result, g, cards = self.merged(ours, theirs)
+        self.assertEqual(cards['a'].x, 100)
+        self.assertEqual(g.edges, [])
+
+    def testUnchangedEdgesNotLoaded(self):
+        g, cards = self.side()
+        g.new_edge(cards['b'], cards['c'])
+        base = g.commit()
+        g = model.Graph(self.store, base)
+        g.cards[0].text = 'a2'
+        ours = g.commit()
+        g = model.Graph(self.store, base)
+        g.new_card().text = 'd'
+        theirs = g.commit()
+        unchanged = g.edges[1].obj.oid
+        got = []
+        get = self.store.get
+        self.store.get = lambda key: got.append(key) or get(key)
+        result = merge(self.store, base, ours, theirs)
+        del self.store.get
+        self.assertEqual(len(result.edges), 2)
+        self.assertTrue(unchanged in result.edges)
+        self.assertFalse(unchanged in got)
+
+    def testDuplicates(self):
+        # identical cards share an oid, but are each a card
+        g = model.Graph(self.store, None)
+        g.new_card(), g.new_card()
+        g.new_card().text = 'x'
+        g.new_edge(g.cards[2], g.cards[0])
+        base = g.commit()
+        g = model.Graph(self.store, base)
+        g.new_card()
+        g.new_edge(g.cards[2], g.cards[0])
+        ours = g.commit()
+        g = model.Graph(self.store, base)
+        g.cards[2].text = 'y'
+        g.new_card()
+        theirs = g.commit()
+        result = merge(self.store, base, ours, theirs)
+        self.assertEqual(result.conflicts, [])
+        self.assertEqual(len(result.cards), 5)
+        g = model.Graph(self.store, result.commit(self.store, theirs, 0))
+        self.assertEqual(sorted(c.text for c in g.cards), ['', '', '', '', 'y'])
+        self.assertEqual([(e.orig.text, e.dest.text) for e in g.edges], [('y', '')] * 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+'''
+Rewriting a whole history into a datastore with different settings.
+
+Changing how objects are encoded changes every oid, and with it every
+reference: edges refer to cards, commits to cards, edges and their parent.
+recode() copies the history leading to a commit into another KVStore,
+re-saving every object oldest first and fixing up the references as it
+goes.
+'''
+
+import model
+import storable
+
+
+def recode(source, target, head, oid_map=None):
+    '''
+    Copy every commit, card and edge reachable from commit head in source
+    into target, re-encoded with target's settings.
+
+    source and target may share a table. Returns (new head, oid map), the
+    map being {old oid: new oid} for every object copied. Pass the map from
+    an earlier call to copy another branch, and what the two share is only
+    copied once.
+    '''
+    chain = []
+    oid = head
+    if oid_map is None:
+        oid_map = {}
+    while oid and oid not in oid_map:
+        chain.append(oid)
+        oid = model.load_commit(source, oid)['parent']
+    oid_map[None] = None
+    for commit_oid in reversed(chain):
+        commit = model.load_commit(source, commit_oid)
+        for card_oid in commit['cards']:
+            if card_oid not in oid_map:
+                oid_map[card_oid] = recode_object(source, target, card_oid, oid_map)
+        for edge_oid in commit.get('edges', []):
+            if edge_oid not in oid_map:
+                oid_map[edge_oid] = recode_object(source, target, edge_oid, oid_map)
+        oid_map[commit_oid] = recode_object(source, target, commit_oid, oid_map)
+    del oid_map[None]
+    return oid_map.get(head), oid_map
+
+
+# the fields of each object type that hold oids (or lists of them)
+REFERENCE_FIELDS = {
+    model.COMMIT_OBJTYPE: ('parent', 'cards', 'edges'),
+    model.EDGE_OBJTYPE: ('orig', 'dest'),
+    model.CARD_OBJTYPE: (),
+}
+
+def recode_object(source, target, oid, oid_map):
+    '''
+    Load oid from source, map the oids it refers to through oid_map and
+    save it in target. Everything it refers to must be in oid_map already.
+    '''
+    obj = storable.Storable()
+    try:
+        obj.load(source, oid)
+    except storable.Error:
+        raise model.Error('Failed to find object %s' % oid)
+    try:
+        for field in REFERENCE_FIELDS[obj[model.objtype]]:
+            if field not in obj:
+                continue
+            if isinstance(obj[field], list):
+                obj[field] = [oid_map[ref] for ref in obj[field]]
+            else:
+                obj[field] = oid_map[obj[field]]
+    except KeyError as e:
+        raise model.Error('Object %s refers to missing or unknown %s' % (oid, e))
+    return obj.save(target)
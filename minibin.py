@@ -0,0 +1,232 @@
+'''
+Compact binary counterpart of minijson.
+
+Like minijson, every set of data has exactly one representation, so the
+encoding can be hashed for content addressing. It is smaller and quicker
+to parse: the key and value strings every object uses are stored as one
+byte, oids (40 character hex strings) as their raw 20 bytes, and numbers
+as varints.
+
+Encoded data starts with the FORMAT byte, which JSON text never does, so
+the two can be told apart by objcodec.
+
+Layout, after the FORMAT byte, is one value:
+ * 'N', 'T', 'F': None, True, False
+ * 'i' <varint>: int, zigzag encoded so small negatives stay short
+ * 'f' <8 bytes>: float, big endian double
+ * 'k' <byte>: one of KNOWN_STRINGS
+ * 'o' <20 bytes>: an oid
+ * 's' <varint length> <utf-8>: any other string
+ * 'O' <varint count> <20 bytes each>: non-empty list of nothing but oids
+ * 'l' <varint count> <values>: any other list
+ * 'd' <varint count> <key, value pairs sorted by key>: dict
+'''
+
+import binascii
+import re
+import struct
+import unittest
+
+FORMAT = '\x01'
+
+# Index in this tuple is what gets stored. Only ever append to it.
+KNOWN_STRINGS = (
+    u'objtype', u'card', u'edge', u'commit',
+    u'text', u'x', u'y', u'w', u'h',
+    u'orig', u'dest',
+    u'cards', u'edges', u'parent', u'time',
+)
+_known_index = dict((s, chr(i)) for i, s in enumerate(KNOWN_STRINGS))
+
+oid_re = re.compile(r'^[0-9a-f]{40}\Z')
+
+_double = struct.Struct('>d')
+
+
+def _varint(n):
+    out = []
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _is_oid(s):
+    return len(s) == 40 and oid_re.match(s) is not None
+
+def _encode(value, out):
+    t = type(value)
+    if t is str:
+        value = value.decode('utf-8')
+        t = unicode
+    if t is unicode:
+        if value in _known_index:
+            out.append('k' + _known_index[value])
+        elif _is_oid(value):
+            out.append('o' + binascii.unhexlify(value))
+        else:
+            encoded = value.encode('utf-8')
+            out.append('s' + _varint(len(encoded)) + encoded)
+    elif t is bool:
+        out.append(value and 'T' or 'F')
+    elif t is int or t is long:
+        if value >= 0:
+            out.append('i' + _varint(value << 1))
+        else:
+            out.append('i' + _varint(((-value) << 1) - 1))
+    elif t is float:
+        out.append('f' + _double.pack(value))
+    elif value is None:
+        out.append('N')
+    elif isinstance(value, (list, tuple)):
+        if value and all(isinstance(v, basestring) and _is_oid(v) for v in value):
+            out.append('O' + _varint(len(value)))
+            out.append(binascii.unhexlify(''.join(value)))
+        else:
+            out.append('l' + _varint(len(value)))
+            for v in value:
+                _encode(v, out)
+    elif isinstance(value, dict):
+        items = []
+        for key, v in value.iteritems():
+            if isinstance(key, str):
+                key = key.decode('utf-8')
+            elif not isinstance(key, unicode):
+                raise TypeError('minibin dict keys must be strings, not %r' % (key,))
+            items.append((key, v))
+        items.sort()
+        out.append('d' + _varint(len(items)))
+        for key, v in items:
+            _encode(key, out)
+            _encode(v, out)
+    else:
+        raise TypeError('%r is not minibin encodable' % (value,))
+
+def encode(data):
+    out = [FORMAT]
+    _encode(data, out)
+    return ''.join(out)
+
+
+def _read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def _decode_int(data, pos):
+    z, pos = _read_varint(data, pos)
+    if z & 1:
+        return -((z + 1) >> 1), pos
+    return z >> 1, pos
+
+def _decode_float(data, pos):
+    return _double.unpack_from(data, pos)[0], pos + 8
+
+def _decode_known(data, pos):
+    return KNOWN_STRINGS[ord(data[pos])], pos + 1
+
+def _decode_oid(data, pos):
+    if pos + 20 > len(data):
+        raise ValueError('truncated oid')
+    return binascii.hexlify(data[pos:pos + 20]), pos + 20
+
+def _decode_string(data, pos):
+    length, pos = _read_varint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise ValueError('truncated string')
+    return data[pos:end].decode('utf-8'), end
+
+def _decode_oid_list(data, pos):
+    count, pos = _read_varint(data, pos)
+    end = pos + 20 * count
+    if end > len(data):
+        raise ValueError('truncated oid list')
+    hexed = binascii.hexlify(data[pos:end])
+    return [hexed[i:i + 40] for i in xrange(0, len(hexed), 40)], end
+
+def _decode_list(data, pos):
+    count, pos = _read_varint(data, pos)
+    out = []
+    for i in xrange(count):
+        value, pos = _decoders[data[pos]](data, pos + 1)
+        out.append(value)
+    return out, pos
+
+def _decode_dict(data, pos):
+    count, pos = _read_varint(data, pos)
+    out = {}
+    for i in xrange(count):
+        key, pos = _decoders[data[pos]](data, pos + 1)
+        value, pos = _decoders[data[pos]](data, pos + 1)
+        out[key] = value
+    return out, pos
+
+_decoders = {
+    'N': lambda data, pos: (None, pos),
+    'T': lambda data, pos: (True, pos),
+    'F': lambda data, pos: (False, pos),
+    'i': _decode_int,
+    'f': _decode_float,
+    'k': _decode_known,
+    'o': _decode_oid,
+    's': _decode_string,
+    'O': _decode_oid_list,
+    'l': _decode_list,
+    'd': _decode_dict,
+}
+
+def decode(data):
+    '''
+    Decode minibin data. Raises ValueError if it is invalid.
+    '''
+    data = str(data)
+    if data[:1] != FORMAT:
+        raise ValueError('not minibin data')
+    try:
+        value, pos = _decoders[data[1]](data, 2)
+    except (IndexError, KeyError, struct.error):
+        raise ValueError('invalid minibin data')
+    if pos != len(data):
+        raise ValueError('trailing garbage after minibin data')
+    return value
+
+
+class TestMiniBin(unittest.TestCase):
+    oid = '0123456789abcdef0123456789abcdef01234567'
+
+    def testRoundTrip(self):
+        for data in [
+            {},
+            {'objtype': 'card', 'text': u'caf\xe9\n"body"', 'x': -35, 'y': 2 ** 70, 'w': 30.5, 'h': 0},
+            {'objtype': 'edge', 'orig': self.oid, 'dest': self.oid},
+            {'objtype': 'commit', 'parent': None, 'cards': [self.oid] * 3, 'edges': [], 'time': 1234567890},
+            {'mixed': [self.oid, 'x', True, False, None, [1, [2]]], 'nested': {'a': {'b': -1}}},
+            {'almost an oid': self.oid.upper(), 'short': self.oid[:-1]},
+        ]:
+            self.assertEqual(decode(encode(data)), data)
+
+    def testCanonical(self):
+        self.assertEqual(encode({'text': 'caf\xc3\xa9'}), encode({u'text': u'caf\xe9'}))
+        self.assertEqual(encode({'b': 1, 'a': 2}), encode({'a': 2, 'b': 1}))
+        self.assertNotEqual(encode({'x': 1}), encode({'x': 1.0}))
+        self.assertNotEqual(encode({'x': 1}), encode({'x': True}))
+
+    def testCompact(self):
+        encoded = encode({'objtype': 'edge', 'orig': self.oid, 'dest': self.oid})
+        self.assertEqual(encoded[0], FORMAT)
+        # format, dict header, three known keys, known 'edge', two oids
+        self.assertEqual(len(encoded), 1 + 2 + 3 * 2 + 2 + 2 * 21)
+
+    def testInvalid(self):
+        for data in ['{"x":1}', FORMAT, FORMAT + 'd\x01', FORMAT + 'O\x02' + 'a' * 20, FORMAT + 'NN', FORMAT + '?']:
+            self.assertRaises(ValueError, decode, data)
+
+if __name__ == '__main__':
+    unittest.main()
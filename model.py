@@ -2,7 +2,13 @@
 Contains the latest version of the basic data model classes.
 '''
 
+import time
+from array import array
+
+import kvstore
+import objcodec
 import storable
+from slot import Slot
 
 COMMIT_OBJTYPE = 'commit'
 CARD_OBJTYPE = 'card'
@@ -14,23 +20,82 @@ MIN_CARD_SIZE = 30
 class Error(Exception):
     pass
 
+def load_commit(datastore, oid):
+    '''
+    Return the commit at oid as a storable.Storable, without loading any
+    of its cards or edges.
+    '''
+    commit = storable.Storable()
+    try:
+        commit.load(datastore, oid)
+    except storable.Error:
+        raise Error('Can\'t find commit %s' % oid)
+    if commit.get(objtype) != COMMIT_OBJTYPE:
+        raise Error('%s is not a commit' % oid)
+    return commit
+
+def save_commit(datastore, cards, edges, parent, commit_time=None):
+    '''
+    Save a commit of the oid lists cards and edges on top of commit parent,
+    without a Graph, and return its oid.
+    '''
+    commit = storable.Storable({
+        objtype: COMMIT_OBJTYPE,
+        'cards': cards,
+        'edges': edges,
+        'parent': parent,
+        'time': int(time.time()) if commit_time is None else commit_time,
+    })
+    return commit.save(datastore)
+
+def load_objects(datastore, oids, batch_size=1000):
+    '''
+    Generate (oid, decoded dict) for each of the list oids, in order,
+    fetching batch_size at a time, so going through a big commit never
+    holds all of it.
+    '''
+    for start in xrange(0, len(oids), batch_size):
+        batch = oids[start:start + batch_size]
+        found = datastore.get_many(batch)
+        for oid in batch:
+            if oid not in found:
+                raise Error('Failed to find object %s' % oid)
+            yield oid, objcodec.decode(found[oid])
+
 class Graph(object):
     '''
     Interface for managing and saving a version of the graph.
 
     Members:
     * datastore: a kvstore.KVStore used to store everything.
+    * commit_slot: signalled after every commit with
+      (commit oid, card changes, edge changes). Each list of changes holds
+      (old oid, new oid) pairs; old oid is None for new objects and new
+      oid is None for deleted ones.
+    * head_slot: signalled when reload() switches to another commit, with
+      (commit oid, removed cards, added cards, removed edges, added edges),
+      the last four being lists of Card and Edge objects.
+    * edit_slot: signalled when a Batch commits, with (commit oid, changed
+      cards, added cards, removed cards, added edges, removed edges)
+    * table: the CardTable holding the cards of a compact graph, or None
+    * open_batch: the Batch being made, or None
     '''
 
-    def __init__(self, datastore, oid):
+    def __init__(self, datastore, oid, compact=False):
         '''
         Load the graph specified by the commit from the datastore.
 
         If oid is None, create empty graph. If oid is invalid or not
-        a commit, error out.
+        a commit, error out. A compact graph keeps its cards in a CardTable,
+        as CompactCards.
         '''
         self.obj = storable.Storable()
         self.datastore = datastore
+        self.table = CardTable() if compact else None
+        self.commit_slot = Slot()
+        self.head_slot = Slot()
+        self.edit_slot = Slot()
+        self.open_batch = None
         if oid:
             try:
                 self.obj.load(datastore, oid)
@@ -50,12 +115,8 @@ class Graph(object):
             self.load_empty_graph()
         # while loading cards, build dict of oids to cards
         # we only need this during loading phase to give to edge constructors
-        card_dict = {}
-        self.cards = []
-        for oid in self.obj['cards']:
-            c = Card(self, oid)
-            card_dict[oid] = c
-            self.cards.append(c)
+        self.cards = self.load_cards(self.obj['cards'])
+        card_dict = dict(zip(self.obj['cards'], self.cards))
         card_mapper = lambda oid: card_dict.get(oid, None)
         if 'edges' in self.obj:
             self.edges = [Edge(self, oid, card_mapper) for oid in self.obj['edges']]
@@ -64,6 +125,100 @@ class Graph(object):
             self.obj['edges'] = []
             self.edges = []
 
+    def reload(self, oid):
+        '''
+        Switch to commit oid, like loading it afresh, but keep the Card and
+        Edge objects of every version the two commits share, so only what
+        changed is decoded and whoever holds the rest doesn't need to care.
+
+        Uncommitted changes are lost.
+        '''
+        commit = load_commit(self.datastore, oid)
+        # {oid: [cards with that version]}; identical cards share an oid
+        old_cards = {}
+        for card in self.cards:
+            if not card.dirty:
+                old_cards.setdefault(card.saved_oid, []).append(card)
+        cards = [old_cards[card_oid].pop() if old_cards.get(card_oid) else None
+                 for card_oid in commit['cards']]
+        loaded = iter(self.load_cards(
+            [card_oid for card_oid, c in zip(commit['cards'], cards) if c is None]))
+        cards = [c if c is not None else next(loaded) for c in cards]
+        card_dict = {}
+        for card_oid, c in zip(commit['cards'], cards):
+            c._delete_me = False
+            card_dict[card_oid] = c
+        card_mapper = lambda oid: card_dict.get(oid, None)
+        old_edges = {}
+        for edge in self.edges:
+            if not edge.dirty:
+                old_edges.setdefault(edge.saved_oid, []).append(edge)
+        edges = []
+        for edge_oid in commit.get('edges', []):
+            if old_edges.get(edge_oid):
+                e = old_edges[edge_oid].pop()
+                # the same card version may be a different Card now
+                e._orig = card_mapper(e.obj['orig'])
+                e._dest = card_mapper(e.obj['dest'])
+                e._delete_me = False
+            else:
+                e = Edge(self, edge_oid, card_mapper)
+            edges.append(e)
+        kept_cards = set(map(id, cards))
+        removed_cards = [c for c in self.cards if id(c) not in kept_cards]
+        old_card_ids = set(map(id, self.cards))
+        added_cards = [c for c in cards if id(c) not in old_card_ids]
+        kept_edges = set(map(id, edges))
+        removed_edges = [e for e in self.edges if id(e) not in kept_edges]
+        old_edge_ids = set(map(id, self.edges))
+        added_edges = [e for e in edges if id(e) not in old_edge_ids]
+        self.obj = commit
+        self.cards = cards
+        self.edges = edges
+        self.head_slot.signal(oid, removed_cards, added_cards, removed_edges, added_edges)
+        if self.table is not None:
+            self.table.release([card.row for card in removed_cards])
+
+    def has_changes(self):
+        "Whether anything has changed since the last commit or load"
+        for item in self.cards + self.edges:
+            if item.dirty or item.delete_me:
+                return True
+        return self.obj.oid is None
+
+    def fork(self):
+        '''
+        Return an independent copy of the graph, uncommitted changes and
+        all, that can be edited and committed separately; its first commit
+        has the same parent this graph's would.
+
+        Cards and edges share their Storables with ours until one side
+        changes them, so a fork costs a Card per card and no decoding, and
+        grows only with what's changed.
+        '''
+        fork = Graph(self.datastore, None)
+        fork.obj = self.obj.unshare()
+        if self.table is not None:
+            # rows are small; copying them all is cheaper than sharing
+            fork.table = self.table.copy()
+        card_map = {}
+        fork.cards = []
+        for card in self.cards:
+            if self.table is not None:
+                c = CompactCard(fork, card.row)
+            else:
+                c = Card(fork, card.saved_oid, card.obj)
+            c._delete_me = card._delete_me
+            card_map[id(card)] = c
+            fork.cards.append(c)
+        fork.edges = []
+        for edge in self.edges:
+            e = Edge(fork, edge.saved_oid, obj=edge.obj,
+                     orig=card_map[id(edge.orig)], dest=card_map[id(edge.dest)])
+            e._delete_me = edge._delete_me
+            fork.edges.append(e)
+        return fork
+
     def get_cards(self):
         '''
         Return all cards, somehow, as model.Card's
@@ -74,8 +229,17 @@ class Graph(object):
         "as get_cards()"
         return self.edges
 
+    def load_cards(self, oids):
+        "Cards for the list oids: Cards, or CompactCards if the graph is compact"
+        if self.table is not None:
+            return self.table.load(self, oids)
+        return [Card(self, oid) for oid in oids]
+
     def new_card(self, x=0, y=0, w=MIN_CARD_SIZE, h=MIN_CARD_SIZE):
-        c = Card(self, None)
+        if self.table is not None:
+            c = self.table.new_card(self)
+        else:
+            c = Card(self, None)
         c.x = x
         c.y = y
         c.w = w
@@ -88,6 +252,15 @@ class Graph(object):
         self.edges.append(e)
         return e
 
+    def batch(self, commit=None):
+        '''
+        Open a Batch of edits, committed by calling commit(), self.commit
+        by default, when it's done.
+        '''
+        if self.open_batch is not None:
+            raise Error('a batch is open already')
+        return Batch(self, commit)
+
     def commit(self):
         '''
         Save a new commit object
@@ -103,38 +276,58 @@ class Graph(object):
             if edge.dirty:
                 edge.invalidate() # sets edge.obj.oid = None
         to_delete = []
+        card_changes = []
         # update card ids
         for card in self.cards:
             if card.delete_me:
                 to_delete.append(card)
+                if card.saved_oid is not None:
+                    card_changes.append((card.saved_oid, None))
             elif card.dirty:
-                card.save()
+                old_oid = card.saved_oid
+                new_oid = card.save()
+                if new_oid != old_oid:
+                    card_changes.append((old_oid, new_oid))
         for card in to_delete:
             self.cards.remove(card) # TODO: more efficient algo
+        # their rows are still needed to tell which edges go with them
+        deleted_rows = [card.row for card in to_delete] if self.table is not None else []
         # reuse deletion list for cards
         to_delete = []
+        edge_changes = []
         # update edge ids
         # must be BEFORE cards, so edges will know which cards' hashes
         # changed.
         for edge in self.edges:
             if edge.delete_me:
                 to_delete.append(edge)
+                if edge.saved_oid is not None:
+                    edge_changes.append((edge.saved_oid, None))
             elif edge.dirty:
-                edge.save()
+                old_oid = edge.saved_oid
+                new_oid = edge.save()
+                if new_oid != old_oid:
+                    edge_changes.append((old_oid, new_oid))
         for edge in to_delete:
             self.edges.remove(edge)
+        if self.table is not None:
+            self.table.release(deleted_rows)
         # load up new commit object
-        get_oid = lambda c: c.obj.oid
+        get_oid = lambda c: c.oid
         self.obj['cards'] = map(get_oid, self.cards)
         self.obj['edges'] = map(get_oid, self.edges)
         self.obj['parent'] = old_id
-        return self.obj.save(self.datastore)
+        self.obj['time'] = int(time.time())
+        commit_oid = self.obj.save(self.datastore)
+        self.commit_slot.signal(commit_oid, card_changes, edge_changes)
+        return commit_oid
 
     def load_empty_graph(self):
         '''
         Initialize self.obj with data for an empty graph.
 
-        Make parent null, and empty lists of cards and edges
+        Make parent null, and empty lists of cards and edges. Commits also
+        get a 'time' (unix seconds) when saved; older files lack it.
         '''
         self.obj[objtype] = COMMIT_OBJTYPE
         self.obj['parent'] = None
@@ -142,20 +335,168 @@ class Graph(object):
         self.obj['edges'] = []
 
 
+class Batch(object):
+    '''
+    Edits to a Graph made as one: everything that changes while the batch
+    is open goes into one commit when it closes, announced once on
+    graph.edit_slot. If anything goes wrong first, the commit included,
+    the graph goes back to how it was when the batch was opened. Cards
+    and edges can be changed directly or through the methods here.
+
+        with graph.batch() as batch:
+            batch.move(cards, 10, 0)
+            batch.delete(others)
+
+    Opening a batch copies the lists of cards and edges, and a compact
+    graph's CardTable. A card or edge is copied the first time it changes
+    (see keep()), and the batch holds on to the original to put back.
+    '''
+
+    def __init__(self, graph, commit=None):
+        self.graph = graph
+        self.commit_function = commit or graph.commit
+        self.obj = graph.obj.unshare()
+        self.cards = list(graph.cards)
+        self.edges = list(graph.edges)
+        self.table = graph.table.copy() if graph.table is not None else None
+        # {id(item): (item, obj, saved_oid, _delete_me, _orig, _dest)} of
+        # the cards and edges changed so far, as they were
+        self.kept = {}
+        # the commit made, once it is
+        self.oid = None
+        graph.open_batch = self
+
+    def keep(self, item):
+        '''
+        Called by a Card or Edge of the graph about to change: the first
+        time, remember how it is and give it a copy of its obj to change.
+        '''
+        if id(item) in self.kept:
+            return
+        self.kept[id(item)] = (item, item.obj, item.saved_oid, item._delete_me,
+                               getattr(item, '_orig', None), getattr(item, '_dest', None))
+        item.obj = item.obj.unshare()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        if self.graph.open_batch is self:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+
+    def move(self, cards, dx, dy):
+        "Move cards by (dx, dy)"
+        if self.graph.table is not None:
+            self.graph.table.move([card.row for card in cards], dx, dy)
+            return
+        for card in cards:
+            card.x += dx
+            card.y += dy
+
+    def place(self, card, x, y, w=None, h=None):
+        "Move card to (x, y), and resize it if w and h are given"
+        card.x = x
+        card.y = y
+        if w is not None:
+            card.w = w
+        if h is not None:
+            card.h = h
+
+    def set_text(self, card, text):
+        card.text = text
+
+    def new_card(self, x=0, y=0, w=MIN_CARD_SIZE, h=MIN_CARD_SIZE, text=''):
+        card = self.graph.new_card(x, y, w, h)
+        card.text = text
+        return card
+
+    def new_edge(self, orig, dest):
+        return self.graph.new_edge(orig, dest)
+
+    def delete(self, items):
+        "Delete the cards and edges items; a card's edges go with it"
+        for item in items:
+            item.delete()
+
+    def close(self):
+        if self.graph.open_batch is not self:
+            raise Error('the batch is closed')
+        self.graph.open_batch = None
+
+    def commit(self):
+        "Close the batch and commit, returning the commit oid"
+        self.close()
+        graph = self.graph
+        try:
+            self.oid = self.commit_function()
+        except:
+            self.restore()
+            raise
+        if self.table is not None:
+            was = lambda card: self.table.oids[card.row]
+        else:
+            was = lambda card: self.kept[id(card)][2] if id(card) in self.kept else card.saved_oid
+        before = set(map(id, self.cards))
+        after = set(map(id, graph.cards))
+        changed = [card for card in self.cards
+                   if id(card) in after and card.saved_oid != was(card)]
+        added = [card for card in graph.cards if id(card) not in before]
+        removed = [card for card in self.cards if id(card) not in after]
+        before = set(map(id, self.edges))
+        after = set(map(id, graph.edges))
+        added_edges = [edge for edge in graph.edges if id(edge) not in before]
+        removed_edges = [edge for edge in self.edges if id(edge) not in after]
+        graph.edit_slot.signal(self.oid, changed, added, removed, added_edges, removed_edges)
+        return self.oid
+
+    def rollback(self):
+        "Close the batch, putting the graph back as it was when it was opened"
+        self.close()
+        self.restore()
+
+    def restore(self):
+        for item, obj, saved_oid, deleted, orig, dest in self.kept.itervalues():
+            item.obj = obj
+            item.saved_oid = saved_oid
+            item._delete_me = deleted
+            if orig is not None:
+                item._orig = orig
+                item._dest = dest
+        self.kept = {}
+        self.graph.obj = self.obj
+        self.graph.cards = self.cards
+        self.graph.edges = self.edges
+        if self.table is not None:
+            self.graph.table = self.table
+
+
 class Card(object):
     '''
     Wraps a Storable to represent a card
+
+    Members:
+    * obj: the storable.Storable holding the card data
+    * saved_oid: oid of the last version loaded or saved, or None if the
+      card has never been saved. Unlike obj.oid, this survives edits.
     '''
 
-    def __init__(self, graph, oid=None):
+    def __init__(self, graph, oid=None, obj=None):
         '''
         Load self from datastore, or create new card
 
-        If oid is invalid, error. If oid is None, create new card.
+        If oid is invalid, error. If oid is None, create new card. If obj
+        is given, it's the Storable of the card being forked, shared until
+        either card changes.
         '''
         self.graph = graph
         self.obj = storable.Storable()
-        if oid is not None:
+        if obj is not None:
+            obj.shared = True
+            self.obj = obj
+        elif oid is not None:
             try:
                 self.obj.load(self.graph.datastore, oid)
             except storable.Error:
@@ -171,49 +512,70 @@ class Card(object):
                     raise Error('Card missing property "%s" at %s' % (prop, oid))
         else:
             self.load_empty_card()
+        self.saved_oid = oid
         # initialize deletion flag
         self._delete_me = False
 
     def load_empty_card(self):
         self.obj[objtype] = CARD_OBJTYPE
         self.obj['text'] = ''
-        self.x = 0
-        self.y = 0
-        self.w = MIN_CARD_SIZE
-        self.h = MIN_CARD_SIZE        
+        self.obj['x'] = 0
+        self.obj['y'] = 0
+        self.obj['w'] = MIN_CARD_SIZE
+        self.obj['h'] = MIN_CARD_SIZE
 
     def save(self):
-        return self.obj.save(self.graph.datastore)
+        self.touch()
+        self.saved_oid = self.obj.save(self.graph.datastore)
+        return self.saved_oid
 
     def delete(self):
+        self.touch()
         self._delete_me = True
 
+    @property
+    def oid(self):
+        "The oid of the card as it is, or None if it's changed since it was saved"
+        return self.obj.oid
+
+    def touch(self):
+        "Let the graph's open Batch, if any, keep the card as it is"
+        if self.graph.open_batch is not None:
+            self.graph.open_batch.keep(self)
+
+    def writable(self):
+        "self.obj, copied first if it's shared with a fork or a batch"
+        self.touch()
+        if self.obj.shared:
+            self.obj = self.obj.unshare()
+        return self.obj
+
     def set_x(self, x):
-        self.obj['x'] = x
+        self.writable()['x'] = x
     def get_x(self):
         return self.obj['x']
     x = property(get_x, set_x)
 
     def set_y(self, y):
-        self.obj['y'] = y
+        self.writable()['y'] = y
     def get_y(self):
         return self.obj['y']
     y = property(get_y, set_y)
 
     def set_w(self, w):
-        self.obj['w'] = max(w, MIN_CARD_SIZE)
+        self.writable()['w'] = max(w, MIN_CARD_SIZE)
     def get_w(self):
         return self.obj['w']
     w = property(get_w, set_w)
 
     def set_h(self, h):
-        self.obj['h'] = max(h, MIN_CARD_SIZE)
+        self.writable()['h'] = max(h, MIN_CARD_SIZE)
     def get_h(self):
         return self.obj['h']
     h = property(get_h, set_h)
 
     def set_text(self, text):
-        self.obj['text'] = text
+        self.writable()['text'] = text
     def get_text(self):
         return self.obj['text']
     text = property(get_text, set_text)
@@ -227,6 +589,285 @@ class Card(object):
         return self.obj.oid is None
 
 
+class CardTable(object):
+    '''
+    The cards of a compact Graph, a row each, in columns: geometry in
+    arrays of doubles, text in a list with equal strings interned, and
+    whatever else a card holds (fields from newer versions, geometry that
+    isn't a plain number) in extras, {row: {name: value}}. A card costs a
+    few dozen bytes this way rather than a Card, a Storable and the dict
+    inside it, and going over the geometry of every card is indexing arrays,
+    which numpy.frombuffer(table.columns['x']) can view without copying.
+
+    Rows of cards that leave the graph, deleted and committed or reloaded
+    away, are blanked and reused for new ones.
+
+    Members:
+    * columns: {'x', 'y', 'w', 'h': array of doubles}
+    * floats: array of bits saying which of a row's geometry was a float
+      rather than an int, so that it's saved as it was loaded
+    * texts, oids: the text and saved oid of each row
+    * dirty, deleted: array of flags per row
+    * free: the rows to reuse
+    '''
+
+    GEOMETRY = ('x', 'y', 'w', 'h')
+    FLOAT_BITS = {'x': 1, 'y': 2, 'w': 4, 'h': 8}
+    # doubles hold integers exactly up to here
+    EXACT = 2 ** 53
+
+    def __init__(self):
+        self.columns = dict((name, array('d')) for name in self.GEOMETRY)
+        self.floats = array('B')
+        self.texts = []
+        self.interned = {}
+        self.oids = []
+        self.dirty = array('b')
+        self.deleted = array('b')
+        self.extras = {}
+        self.free = []
+
+    def __len__(self):
+        return len(self.texts)
+
+    def copy(self):
+        copy = CardTable()
+        for name in self.GEOMETRY:
+            copy.columns[name] = array('d', self.columns[name])
+        copy.floats = array('B', self.floats)
+        copy.texts = list(self.texts)
+        copy.interned = dict(self.interned)
+        copy.oids = list(self.oids)
+        copy.dirty = array('b', self.dirty)
+        copy.deleted = array('b', self.deleted)
+        copy.extras = dict((row, dict(extra)) for row, extra in self.extras.iteritems())
+        copy.free = list(self.free)
+        return copy
+
+    def add(self, values, oid=None):
+        "Add a row of the card dict values, saved as oid, and return its number"
+        if self.free:
+            row = self.free.pop()
+            self.oids[row] = oid
+        else:
+            row = len(self.texts)
+            for name in self.GEOMETRY:
+                self.columns[name].append(0)
+            self.floats.append(0)
+            self.texts.append('')
+            self.oids.append(oid)
+            self.dirty.append(0)
+            self.deleted.append(0)
+        for name, value in values.iteritems():
+            if name != objtype:
+                self.set(row, name, value)
+        self.dirty[row] = oid is None
+        return row
+
+    def release(self, rows):
+        '''
+        Blank rows, whose cards have left the graph, for add() to reuse.
+        Texts are interned afresh once most of those interned are gone.
+        '''
+        for row in rows:
+            for name in self.GEOMETRY:
+                self.columns[name][row] = 0
+            self.floats[row] = 0
+            self.texts[row] = ''
+            self.oids[row] = None
+            self.dirty[row] = 0
+            self.deleted[row] = 0
+            self.extras.pop(row, None)
+        self.free.extend(rows)
+        if len(self.interned) > 2 * (len(self.texts) - len(self.free)):
+            self.interned = dict((text, text) for text in self.texts)
+
+    def get(self, row, name):
+        extra = self.extras.get(row)
+        if extra and name in extra:
+            return extra[name]
+        if name == 'text':
+            return self.texts[row]
+        value = self.columns[name][row]
+        if self.floats[row] & self.FLOAT_BITS[name]:
+            return value
+        return int(value)
+
+    def set(self, row, name, value):
+        extra = self.extras.get(row)
+        if extra and name in extra:
+            del extra[name]
+            if not extra:
+                del self.extras[row]
+        if name == 'text' and isinstance(value, basestring):
+            self.texts[row] = self.interned.setdefault(value, value)
+        elif (name in self.columns and type(value) in (int, long, float)
+              and -self.EXACT < value < self.EXACT):
+            self.columns[name][row] = value
+            if type(value) is float:
+                self.floats[row] |= self.FLOAT_BITS[name]
+            else:
+                self.floats[row] &= ~self.FLOAT_BITS[name]
+        else:
+            self.extras.setdefault(row, {})[name] = value
+        self.dirty[row] = 1
+
+    def values(self, row):
+        "The card dict of row, as it would be saved"
+        values = {objtype: CARD_OBJTYPE, 'text': self.texts[row]}
+        for name in self.GEOMETRY:
+            values[name] = self.get(row, name)
+        values.update(self.extras.get(row, ()))
+        return values
+
+    def obj(self, row):
+        "A Storable of the card in row, with its oid unless it's dirty"
+        obj = storable.Storable(self.values(row))
+        if not self.dirty[row]:
+            obj.oid = self.oids[row]
+        return obj
+
+    def put(self, row, obj):
+        "Make the card in row the card dict obj, saved as obj.oid if it has one"
+        self.extras.pop(row, None)
+        for name, value in obj.iteritems():
+            if name != objtype:
+                self.set(row, name, value)
+        if obj.oid is not None:
+            self.oids[row] = obj.oid
+        self.dirty[row] = obj.oid is None
+
+    def save(self, row, datastore):
+        values = self.values(row)
+        oid = datastore.store(datastore.codec.encode(values), None,
+                              kvstore.object_info(values))
+        self.oids[row] = oid
+        self.dirty[row] = 0
+        return oid
+
+    def load(self, graph, oids):
+        "CompactCards of graph for the list of card oids, checked as Card checks them"
+        cards = []
+        for oid, values in load_objects(graph.datastore, oids):
+            if not isinstance(values, dict) or objtype not in values:
+                raise Error('Alleged card has no objtype at %s' % oid)
+            if values[objtype] != CARD_OBJTYPE:
+                raise Error('Invalid card at %s' % oid)
+            for prop in ('text',) + self.GEOMETRY:
+                if not prop in values:
+                    raise Error('Card missing property "%s" at %s' % (prop, oid))
+            cards.append(CompactCard(graph, self.add(values, oid)))
+        return cards
+
+    def new_card(self, graph):
+        return CompactCard(graph, self.add({'text': '', 'x': 0, 'y': 0,
+                                            'w': MIN_CARD_SIZE, 'h': MIN_CARD_SIZE}))
+
+    def move(self, rows, dx, dy):
+        "Move the cards in rows by (dx, dy)"
+        for name, delta in (('x', dx), ('y', dy)):
+            column = self.columns[name]
+            bit = self.FLOAT_BITS[name]
+            for row in rows:
+                if row in self.extras:
+                    self.set(row, name, self.get(row, name) + delta)
+                    continue
+                column[row] += delta
+                if type(delta) is float:
+                    self.floats[row] |= bit
+                self.dirty[row] = 1
+
+    def bounds(self, rows):
+        "(left, top, right, bottom) around the cards in rows, or None if there are none"
+        if not rows:
+            return None
+        x, y, w, h = [self.columns[name] for name in self.GEOMETRY]
+        if self.extras:
+            x, y, w, h = [[self.get(row, name) for row in rows] for name in self.GEOMETRY]
+            rows = xrange(len(rows))
+        return (min(x[row] for row in rows), min(y[row] for row in rows),
+                max(x[row] + w[row] for row in rows), max(y[row] + h[row] for row in rows))
+
+    def within(self, rows, left, top, right, bottom):
+        "Those of rows whose cards overlap the rectangle"
+        x, y, w, h = [self.columns[name] for name in self.GEOMETRY]
+        if self.extras:
+            get = self.get
+            return [row for row in rows
+                    if get(row, 'x') < right and get(row, 'x') + get(row, 'w') > left
+                    and get(row, 'y') < bottom and get(row, 'y') + get(row, 'h') > top]
+        return [row for row in rows
+                if x[row] < right and x[row] + w[row] > left
+                and y[row] < bottom and y[row] + h[row] > top]
+
+
+class CompactCard(object):
+    '''
+    A card of a compact Graph: a view of a row of graph.table, with the
+    interface of Card. Its obj is made from the row each time it's asked
+    for, and changing it changes nothing until it's assigned back. Once
+    the card leaves the graph, its row goes to another card.
+    '''
+
+    __slots__ = ('graph', 'row')
+
+    def __init__(self, graph, row):
+        self.graph = graph
+        self.row = row
+
+    def get_obj(self):
+        return self.graph.table.obj(self.row)
+    def set_obj(self, obj):
+        self.graph.table.put(self.row, obj)
+    obj = property(get_obj, set_obj)
+
+    def save(self):
+        return self.graph.table.save(self.row, self.graph.datastore)
+
+    def delete(self):
+        self._delete_me = True
+
+    def field(name, minimum=None):
+        def get(self):
+            return self.graph.table.get(self.row, name)
+        def set(self, value):
+            if minimum is not None:
+                value = max(value, minimum)
+            self.graph.table.set(self.row, name, value)
+        return property(get, set)
+    x = field('x')
+    y = field('y')
+    w = field('w', MIN_CARD_SIZE)
+    h = field('h', MIN_CARD_SIZE)
+    text = field('text')
+    del field
+
+    @property
+    def saved_oid(self):
+        return self.graph.table.oids[self.row]
+
+    @property
+    def oid(self):
+        "As Card.oid"
+        if self.dirty:
+            return None
+        return self.saved_oid
+
+    @property
+    def dirty(self):
+        return bool(self.graph.table.dirty[self.row])
+
+    def get_delete_me(self):
+        return bool(self.graph.table.deleted[self.row])
+    def set_delete_me(self, delete_me):
+        self.graph.table.deleted[self.row] = delete_me
+    _delete_me = property(get_delete_me, set_delete_me)
+
+    @property
+    def delete_me(self):
+        return self._delete_me
+
+
 class Edge(object):
     def __init__(self, graph, oid=None, card_by_oid=None, **kwargs):
         '''
@@ -244,10 +885,18 @@ class Edge(object):
         In the second case, oid is None and both keyword args must be present.
         Someday it will accept other parameters for edge type and whatever else,
         but for now any other kwargs will be ignored.
+
+        model.Graph.fork() also passes obj, the Storable of the edge being
+        forked, along with orig and dest; it's shared until either changes.
         '''
         self.graph = graph
         self.obj = storable.Storable()
-        if oid is not None:
+        if kwargs.get('obj') is not None:
+            self.obj = kwargs['obj']
+            self.obj.shared = True
+            self._orig = kwargs['orig']
+            self._dest = kwargs['dest']
+        elif oid is not None:
             # load from kvstore
             try:
                 self.obj.load(self.graph.datastore, oid)
@@ -276,9 +925,11 @@ class Edge(object):
                 self._dest = kwargs['dest']
             except KeyError as e:
                 raise Error('Missing required Edge fresh-construction argument %s' % e)
+        self.saved_oid = oid
         self._delete_me = False
 
     def delete(self):
+        self.touch()
         self._delete_me = True
  
     def save(self):
@@ -293,23 +944,25 @@ class Edge(object):
         if not self.dirty:
             return self.obj.oid
         # load origin
-        if self._orig.obj.oid:
-            self.obj['orig'] = self._orig.obj.oid
+        if self._orig.oid:
+            self.writable()['orig'] = self._orig.oid
         else:
             raise Error('Failed to save edge: origin card has not been saved')
         # load dest
-        if self._dest.obj.oid:
-            self.obj['dest'] = self._dest.obj.oid
+        if self._dest.oid:
+            self.writable()['dest'] = self._dest.oid
         else:
             raise Error('Failed to save edge: dest card has not been saved')
         # ok, now really save
-        return self.obj.save(self.graph.datastore)
+        self.saved_oid = self.obj.save(self.graph.datastore)
+        return self.saved_oid
 
     def set_orig(self, new):
         "Set origin card, do bookkeeping"
         assert new.graph is self.graph
+        self.touch()
         self._orig = new
-        self.obj['orig'] = '' # invalidate
+        self.writable()['orig'] = '' # invalidate
     def get_orig(self):
         return self._orig
     orig = property(get_orig, set_orig)
@@ -317,8 +970,9 @@ class Edge(object):
     def set_dest(self, new):
         "Set dest card, plus bookkeeping"
         assert new.graph is self.graph
+        self.touch()
         self._dest = new
-        self.obj['dest'] = ''
+        self.writable()['dest'] = ''
     def get_dest(self):
         return self._dest
     dest = property(get_dest, set_dest)
@@ -329,7 +983,24 @@ class Edge(object):
 
     def invalidate(self):
         "make self.dirty true, in cases where we know better"
-        self.obj.oid = None
+        self.writable().oid = None
+
+    @property
+    def oid(self):
+        "As Card.oid"
+        return self.obj.oid
+
+    def touch(self):
+        "As Card.touch()"
+        if self.graph.open_batch is not None:
+            self.graph.open_batch.keep(self)
+
+    def writable(self):
+        "As Card.writable()"
+        self.touch()
+        if self.obj.shared:
+            self.obj = self.obj.unshare()
+        return self.obj
 
     @property
     def delete_me(self):
@@ -0,0 +1,41 @@
+'''
+Chooses between the encodings objects can be stored in.
+
+Every stored object is either minijson text, which always starts with '{',
+or minibin data, which starts with minibin.FORMAT, so decode() works on
+either. Which one new objects are written in is a per-file setting.
+'''
+
+import minibin
+import minijson
+
+CODECS = {
+    'json': minijson,
+    'binary': minibin,
+}
+
+DEFAULT_CODEC = 'json'
+
+def get_codec(name):
+    '''
+    Return the codec module called name. Raise ValueError if unknown.
+    '''
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('unknown object codec: "%s"' % name)
+
+def codec_name(codec):
+    for name, module in CODECS.iteritems():
+        if module is codec:
+            return name
+    raise ValueError('not an object codec: %r' % codec)
+
+def detect(data):
+    "Return the codec module data was encoded with"
+    if data[:1] == minibin.FORMAT:
+        return minibin
+    return minijson
+
+def decode(data):
+    return detect(data).decode(data)
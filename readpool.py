@@ -0,0 +1,167 @@
+'''
+Read-only connections for background work on a .gp file.
+
+Garbage collection marking, exports, searches and the like only read, and
+shouldn't hold up the editor committing. Each of them takes a read
+transaction from a ReadPool: a connection of its own, with a transaction
+open on it. With the file in WAL mode (see sqlprofile), sqlite gives every
+read transaction the database as it was when it started, however much is
+committed meanwhile, and readers and the writer never wait for each other.
+gpfile.GraphPaperFile.snapshot() reads the head inside one, so everything
+reachable from it is there for as long as the snapshot is held, even if
+the writer garbage collects.
+
+Without WAL, readers still see a consistent commit, but a commit has to
+wait for them to finish.
+'''
+
+import contextlib
+import threading
+import unittest
+
+import sqlprofile
+
+
+class Error(Exception):
+    pass
+
+
+class ReadPool(object):
+    '''
+    Hands out read transactions on the file at filename, at most size at a
+    time, reusing their connections. Safe to use from any thread; each
+    connection belongs to the thread that took it until it's given back.
+    '''
+
+    def __init__(self, filename, size=4):
+        if filename == ':memory:':
+            raise Error('an in-memory database has no other connections')
+        self.filename = filename
+        self.size = size
+        self.idle = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(size)
+
+    def connect(self):
+        conn = sqlprofile.connect(self.filename, check_same_thread=False,
+                                  isolation_level=None)
+        profile = conn.execute(
+            "select value from config where key = 'storage_profile'").fetchone()
+        try:
+            sqlprofile.apply_reader(conn, profile[0] if profile else sqlprofile.DEFAULT_PROFILE)
+        except ValueError:
+            sqlprofile.apply_reader(conn, sqlprofile.DEFAULT_PROFILE)
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Context manager giving a connection inside a read transaction.
+        Blocks while size of them are out.
+        '''
+        self.slots.acquire()
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = self.connect()
+            conn.execute('begin')
+            try:
+                yield conn
+            finally:
+                conn.execute('rollback')
+                with self.lock:
+                    if self.closed:
+                        conn.close()
+                    else:
+                        self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        '''
+        Close the idle connections. Those still out are closed when they're
+        given back.
+        '''
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.closed = True
+        for conn in idle:
+            conn.close()
+
+
+class TestReadPool(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import gpfile
+        self.directory = tempfile.mkdtemp()
+        self.f = gpfile.GraphPaperFile(self.directory + '/test.gp')
+        self.f.set_profile('wal')
+        self.f.graph.new_card().text = 'first'
+        self.f.commit()
+
+    def tearDown(self):
+        import shutil
+        self.f.close()
+        shutil.rmtree(self.directory)
+
+    def make_branch(self):
+        "Commit on a new branch, back on master. Returns the branch's commit."
+        self.f.create_branch('idea')
+        self.f.checkout('idea')
+        self.f.graph.cards[0].text = 'idea'
+        idea = self.f.commit()
+        self.f.checkout('master')
+        return idea
+
+    def testSnapshotIsolation(self):
+        first_head = self.f.head
+        idea = self.make_branch()
+        with self.f.snapshot() as snapshot:
+            self.assertEqual(snapshot.head, first_head)
+            self.f.delete_branch('idea')
+            self.f.graph.cards[0].text = 'second'
+            self.f.commit()
+            for freed in self.f.collect_garbage():
+                pass
+            self.assertFalse(self.f.graph.datastore.contains(idea))
+            # the writer moved on and freed the branch; the snapshot still
+            # has it all
+            self.assertEqual(snapshot.config['head'], first_head)
+            self.assertEqual(snapshot.config['ref:idea'], idea)
+            self.assertTrue(snapshot.datastore.contains(idea))
+            self.assertEqual(snapshot.graph().cards[0].text, 'first')
+        with self.f.snapshot() as snapshot:
+            self.assertEqual(snapshot.graph().cards[0].text, 'second')
+
+    def testThreads(self):
+        texts = []
+        def read():
+            with self.f.snapshot() as snapshot:
+                texts.append(snapshot.graph().cards[0].text)
+        threads = [threading.Thread(target=read) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(texts, ['first'] * 8)
+        pool = self.f.read_pool()
+        self.assertTrue(len(pool.idle) <= pool.size)
+
+    def testBackgroundMarking(self):
+        idea = self.make_branch()
+        self.f.delete_branch('idea')
+        self.f.graph.cards[0].text = 'second'
+        self.f.commit()
+        freed = sum(self.f.collect_garbage())
+        # the branch's commit and its card; the walk was on a pooled
+        # connection
+        self.assertEqual(freed, 2)
+        self.assertEqual(len(self.f.read_pool().idle), 1)
+        self.assertFalse(self.f.graph.datastore.contains(idea))
+        self.assertEqual(self.f.graph.cards[0].text, 'second')
+
+if __name__ == '__main__':
+    unittest.main()
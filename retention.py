@@ -0,0 +1,201 @@
+'''
+Thinning of old history, and garbage collection.
+
+Autosaving makes a commit for nearly every edit. A RetentionPolicy keeps
+every commit for a while, then only the newest commit of each hour, then
+only the newest of each day. thin() rewrites the kept commits so each
+one's parent is the previous kept commit, after which collect_garbage()
+can free whatever nothing refers to any more.
+'''
+
+import itertools
+import time
+
+import model
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+class RetentionPolicy(object):
+    '''
+    Decides which commits are worth keeping.
+
+    Members:
+    * keep_all: age in seconds under which every commit is kept
+    * keep_hourly: age in seconds under which one commit per hour is kept.
+      Older commits are kept one per day.
+    '''
+
+    def __init__(self, keep_all_hours=24, hourly_days=7):
+        self.keep_all = keep_all_hours * HOUR
+        self.keep_hourly = hourly_days * DAY
+
+    @classmethod
+    def from_config(cls, config):
+        '''
+        Load the policy saved in a ConfigDict, or None if there isn't one.
+        '''
+        keep_all_hours = config['retention_keep_all_hours']
+        if keep_all_hours is None:
+            return None
+        return cls(float(keep_all_hours),
+                   float(config.get('retention_hourly_days', '7')))
+
+    def save(self, config):
+        config['retention_keep_all_hours'] = repr(float(self.keep_all) / HOUR)
+        config['retention_hourly_days'] = repr(float(self.keep_hourly) / DAY)
+
+    def bucket(self, commit_time, now):
+        '''
+        Return the bucket a commit made at commit_time falls in. Only the
+        newest commit in each bucket is kept; None means always keep.
+
+        Commits from before commits had times are always kept: there's no
+        telling how old they are.
+        '''
+        if commit_time is None:
+            return None
+        age = now - commit_time
+        if age < self.keep_all:
+            return None
+        elif age < self.keep_hourly:
+            return ('hour', commit_time // HOUR)
+        else:
+            return ('day', commit_time // DAY)
+
+
+def thin(datastore, head, policy, now=None, batch_size=100):
+    '''
+    Generator that drops the commits policy doesn't keep from the history
+    leading to head, looking at or rewriting batch_size commits per step.
+
+    Yields lists of (old commit oid, new commit oid), oldest first, for
+    every commit that was rewritten or dropped; a dropped commit maps to
+    the kept commit that now contains its changes. The last pair is the
+    head's, so its new oid is the new head. Nothing is yielded but empty
+    lists if nothing was dropped.
+
+    Nothing is deleted; run collect_garbage() afterwards.
+    '''
+    if now is None:
+        now = time.time()
+    # only remember (oid, keep) so long histories don't hold every manifest
+    chain = []
+    seen = set()
+    oid = head
+    while oid:
+        commit = model.load_commit(datastore, oid)
+        bucket = policy.bucket(commit.get('time'), now)
+        # the head is always kept
+        keep = oid == head or bucket is None or bucket not in seen
+        seen.add(bucket)
+        chain.append((oid, keep))
+        oid = commit['parent']
+        if len(chain) % batch_size == 0:
+            yield []
+    if all(keep for oid, keep in chain):
+        return
+    absorbed = []
+    dropped = []
+    parent = None
+    for oid, keep in reversed(chain):
+        if not keep:
+            dropped.append(oid)
+            continue
+        commit = model.load_commit(datastore, oid)
+        if commit['parent'] != parent:
+            commit['parent'] = parent
+            new_oid = commit.save(datastore)
+        else:
+            new_oid = oid
+        absorbed.extend((old_oid, new_oid) for old_oid in dropped)
+        absorbed.append((oid, new_oid))
+        dropped = []
+        parent = new_oid
+        if len(absorbed) >= batch_size:
+            yield absorbed
+            absorbed = []
+    yield absorbed
+
+
+def graft(datastore, head, base, onto):
+    '''
+    Move the commits after commit base up to head on top of commit onto,
+    as thin() does with those it keeps. Returns (new head, [(old commit
+    oid, new commit oid)] oldest first), or None if head doesn't descend
+    from base.
+    '''
+    chain = []
+    oid = head
+    while oid != base:
+        if oid is None:
+            return None
+        chain.append(oid)
+        oid = model.load_commit(datastore, oid)['parent']
+    moved = []
+    parent = onto
+    for oid in reversed(chain):
+        commit = model.load_commit(datastore, oid)
+        commit['parent'] = parent
+        parent = commit.save(datastore)
+        moved.append((oid, parent))
+    return parent, moved
+
+
+def mark_reachable(datastore, head, marked):
+    '''
+    Add the oids of every commit, card and edge reachable from commit head
+    to the set marked. Stops at commits that are already marked.
+    '''
+    oid = head
+    while oid and oid not in marked:
+        commit = model.load_commit(datastore, oid)
+        marked.add(oid)
+        marked.update(commit['cards'])
+        marked.update(commit.get('edges', []))
+        oid = commit['parent']
+
+
+def lost_commits(datastore, heads):
+    '''
+    Return the oids of the stored commits that none of the commits heads
+    lead to: those of deleted branches, and those thinned away, until
+    collect_garbage() frees them. They're found through the type index
+    (see kvstore.KVStore.keys_of_type()), so only commits get decoded.
+    '''
+    reachable = set()
+    for head in heads:
+        oid = head
+        while oid and oid not in reachable:
+            reachable.add(oid)
+            oid = model.load_commit(datastore, oid)['parent']
+    return [oid for oid in datastore.keys_of_type(model.COMMIT_OBJTYPE)
+            if oid not in reachable]
+
+
+def collect_garbage(datastore, roots, batch_size=1000, generation=None,
+                    marked=None):
+    '''
+    Delete every object not reachable from the commits returned by roots().
+    With a generation (see kvstore.KVStore.generation()), objects stored
+    after it are left alone. marked is a set of what's already known to be
+    reachable, if anything.
+
+    This is a generator that yields the list of deleted keys after each
+    batch, so it can be run a bit at a time while the file is being edited.
+    roots() is called again before every batch, and anything reachable from
+    new commits is marked before more is deleted.
+    '''
+    if marked is None:
+        marked = set()
+    keys = datastore.keys(batch_size, generation)
+    while True:
+        for root in roots():
+            mark_reachable(datastore, root, marked)
+        batch = list(itertools.islice(keys, batch_size))
+        if not batch:
+            return
+        garbage = [key for key in batch if key not in marked]
+        datastore.delete_many(garbage, generation)
+        yield garbage
@@ -0,0 +1,176 @@
+'''
+Full-text search over card text.
+
+SearchIndex keeps a sqlite FTS5 table of the text of every card on one
+commit's board, in the file itself, and which commit that is in the
+config as HEAD_KEY. It's kept up by passing it the card changes of each
+commit, like cardhistory.CardHistory, or caught up with any other commit
+by comparing the two manifests; either way only new cards are decoded.
+
+Queries are FTS5's: words match words anywhere in the text, in any order,
+"quoted words" match a phrase, and word* matches a prefix (quickly for
+prefixes of two or three letters, which get an index of their own).
+Results come best first, by BM25.
+'''
+
+import sqlite3
+import unittest
+
+import model
+from config import ConfigDict
+
+HEAD_KEY = 'search_head'
+
+
+class Error(Exception):
+    pass
+
+
+class SearchIndex(object):
+    '''
+    Text index living in a sqlite connection: card_search, the FTS5 table,
+    and card_search_oids giving the card oid of each of its rows.
+
+    Two cards with identical contents share an oid, and one row; when
+    either changes the other drops out of the index until it's rebuilt.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.config = ConfigDict(conn)
+        try:
+            self.conn.execute('''
+                create virtual table if not exists card_search
+                using fts5(text, tokenize = 'unicode61 remove_diacritics 2',
+                           prefix = '2 3')''')
+        except sqlite3.OperationalError as e:
+            raise Error('this sqlite can\'t search: %s' % e)
+        self.conn.execute('''
+            create table if not exists card_search_oids (
+                id integer primary key,
+                oid text not null unique)''')
+        self.conn.commit()
+
+    def head(self):
+        "The commit indexed, or None"
+        return self.config[HEAD_KEY]
+
+    def record(self, datastore, commit_oid, changes, parent):
+        '''
+        Index the card changes made by commit_oid on top of parent:
+        [(old oid, new oid)], as passed to model.Graph.commit_slot. Does
+        nothing unless parent is the commit indexed; update() catches up.
+        '''
+        if parent is None or parent != self.head():
+            return
+        self.remove([old for old, new in changes if old is not None])
+        self.add(datastore, [new for old, new in changes if new is not None])
+        self.config[HEAD_KEY] = commit_oid
+
+    def update(self, datastore, head):
+        '''
+        Index commit head's cards instead of those of the commit indexed,
+        building the index from scratch if need be.
+        '''
+        indexed = self.head()
+        if indexed == head:
+            return
+        new = set(model.load_commit(datastore, head)['cards'])
+        try:
+            old = set(model.load_commit(datastore, indexed)['cards']) if indexed else None
+        except model.Error:
+            # garbage collected since
+            old = None
+        if old is None:
+            self.clear()
+            old = set()
+        self.remove(old.difference(new))
+        self.add(datastore, sorted(new.difference(old)))
+        self.config[HEAD_KEY] = head
+
+    def add(self, datastore, oids):
+        for oid, card in model.load_objects(datastore, oids):
+            cur = self.conn.execute(
+                'insert or ignore into card_search_oids (oid) values (?)', (oid,))
+            if cur.rowcount:
+                self.conn.execute(
+                    'insert into card_search (rowid, text) values (?, ?)',
+                    (cur.lastrowid, card.get('text', '')))
+
+    def remove(self, oids):
+        for oid in oids:
+            row = self.conn.execute(
+                'select id from card_search_oids where oid = ?', (oid,)).fetchone()
+            if row is not None:
+                self.conn.execute('delete from card_search where rowid = ?', row)
+                self.conn.execute('delete from card_search_oids where id = ?', row)
+
+    def clear(self):
+        self.conn.execute('delete from card_search')
+        self.conn.execute('delete from card_search_oids')
+        del self.config[HEAD_KEY]
+
+    def search(self, query, limit=20):
+        '''
+        Return [(card oid, snippet)] for the cards matching query, best
+        first. A query that isn't valid FTS5 is searched for as plain words.
+        '''
+        sql = '''
+            select card_search_oids.oid,
+                   snippet(card_search, 0, '[', ']', '...', 10)
+            from card_search join card_search_oids
+                on card_search_oids.id = card_search.rowid
+            where card_search match ?
+            order by rank limit ?'''
+        try:
+            return self.conn.execute(sql, (query, limit)).fetchall()
+        except sqlite3.OperationalError:
+            words = ' '.join('"%s"' % word.replace('"', '""') for word in query.split())
+            if not words:
+                return []
+            return self.conn.execute(sql, (words, limit)).fetchall()
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        import kvbackend
+        import kvstore
+        self.store = kvstore.KVStore(kvbackend.MemoryBackend())
+        self.index = SearchIndex(sqlite3.connect(':memory:'))
+        self.graph = model.Graph(self.store, None)
+        self.graph.commit_slot.add(lambda oid, cards, edges: self.index.record(
+            self.store, oid, cards, self.graph.obj['parent']))
+        self.index.update(self.store, self.graph.commit())
+        for text in (u'apple pie recipe', u'Pi\xf1a colada', u'apple apple apple',
+                     u'recipe for pie'):
+            self.graph.new_card().text = text
+        self.first = self.graph.commit()
+        self.assertEqual(self.index.head(), self.first)
+
+    def texts(self, query):
+        by_oid = dict((c.saved_oid, c.text) for c in self.graph.cards)
+        return [by_oid[oid] for oid, snippet in self.index.search(query)]
+
+    def testQueries(self):
+        self.assertEqual(self.texts('apple')[0], 'apple apple apple')
+        self.assertEqual(self.texts('"pie recipe"'), ['apple pie recipe'])
+        self.assertEqual(sorted(self.texts('rec*')), ['apple pie recipe', 'recipe for pie'])
+        self.assertEqual(self.texts('pina'), [u'Pi\xf1a colada'])
+        self.assertEqual(self.texts('don\'t "'), [])
+
+    def testIncremental(self):
+        self.graph.cards[0].text = 'banana'
+        self.graph.cards[1].delete()
+        second = self.graph.commit()
+        self.assertEqual(self.texts('apple'), ['apple apple apple'])
+        self.assertEqual(self.texts('banana'), ['banana'])
+        # back to the first commit and forward again by manifests
+        self.index.update(self.store, self.first)
+        self.assertEqual(len(self.index.search('apple')), 2)
+        self.index.update(self.store, second)
+        self.assertEqual(len(self.index.search('apple')), 1)
+        self.assertEqual(len(self.index.search('colada')), 0)
+
+if __name__ == '__main__':
+    unittest.main()
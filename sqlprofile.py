@@ -0,0 +1,120 @@
+'''
+How sqlite is set up for a .gp file.
+
+A profile is a set of pragmas applied every time a file is opened. Which
+profile a file uses is saved in its config as 'storage_profile'; files
+without one get DEFAULT_PROFILE. The journal mode is kept in the file
+itself, so only choosing a profile (GraphPaperFile.set_profile()) changes
+it; WAL in particular stays until another profile switches it back.
+
+ * 'keep': whatever journal mode the file has, sqlite's default fsyncs and
+   a bigger page cache. The default.
+ * 'wal': write-ahead logging with synchronous=normal, so a commit is one
+   append to the -wal file and no fsync. A crash can lose the last commits
+   but never corrupts the file. Plus a memory map and a bigger page cache
+   for quick loads.
+ * 'safe': the same, but fsyncs every commit.
+ * 'fast': no fsyncs at all. For bulk imports and benchmarks; a power cut
+   can corrupt the file.
+ * 'compat': sqlite's own defaults, a rollback journal and no mmap. For
+   files on network drives, where WAL doesn't work.
+'''
+
+import sqlite3
+
+# applied in this order: synchronous=normal is only crash safe once the
+# journal is a WAL. None leaves a pragma alone.
+PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size')
+# the ones that matter to a connection that only reads (see readpool)
+READER_PRAGMAS = ('mmap_size', 'cache_size')
+
+PROFILES = {
+    'keep': {
+        'journal_mode': None,
+        'synchronous': 'full',
+        'mmap_size': 0,
+        'cache_size': -16 * 1024,
+    },
+    'wal': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -16 * 1024, # negative is in KiB
+    },
+    'safe': {
+        'journal_mode': 'wal',
+        'synchronous': 'full',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -16 * 1024,
+    },
+    'fast': {
+        'journal_mode': 'wal',
+        'synchronous': 'off',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,
+    },
+    'compat': {
+        'journal_mode': 'delete',
+        'synchronous': 'full',
+        'mmap_size': 0,
+        'cache_size': -2000,
+    },
+}
+
+DEFAULT_PROFILE = 'keep'
+
+# enough for every statement KVStore, ConfigDict and CardHistory use to stay
+# prepared; the sqlite3 module's default is 100
+CACHED_STATEMENTS = 256
+
+
+def get_profile(name):
+    '''
+    Return the pragmas of the profile called name. Raise ValueError if
+    unknown.
+    '''
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError('unknown storage profile: "%s"' % name)
+
+def connect(filename, **options):
+    '''
+    Open a sqlite connection the way .gp files are opened. options go to
+    sqlite3.connect().
+    '''
+    return sqlite3.connect(filename, cached_statements=CACHED_STATEMENTS, **options)
+
+def apply(conn, name):
+    '''
+    Set the pragmas of profile name on conn. Returns {pragma: value} as
+    sqlite reports them afterwards, which can differ from what was asked
+    for (an in-memory database has no WAL, for one).
+    '''
+    profile = get_profile(name)
+    # pragmas can't change the journal mode inside a transaction
+    conn.commit()
+    for pragma in PRAGMAS:
+        if profile[pragma] is not None:
+            conn.execute('pragma %s = %s' % (pragma, profile[pragma]))
+    return current(conn)
+
+def apply_reader(conn, name):
+    '''
+    Set up conn, on a file using profile name, to only read: the profile's
+    memory map and cache, and no writes.
+    '''
+    profile = get_profile(name)
+    for pragma in READER_PRAGMAS:
+        if profile[pragma] is not None:
+            conn.execute('pragma %s = %s' % (pragma, profile[pragma]))
+    conn.execute('pragma query_only = 1')
+
+def current(conn):
+    "{pragma: value} of conn's current settings"
+    settings = {}
+    for pragma in PRAGMAS:
+        # no row if sqlite was built without the feature (mmap, say)
+        row = conn.execute('pragma %s' % pragma).fetchone()
+        settings[pragma] = row[0] if row else None
+    return settings
@@ -1,4 +1,6 @@
+import kvstore
 import minijson
+import objcodec
 
 class Error(Exception):
     pass
@@ -11,21 +13,42 @@ class Storable(dict):
     Easy interface for storing dicts in a KVStore.
     Object acts like a dict, but adds a save method that takes
     a kvstore and returns the stored id.
+
+    Objects are saved in the codec of the datastore (see objcodec), and
+    can be loaded from either.
+
+    The encoded data and its key are remembered until the next change, so
+    saving an unchanged object doesn't encode or hash it again. Changes to
+    lists inside the dict aren't noticed; assign a new list instead.
+
+    shared is set on objects that more than one owner holds (see
+    model.Graph.fork()); owners should change a copy from unshare() instead.
     '''
 
+    shared = False
+
     def __init__(self, *args, **kwargs):
         dict.__init__(self, *args, **kwargs)
         self.oid = None
+        self._encoded = None
+        self._codec = None
+        self._key = None
+        self._key_hash = None
 
     def load(self, datastore, oid):
-        dat = datastore.get(oid)
-        if dat:
+        encoded = datastore.get(oid)
+        if encoded:
             try:
-                dat = minijson.decode(dat)       
+                codec = objcodec.detect(encoded)
+                dat = codec.decode(encoded)
                 if isinstance(dat, dict):
                     self.clear()
                     self.update(dat)
                     self.oid = oid
+                    self._encoded = encoded
+                    self._codec = codec
+                    self._key = oid
+                    self._key_hash = datastore.hash_name
                 else:
                     raise Error('StorableDict must be loaded from dict, key: %s' % oid)
             except ValueError:
@@ -33,10 +56,64 @@ class Storable(dict):
         else:
             raise Error('StorableDict got invalid key: %s' % oid)
     
+    def encode(self, codec=minijson):
+        "Return the canonical encoding of this object in codec"
+        if self._encoded is None or self._codec is not codec:
+            self._encoded = codec.encode(self)
+            self._codec = codec
+            self._key = None
+        return self._encoded
+
     def save(self, datastore):
-        self.oid = datastore.store(minijson.encode(self))
+        encoded = self.encode(datastore.codec)
+        if self._key_hash != datastore.hash_name:
+            self._key = None
+        self._key = self.oid = datastore.store(encoded, self._key,
+                                               kvstore.object_info(self))
+        self._key_hash = datastore.hash_name
         return self.oid
 
-    def __setitem__(self, *args):
+    def unshare(self):
+        "A private copy, keeping what's cached about the encoding"
+        copy = Storable(self)
+        copy.oid = self.oid
+        copy._encoded = self._encoded
+        copy._codec = self._codec
+        copy._key = self._key
+        copy._key_hash = self._key_hash
+        return copy
+
+    def _changed(self):
         self.oid = None
+        self._encoded = None
+        self._codec = None
+        self._key = None
+        self._key_hash = None
+
+    def __setitem__(self, *args):
+        self._changed()
         dict.__setitem__(self, *args)
+
+    def __delitem__(self, *args):
+        self._changed()
+        dict.__delitem__(self, *args)
+
+    def clear(self):
+        self._changed()
+        dict.clear(self)
+
+    def update(self, *args, **kwargs):
+        self._changed()
+        dict.update(self, *args, **kwargs)
+
+    def pop(self, *args):
+        self._changed()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._changed()
+        return dict.popitem(self)
+
+    def setdefault(self, *args):
+        self._changed()
+        return dict.setdefault(self, *args)
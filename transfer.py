@@ -0,0 +1,139 @@
+'''
+Copying history between files without decoding it.
+
+Objects are content addressed the same way in every .gp file, so an object
+is the same everywhere it's stored under the same key, and copying one is
+copying its row. transfer() walks back from a commit to the first commit
+the target already has, copies whatever those commits use that the target
+lacks, and never decodes anything but the commits themselves. Time goes
+with what's new, not with the size of the history.
+
+A file holds everything reachable from every commit in it: objects are
+copied before the commits that use them, oldest commit first, so that
+stays true even if a transfer is cut short.
+
+Both files must hash the same way. Their codecs and compression can
+differ: either codec can always be read, and compressed values stay
+readable wherever they go (see kvstore.KVStore.copy_from).
+'''
+
+import unittest
+
+import model
+
+
+def transfer(source, target, head, batch_size=1000):
+    '''
+    Copy everything reachable from commit head in KVStore source that
+    KVStore target lacks.
+
+    Returns (number of objects copied, the newest commit of head's history
+    that target already had, or None).
+    '''
+    if source.hash_name != target.hash_name:
+        raise ValueError('can\'t transfer from a %s keyed file to a %s keyed one' % (
+            source.hash_name, target.hash_name))
+    chain, boundary = history(source, head, target.contains)
+    copied = 0
+    objects = []
+    commits = []
+    for commit_oid, new in changes(source, chain, boundary):
+        objects.extend(new)
+        commits.append(commit_oid)
+        if len(objects) >= batch_size:
+            copied += copy(source, target, objects, commits)
+            objects = []
+            commits = []
+    copied += copy(source, target, objects, commits)
+    return copied, boundary
+
+
+def history(source, head, known):
+    '''
+    Walk back from commit head to the first commit known(oid) is true of.
+    Returns (the commits before it, newest first, that commit or None).
+    '''
+    chain = []
+    oid = head
+    while oid and not known(oid):
+        chain.append(oid)
+        oid = model.load_commit(source, oid)['parent']
+    return chain, oid
+
+
+def changes(source, chain, boundary):
+    '''
+    Generate (commit oid, oids it refers to that the commit before didn't)
+    for a chain from history(), oldest first.
+    '''
+    if boundary is not None:
+        previous = manifest(model.load_commit(source, boundary))
+    else:
+        previous = set()
+    for commit_oid in reversed(chain):
+        current = manifest(model.load_commit(source, commit_oid))
+        yield commit_oid, current.difference(previous)
+        previous = current
+
+
+def manifest(commit):
+    "The set of oids a commit refers to, apart from its parent"
+    return set(commit['cards']).union(commit.get('edges', []))
+
+
+def copy(source, target, objects, commits):
+    '''
+    Copy objects that target lacks, then commits. Returns how many were
+    copied.
+    '''
+    copied = 0
+    for keys in (objects, commits):
+        missing = list(set(keys).difference(target.backend.present(keys)))
+        not_found = target.copy_from(source, missing)
+        if not_found:
+            raise model.Error('Objects missing from source: %s' % ', '.join(not_found))
+        copied += len(missing)
+    return copied
+
+
+class TestTransfer(unittest.TestCase):
+
+    def store(self, codec='json'):
+        import kvbackend
+        import kvstore
+        return kvstore.KVStore(kvbackend.MemoryBackend(), codec=codec,
+                               compression='zlib')
+
+    def testIncremental(self):
+        source = self.store()
+        target = self.store(codec='binary')
+        g = model.Graph(source, None)
+        for i in range(20):
+            g.new_card().text = 'card %d' % i
+        g.new_edge(g.cards[0], g.cards[1])
+        first = g.commit()
+        copied, boundary = transfer(source, target, first)
+        self.assertEqual((copied, boundary), (22, None))
+        self.assertEqual(len(model.Graph(target, first).cards), 20)
+        g.cards[0].text = 'changed'
+        g.new_card().text = 'new'
+        second = g.commit()
+        g.cards[5].delete()
+        third = g.commit()
+        copied, boundary = transfer(source, target, third)
+        # two cards, the edge to the changed one, two commits
+        self.assertEqual((copied, boundary), (5, first))
+        self.assertEqual(model.Graph(target, third).cards[0].text, 'changed')
+        self.assertEqual(transfer(source, target, third), (0, third))
+        self.assertEqual(target.get(second), source.get(second))
+
+    def testHashMismatch(self):
+        source = self.store()
+        g = model.Graph(source, None)
+        head = g.commit()
+        target = self.store()
+        target.hash_name = 'sha256'
+        self.assertRaises(ValueError, transfer, source, target, head)
+
+if __name__ == '__main__':
+    unittest.main()
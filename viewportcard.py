@@ -230,6 +230,7 @@ class ViewportCard(object):
 
     def focusin(self, event):
         self.editing = True
+        self.viewport.card_focused(self)
 
     def focusout(self, event):
         self.editing = False
@@ -244,15 +245,20 @@ class ViewportCard(object):
             "Delete?",
             "Delete card \"%s\" and all its edges?" % title_sample
         ):
-            for handle in self.edge_handles:
-                self.canvas.delete(handle)
-            self.deletion_slot.signal()
-            self.viewport.remove_card(self)
-            self.card.delete()
-            self.window.destroy()
-            self.gpfile.commit()
+            # the edges commit as they go; make it one commit
+            with self.gpfile.batch():
+                self.remove()
         return "break"
 
+    def remove(self):
+        "Delete the card and its edges, without committing"
+        for handle in self.edge_handles:
+            self.canvas.delete(handle)
+        self.deletion_slot.signal()
+        self.viewport.remove_card(self)
+        self.card.delete()
+        self.window.destroy()
+
     def save_card(self):
         # grab values from self.window,
         # and put them in the model.card